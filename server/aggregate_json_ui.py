@@ -1,11 +1,17 @@
 import database as db
 import sqlalchemy
 from sqlalchemy import func, and_, or_
+from sqlalchemy.dialects import postgresql
 import cherrypy
 from cgi import escape as html_escape
 from operator import itemgetter
 import json
 import decimal
+import rollups
+import result_cache
+from histogram import Histogram, bucket_index_clause, gamma
+from dimensions import chunk_size, chunks
+from collections import defaultdict
 
 
 class Decimal_JSON_Encoder(json.JSONEncoder):
@@ -63,7 +69,8 @@ def datatables(query_func):
         if table_kwargs:
             # parse datatables kwargs
             sort = []
-            cols = (None, column_name_dict[table_class], 'count', 'total', 'avg', 'min', 'max')
+            cols = (None, column_name_dict[table_class], 'count', 'total', 'avg', 'min', 'max') + \
+                   tuple(name for name, q in percentiles)
             for i in xrange(int(table_kwargs['iSortingCols'])):
                 sort_col = cols[int(table_kwargs['iSortCol_' + str(i)])]
                 sort_dir = 'DESC' if table_kwargs['sSortDir_' + str(i)] == 'desc' else 'ASC'
@@ -98,13 +105,13 @@ def datatables(query_func):
 
     return dt_wrapped
 
-def filter_query(query, filter_kwargs, table_class):
-    call_stack_metadata_dict = {
-            'module': db.CallStackName.module_name,
-            'class':  db.CallStackName.class_name,
-            'method': db.CallStackName.fn_name
-        }
+call_stack_metadata_dict = {
+        'module': db.CallStackName.module_name,
+        'class':  db.CallStackName.class_name,
+        'method': db.CallStackName.fn_name
+    }
 
+def filter_query(query, filter_kwargs, table_class):
     for k in filter_kwargs:
         if 'key_' in k:
             v = k.replace('key', 'value')
@@ -114,8 +121,12 @@ def filter_query(query, filter_kwargs, table_class):
 
                 call_stack_attr = call_stack_metadata_dict[filter_kwargs[k]]
                 query = query.filter(call_stack_attr == filter_kwargs[v])
-            else: # General metadata filter args
-                query = query.filter(table_class.metadata_items.any(and_(db.MetaData.key == filter_kwargs[k], db.MetaData.value == filter_kwargs[v])))
+            else: # General metadata filter args, matched against the metadata sets holding the item
+                metadata_set_ids = sqlalchemy.select([db.metadata_set_items.c.metadata_set_id])\
+                                             .where(db.metadata_set_items.c.metadata_id == db.MetaData.id)\
+                                             .where(db.MetaData.key == filter_kwargs[k])\
+                                             .where(db.MetaData.value == filter_kwargs[v])
+                query = query.filter(table_class.metadata_set_id.in_(metadata_set_ids))
     return query
 
 metadata_table_dict = {
@@ -134,53 +145,256 @@ searchable_columns_dict = {
         db.FileAccess: [db.FileName.filename]
     }
 
+def contains_pattern(term):
+    # A LIKE pattern matching term anywhere, with any wildcards in it escaped.
+    # Served by the trigram indexes on the searchable columns
+    return '%{0}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+def metadata_filtered(filter_kwargs):
+    # the rollups only know names, not the metadata of each fact
+    return any(filter_kwargs[k] not in call_stack_metadata_dict for k in filter_kwargs if 'key_' in k)
+
+def aggregate_query(table_class, filter_kwargs):
+    column_name = column_name_dict[table_class]
+    metadata_table = metadata_table_dict[table_class][0]
+    metadata_value = metadata_table_dict[table_class][1]
+    table_class_column = metadata_table_dict[table_class][2]
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+
+    if metadata_filtered(filter_kwargs):
+        # aggregate the facts themselves
+        query = db.session.query(
+                metadata_table.id,
+                metadata_value.label(column_name),
+                func.count(table_class.id).label('count'),
+                sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
+                sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
+                sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
+                sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')
+            )
+        # Only get information for current tab (e.g. Call Stacks)
+        query = query.join(table_class_column)
+        if start_date:
+            query = query.filter(table_class.datetime > start_date)
+        if end_date:
+            query = query.filter(table_class.datetime < end_date)
+    else:
+        # merge the rollups covering the period
+        count = func.sum(db.Rollup.count)
+        query = db.session.query(
+                metadata_table.id,
+                metadata_value.label(column_name),
+                count.label('count'),
+                sqlalchemy.cast(func.sum(db.Rollup.total), sqlalchemy.Numeric(10, 5)).label('total'),
+                sqlalchemy.cast(func.sum(db.Rollup.total) / func.nullif(count, 0), sqlalchemy.Numeric(10, 5)).label('avg'),
+                sqlalchemy.cast(func.min(db.Rollup.min), sqlalchemy.Numeric(10, 5)).label('min'),
+                sqlalchemy.cast(func.max(db.Rollup.max), sqlalchemy.Numeric(10, 5)).label('max')
+            )
+        query = query.join(db.Rollup, rollups.join_clause(table_class, metadata_table.id))
+        query = query.filter(rollups.period_clause(start_date, end_date))
+        query = query.having(count > 0)
+
+    # Filter data based on the key/value pairs picked in the side bar
+    query = filter_query(query, filter_kwargs, table_class)
+    return query.group_by(metadata_table.id)
+
+percentiles = (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99))
+
+def histograms(table_class, filter_kwargs, ids):
+    # Latency histograms of the given names, merged from the rollups
+    # or, if the rollups can't answer the filters, built by the database.
+    # The rollups hold no metadata, so with a metadata filter the histograms
+    # are built from the matching facts themselves
+    metadata_table = metadata_table_dict[table_class][0]
+    table_class_column = metadata_table_dict[table_class][2]
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+
+    name_histograms = defaultdict(Histogram)
+    if not ids:
+        return name_histograms
+
+    if metadata_filtered(filter_kwargs):
+        index = bucket_index_clause(table_class.duration)
+        query = db.session.query(metadata_table.id, index, func.count(table_class.id))
+        query = query.join(table_class_column)
+        if start_date:
+            query = query.filter(table_class.datetime > start_date)
+        if end_date:
+            query = query.filter(table_class.datetime < end_date)
+        query = filter_query(query, filter_kwargs, table_class)
+        for chunk in chunks(sorted(ids), chunk_size):
+            for name_id, index, count in query.filter(metadata_table.id.in_(chunk)).group_by(metadata_table.id, index):
+                name_histograms[name_id].merge(Histogram({index: count}))
+    else:
+        query = db.session.query(metadata_table.id, db.Rollup.histogram)
+        query = query.join(db.Rollup, rollups.join_clause(table_class, metadata_table.id))
+        query = query.filter(rollups.period_clause(start_date, end_date))
+        query = filter_query(query, filter_kwargs, table_class)
+        for chunk in chunks(sorted(ids), chunk_size):
+            for name_id, histogram in query.filter(metadata_table.id.in_(chunk)):
+                name_histograms[name_id].merge(Histogram.from_json(histogram))
+    return name_histograms
+
+def bucket_counts_query(table_class, filter_kwargs):
+    # (name_id, index, count) of each histogram bucket of each name, the
+    # histograms of histograms() added up by the database instead
+    metadata_table = metadata_table_dict[table_class][0]
+    table_class_column = metadata_table_dict[table_class][2]
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+
+    if metadata_filtered(filter_kwargs):
+        index = bucket_index_clause(table_class.duration)
+        query = db.session.query(metadata_table.id.label('name_id'), index.label('index'),
+                                 func.count(table_class.id).label('count'))
+        query = query.join(table_class_column)
+        if start_date:
+            query = query.filter(table_class.datetime > start_date)
+        if end_date:
+            query = query.filter(table_class.datetime < end_date)
+        query = filter_query(query, filter_kwargs, table_class)
+        return query.group_by(metadata_table.id, index)
+
+    # each rollup's histogram split into its buckets, json_each_text can
+    # refer to the rollup joined before it
+    histogram_buckets = func.json_each_text(sqlalchemy.cast(func.coalesce(func.nullif(db.Rollup.histogram, ''), '{}'),
+                                                            postgresql.JSON)).alias('histogram_buckets')
+    index = sqlalchemy.cast(sqlalchemy.literal_column('histogram_buckets.key'), sqlalchemy.Integer)
+    count = func.sum(sqlalchemy.cast(sqlalchemy.literal_column('histogram_buckets.value'), sqlalchemy.BigInteger))
+    query = db.session.query(metadata_table.id.label('name_id'), index.label('index'), count.label('count'))
+    query = query.join(db.Rollup, rollups.join_clause(table_class, metadata_table.id))
+    query = query.join(histogram_buckets, sqlalchemy.true())
+    query = query.filter(rollups.period_clause(start_date, end_date))
+    query = filter_query(query, filter_kwargs, table_class)
+    return query.group_by(metadata_table.id, index)
+
+def percentile_index_query(bucket_counts, q):
+    # (name_id, index) of the bucket each name's q quantile falls in, as
+    # Histogram.percentile finds it
+    seen = func.sum(bucket_counts.c.count).over(partition_by=bucket_counts.c.name_id,
+                                                order_by=bucket_counts.c.index)
+    total = func.sum(bucket_counts.c.count).over(partition_by=bucket_counts.c.name_id)
+    cumulative = sqlalchemy.select([bucket_counts.c.name_id, bucket_counts.c.index,
+                                    seen.label('seen'), total.label('total')]).alias()
+    return sqlalchemy.select([cumulative.c.name_id, func.min(cumulative.c.index).label('index')])\
+                     .where(cumulative.c.seen > q * (cumulative.c.total - 1))\
+                     .group_by(cumulative.c.name_id)
+
+def sort_by_percentiles(query, table_class, filter_kwargs, sort):
+    # The aggregate query sorted by the database, percentiles included, so
+    # only the page asked for is fetched. The percentiles are worked out
+    # from the histogram buckets the same way add_percentiles does it
+    aggregates = query.subquery()
+    query = db.session.query(*aggregates.c)
+    bucket_counts = bucket_counts_query(table_class, filter_kwargs).subquery()
+    sort_columns = dict((column.name, column) for column in aggregates.c)
+    for name, q in percentiles:
+        if name in (sorter[0] for sorter in sort):
+            percentile_index = percentile_index_query(bucket_counts, q).alias(name)
+            query = query.outerjoin(percentile_index, percentile_index.c.name_id == aggregates.c.id)
+            value = 2 * func.power(gamma, percentile_index.c.index) / (gamma + 1)
+            sort_columns[name] = func.least(func.greatest(value, aggregates.c.min), aggregates.c.max)
+    for column, direction in sort:
+        # rows without a value go last, as sort_results leaves them
+        if direction.upper() == 'DESC':
+            query = query.order_by(sort_columns[column].desc().nullslast())
+        else:
+            query = query.order_by(sort_columns[column].asc().nullsfirst())
+    return query
+
+def add_percentiles(results, table_class, filter_kwargs):
+    name_histograms = histograms(table_class, filter_kwargs, [result[0] for result in results])
+    for result in results:
+        histogram = name_histograms[result[0]]
+        for name, q in percentiles:
+            value = histogram.percentile(q)
+            if value is not None:
+                # the bucket value may be slightly outside the range seen
+                value = round(min(max(value, float(result[5])), float(result[6])), 5)
+            result.append(value)
+    return results
+
+def sort_results(results, sort, column_name):
+    cols = ['id', column_name, 'count', 'total', 'avg', 'min', 'max'] + [name for name, q in percentiles]
+    for column, direction in reversed(sort):
+        results.sort(key=itemgetter(cols.index(column)), reverse=direction.upper() == 'DESC')
+    return results
+
+# Tables estimated to hold more rows than this are counted from the planner's
+# statistics rather than exactly, 0 to always count exactly
+approximate_count_threshold = 100000
+
+def setup(count_threshold):
+    global approximate_count_threshold
+    approximate_count_threshold = count_threshold
+
+def table_count(model):
+    # The number of rows of a table, estimated if it is a big one
+    if approximate_count_threshold and db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(sqlalchemy.text('SELECT reltuples FROM pg_class WHERE relname = :name'),
+                                      {'name': model.__tablename__}).scalar()
+        if estimate is not None and estimate > approximate_count_threshold:
+            return int(estimate)
+    return db.session.query(func.count(model.id)).scalar()
+
 # Get JSON aggregate data for main aggregate pages
 @datatables
+@result_cache.cached
 def json_aggregate(table_class, filter_kwargs=None, search=None, sort=[('avg','DESC')], start=None, limit=None):
     # Get specific table info (call stack/sql statement/file access)
-    column_name = column_name_dict[table_class]
     metadata_table = metadata_table_dict[table_class][0]
-    metadata_value = metadata_table_dict[table_class][1]
-    table_class_column = metadata_table_dict[table_class][2]
 
-    total_num_items = db.session.query(metadata_table).count()
+    total_num_items = table_count(metadata_table)
     
     # Get aggregate data for datatable/d3 bar graph
-    query = db.session.query(
-            metadata_table.id,
-            metadata_value.label(column_name),
-            func.count(table_class.id).label('count'),
-            sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
-            sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
-            sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
-            sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')
-        )
-    # Only get information for current tab (e.g. Call Stacks)
-    query = query.join(table_class_column)
-    
-    # Filter data based on the key/value pairs picked in the side bar
-    query = filter_query(query, filter_kwargs, table_class)
-    query = query.group_by(metadata_table.id)
+    query = aggregate_query(table_class, filter_kwargs)
 
     if search:
         search_clauses = []
         for column in searchable_columns_dict[table_class]:
-            search_clauses.append(column.ilike('%{0}%'.format(search)))
+            search_clauses.append(column.ilike(contains_pattern(search), escape='\\'))
         query = query.filter(or_(*search_clauses))
 
-    for sorter in sort:
-        query = query.order_by('{0} {1}'.format(*sorter))
-        
-    # Get filtered count before limiting to datatables length 
-    filtered_num_items = query.count()
-
-    if start:
-        query = query.offset(start)
-    if limit:
-        query = query.limit(limit)
+    percentile_sort = any(sorter[0] in dict(percentiles) for sorter in sort)
+    if percentile_sort and db.engine.dialect.name != 'postgresql':
+        # the histograms can only be merged here, so every row has to be
+        # fetched to be sorted by a percentile
+        results = [list(result) for result in query.all()]
+        filtered_num_items = len(results)
+        add_percentiles(results, table_class, filter_kwargs)
+        sort_results(results, sort, column_name_dict[table_class])
+        start = start or 0
+        results = results[start:start + limit] if limit else results[start:]
+    else:
+        if percentile_sort:
+            query = sort_by_percentiles(query, table_class, filter_kwargs, sort)
+        else:
+            for sorter in sort:
+                query = query.order_by('{0} {1}'.format(*sorter))
+
+        # Count the filtered rows in the same pass, before limiting to datatables length
+        filtered_query = query
+        query = query.add_columns(func.count().over().label('filtered_count'))
+
+        if start:
+            query = query.offset(start)
+        if limit:
+            query = query.limit(limit)
+
+        # Convert to lists from keyedTuples, dropping the count
+        results = [list(result) for result in query.all()]
+        if results:
+            filtered_num_items = results[0][-1]
+        elif start:
+            # paged past the end, count again without the page
+            filtered_num_items = filtered_query.count()
+        else:
+            filtered_num_items = 0
+        results = [result[:-1] for result in results]
+        add_percentiles(results, table_class, filter_kwargs)
 
-    # Convert to lists from keyedTuples
-    results = [list(result) for result in query.all()]
     # Convert call stack name objects to strings
     for result in results:
         result[1] = str(result[1])
@@ -188,75 +402,167 @@ def json_aggregate(table_class, filter_kwargs=None, search=None, sort=[('avg','D
     return results, total_num_items, filtered_num_items
 
 # Get JSON aggregate data for aggregate item pages
+@result_cache.cached
 def json_aggregate_item(table_class, filter_kwargs, id):
     # Get specific table info (call stack/sql statement/file access)
-    column_name = column_name_dict[table_class]
     metadata_table = metadata_table_dict[table_class][0]
-    metadata_value = metadata_table_dict[table_class][1]
-    table_class_column = metadata_table_dict[table_class][2]
     
     sort = filter_kwargs.get('sort', [('avg','DESC')])
     limit = filter_kwargs.get('limit', None)
-    start_date = filter_kwargs.get('start_date', None)
-    end_date = filter_kwargs.get('end_date', None)
 
     # Get timing data for d3 graph
-    times_query = db.session.query(metadata_table.id,
-                                   table_class.id,
-                                   table_class.duration,
-                                   table_class.datetime)
-    times_query = times_query.join(table_class_column)
-    times_query = filter_query(times_query, filter_kwargs, table_class)
-    times_query = times_query.filter(metadata_table.id == id)
-
-    if start_date:
-        times_query = times_query.filter(table_class.datetime > start_date)
-    if end_date:
-        times_query = times_query.filter(table_class.datetime < end_date)
-
-    times = [(time[2], time[3], time[1]) for time in times_query.all()]
-    times = sorted(times, key=itemgetter(1))
+    series = json_timeseries(table_class, filter_kwargs, id)
     
     # Get aggregate item data
-    query = db.session.query(
-            metadata_table.id,
-            metadata_value.label(column_name),
-            func.count(table_class.id).label('count'),
-            sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
-            sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
-            sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
-            sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')
-        )
-    # Only get information for current tab (e.g. Call Stacks)
-    query = query.join(table_class_column)
-    
-    # Filter data based on the key/value pairs picked in the side bar
-    query = filter_query(query, filter_kwargs, table_class)
-    
-    query = query.group_by(metadata_table.id)
+    query = aggregate_query(table_class, filter_kwargs)
     query = query.filter(metadata_table.id == id)
-    
-    if start_date:
-        query = query.filter(table_class.datetime > start_date)
-    if end_date:
-        query = query.filter(table_class.datetime < end_date)
 
     for sorter in sort:
-        query = query.order_by('{0} {1}'.format(*sorter))
+        if sorter[0] not in dict(percentiles):
+            query = query.order_by('{0} {1}'.format(*sorter))
 
     if limit:
         query = query.limit(limit)
     
     try:
-        result = list(query.first())
+        result = add_percentiles([list(query.first())], table_class, filter_kwargs)[0]
         # Convert call stack name object to string
         result[1] = str(result[1])
-        result.append(times)
+        result.append(series)
         return result,1,1
     except:
         return [],0,0
 
+# Number of buckets the time series of an item is cut into, at most, and the
+# number of calls sampled for the scatter plot
+series_points = 200
+sample_size = 500
+
+# Widths the time series buckets can have, in seconds
+series_widths = (1, 5, 10, 30, 60, 5 * 60, 10 * 60, 30 * 60, 60 * 60, 3 * 60 * 60, 6 * 60 * 60,
+                 12 * 60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60)
+
+def series_width(start_date, end_date):
+    # The narrowest bucket width giving no more than series_points buckets
+    for width in series_widths:
+        if (end_date - start_date) / width < series_points:
+            return width
+    return series_widths[-1]
+
+def item_facts_query(query, table_class, filter_kwargs, id):
+    # Restrict a query of facts to those of an item matching the filters
+    metadata_table = metadata_table_dict[table_class][0]
+    table_class_column = metadata_table_dict[table_class][2]
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+
+    query = query.join(table_class_column)
+    query = filter_query(query, filter_kwargs, table_class)
+    query = query.filter(metadata_table.id == id)
+    if start_date:
+        query = query.filter(table_class.datetime > start_date)
+    if end_date:
+        query = query.filter(table_class.datetime < end_date)
+    return query
+
+def series_query(table_class, filter_kwargs, id, start_date, end_date, width):
+    # The query series_summaries runs, and whether it reads the rollups:
+    # they are used if some resolution divides the width, else the database
+    # summarises the facts
+    resolutions = [resolution for resolution in rollups.available_resolutions(start_date, end_date)
+                   if width % resolution == 0]
+    if resolutions and not metadata_filtered(filter_kwargs):
+        query = db.session.query(db.Rollup.bucket, db.Rollup.count, db.Rollup.total,
+                                 db.Rollup.min, db.Rollup.max, db.Rollup.histogram)
+        query = query.filter(db.Rollup.fact_type == rollups.fact_types[table_class])
+        query = query.filter(db.Rollup.name_id == id)
+        query = query.filter(db.Rollup.resolution == resolutions[-1])
+        query = query.filter(db.Rollup.bucket >= start_date // resolutions[-1] * resolutions[-1])
+        query = query.filter(db.Rollup.bucket < end_date)
+        return query, True
+    time_bucket = sqlalchemy.cast(func.floor(table_class.datetime / width), sqlalchemy.Integer)
+    index = bucket_index_clause(table_class.duration)
+    query = db.session.query(time_bucket, index, func.count(table_class.id), func.sum(table_class.duration),
+                             func.min(table_class.duration), func.max(table_class.duration))
+    query = item_facts_query(query, table_class, filter_kwargs, id)
+    return query.group_by(time_bucket, index), False
+
+def series_summaries(table_class, filter_kwargs, id, start_date, end_date, width):
+    # Summaries of the durations of an item per time bucket
+    summaries = defaultdict(rollups.Summary)
+    query, from_rollups = series_query(table_class, filter_kwargs, id, start_date, end_date, width)
+    if from_rollups:
+        for bucket, count, total, shortest, longest, histogram in query:
+            summaries[bucket // width * width].merge(
+                rollups.Summary(count, total, shortest, longest, Histogram.from_json(histogram)))
+    else:
+        for bucket, index, count, total, shortest, longest in query:
+            summaries[bucket * width].merge(rollups.Summary(count, total, shortest, longest, Histogram({index: count})))
+    return summaries
+
+def sample_query(table_class, filter_kwargs, id, counts, width):
+    # A sample of the calls of an item spread over the time buckets of its
+    # series, counts being the calls in each bucket. Each bucket gets a
+    # share of the sample in proportion to its calls and reads just that
+    # many rows off the index, so the cost doesn't grow with the calls
+    total = sum(counts.itervalues())
+    selects = []
+    for bucket, count in sorted(counts.items()):
+        if not count:
+            continue
+        share = min(count, max(1, int(round(float(sample_size) * count / total))))
+        query = db.session.query(table_class.duration, table_class.datetime, table_class.id)
+        query = item_facts_query(query, table_class, filter_kwargs, id)
+        query = query.filter(table_class.datetime >= bucket).filter(table_class.datetime < bucket + width)
+        bucket_sample = query.order_by(table_class.datetime).limit(share).subquery()
+        selects.append(sqlalchemy.select(list(bucket_sample.c)))
+    if not selects:
+        return None
+    return sqlalchemy.union_all(*selects)
+
+# Get the time series of an item for the d3 graph: count, avg, max and p99
+# per time bucket, plus a sample of the calls themselves
+@result_cache.cached
+def json_timeseries(table_class, filter_kwargs, id):
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+
+    if start_date is None or end_date is None:
+        query = db.session.query(func.min(table_class.datetime), func.max(table_class.datetime))
+        first, last = item_facts_query(query, table_class, filter_kwargs, id).one()
+        if first is None:
+            return {'width': None, 'buckets': [], 'sample': []}
+        start_date = int(first) if start_date is None else start_date
+        end_date = int(last) + 1 if end_date is None else end_date
+
+    width = series_width(start_date, end_date)
+    summaries = series_summaries(table_class, filter_kwargs, id, start_date, end_date, width)
+    buckets = []
+    for bucket, summary in sorted(summaries.items()):
+        if summary.count:
+            buckets.append([bucket, summary.count, round(summary.total / summary.count, 5), round(summary.max, 5),
+                            round(min(max(summary.histogram.percentile(0.99), summary.min), summary.max), 5)])
+
+    query = sample_query(table_class, filter_kwargs, id,
+                         dict((bucket, summary.count) for bucket, summary in summaries.iteritems()), width)
+    sample = sorted((tuple(row) for row in db.session.execute(query)), key=itemgetter(1)) if query is not None else []
+
+    return {'width': width, 'buckets': buckets, 'sample': sample}
+
+# the fact table of each AggregateAPI page
+url_table_classes = {'callstacks': db.CallStack,
+                     'sqlstatements': db.SQLStatement,
+                     'fileaccesses': db.FileAccess}
+
 class AggregateAPI(object):
+    @cherrypy.expose
+    @cherrypy.tools.json_out(handler=json_handler)
+    def timeseries(self, url_name, id, **kwargs):
+        if url_name not in url_table_classes:
+            raise cherrypy.NotFound
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        return json_timeseries(url_table_classes[url_name], filter_kwargs, id)
+
     @cherrypy.expose
     @cherrypy.tools.json_out(handler=json_handler)
     def callstacks(self, id=None, **kwargs):
@@ -0,0 +1,27 @@
+"""add pstat blobs
+
+Revision ID: 393fcf61d562
+Revises: 25606b7db808
+Create Date: 2026-10-18 10:12:41.518000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '393fcf61d562'
+down_revision = '25606b7db808'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('pstat_blobs',
+        sa.Column('key', sa.String, primary_key=True),
+        sa.Column('segment', sa.Integer),
+        sa.Column('start', sa.BigInteger),
+        sa.Column('length', sa.Integer)
+    )
+
+
+def downgrade():
+    op.drop_table('pstat_blobs')
@@ -0,0 +1,62 @@
+"""add rollups
+
+Revision ID: 4a1f0d3c2b7e
+Revises: 393fcf61d562
+Create Date: 2026-10-18 11:02:17.604000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1f0d3c2b7e'
+down_revision = '393fcf61d562'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+fact_tables = (('call_stack', 'call_stacks', 'call_stack_name_id'),
+               ('sql_statement', 'sql_statements', 'sql_string_id'),
+               ('file_access', 'file_accesses', 'file_name_id'))
+
+resolutions = (60, 3600, 86400)
+
+# must match the buckets of histogram.py
+backfill = """
+INSERT INTO rollups (fact_type, resolution, bucket, name_id, count, total, min, max, histogram)
+SELECT '{fact_type}', {resolution}, bucket, name_id, sum(n), sum(total), min(min), max(max),
+       '{{' || string_agg('"' || index || '":' || n, ',') || '}}'
+FROM (SELECT (floor(datetime / {resolution}) * {resolution})::integer AS bucket,
+             {name_column} AS name_id,
+             ceil(ln(greatest(duration, 1e-6)) / ln(1.05))::integer AS index,
+             count(*) AS n, sum(duration) AS total, min(duration) AS min, max(duration) AS max
+      FROM {table}
+      WHERE datetime IS NOT NULL AND duration IS NOT NULL AND {name_column} IS NOT NULL
+      GROUP BY 1, 2, 3) AS histogram_buckets
+GROUP BY bucket, name_id
+"""
+
+
+def upgrade():
+    op.create_table('rollups',
+        sa.Column('fact_type', sa.String, primary_key=True),
+        sa.Column('resolution', sa.Integer, primary_key=True),
+        sa.Column('bucket', sa.Integer, primary_key=True),
+        sa.Column('name_id', sa.Integer, primary_key=True),
+        sa.Column('count', sa.Integer),
+        sa.Column('total', sa.Float),
+        sa.Column('min', sa.Float),
+        sa.Column('max', sa.Float),
+        sa.Column('histogram', sa.String)
+    )
+    op.create_index('ix_rollups_name', 'rollups', ['fact_type', 'name_id', 'resolution', 'bucket'])
+
+    # roll up the facts stored so far
+    for fact_type, table, name_column in fact_tables:
+        for resolution in resolutions:
+            op.execute(backfill.format(fact_type=fact_type, table=table,
+                                       name_column=name_column, resolution=resolution))
+
+
+def downgrade():
+    op.drop_index('ix_rollups_name', 'rollups')
+    op.drop_table('rollups')
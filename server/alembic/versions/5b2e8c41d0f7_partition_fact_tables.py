@@ -0,0 +1,80 @@
+"""partition fact tables
+
+Revision ID: 5b2e8c41d0f7
+Revises: 4a1f0d3c2b7e
+Create Date: 2026-10-18 13:40:52.291000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8c41d0f7'
+down_revision = '4a1f0d3c2b7e'
+
+from alembic import op
+import sqlalchemy as sa
+import time
+import ConfigParser
+
+
+day = 24 * 60 * 60
+
+
+def partition_days():
+    '''The partition_days the server is configured with, its partitions must line up with these'''
+    config = ConfigParser.ConfigParser()
+    config.read('server_config.cfg')
+    if config.has_option('global', 'partition_days'):
+        return config.getint('global', 'partition_days')
+    return 1
+
+# fact table -> foreign keys of the association tables pointing at it
+fact_tables = {'call_stacks': [('call_stack_metadata_association', 'call_stack_id')],
+               'sql_statements': [('sql_statement_metadata_association', 'sql_statement_id'),
+                                  ('sql_arguments_association', 'sql_statement_id'),
+                                  ('sql_stack_association', 'sql_statement_id')],
+               'file_accesses': [('file_access_metadata_association', 'file_access_id')]}
+
+
+def partition_name(table, start, days):
+    # must match partitions.partition_name
+    return '{0}_{1}_{2}d'.format(table, time.strftime('%Y%m%d', time.gmtime(start)), days)
+
+
+def upgrade():
+    connection = op.get_bind()
+    days = partition_days()
+    period = days * day
+    for table, foreign_keys in fact_tables.items():
+        for association_table, column in foreign_keys:
+            op.drop_constraint('{0}_{1}_fkey'.format(association_table, column), association_table)
+
+        # move the facts stored so far into partitions of the configured
+        # period, aligned as partitions.partition_start aligns them
+        first, last = connection.execute('SELECT min(datetime), max(datetime) FROM ONLY {0}'.format(table)).first()
+        if first is None:
+            continue
+        for start in xrange(int(first) // period * period, int(last) + 1, period):
+            name = partition_name(table, start, days)
+            op.execute('CREATE TABLE {0} ('
+                       '    LIKE {1} INCLUDING DEFAULTS INCLUDING INDEXES,'
+                       '    CHECK (datetime >= {2} AND datetime < {3})'
+                       ') INHERITS ({1})'.format(name, table, start, start + period))
+            op.execute('INSERT INTO {0} SELECT * FROM ONLY {1} WHERE datetime >= {2} AND datetime < {3}'
+                       .format(name, table, start, start + period))
+        op.execute('DELETE FROM ONLY {0} WHERE datetime IS NOT NULL'.format(table))
+
+
+def downgrade():
+    connection = op.get_bind()
+    for table, foreign_keys in fact_tables.items():
+        partitions = connection.execute(sa.text('SELECT child.relname FROM pg_inherits '
+                                                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                                                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                                                'WHERE parent.relname = :parent'), parent=table).fetchall()
+        for (name,) in partitions:
+            op.execute('INSERT INTO {0} SELECT * FROM ONLY {1}'.format(table, name))
+            op.execute('DROP TABLE {0}'.format(name))
+
+        for association_table, column in foreign_keys:
+            op.create_foreign_key('{0}_{1}_fkey'.format(association_table, column),
+                                  association_table, table, [column], ['id'])
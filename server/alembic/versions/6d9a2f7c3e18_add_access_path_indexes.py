@@ -0,0 +1,62 @@
+"""add access path indexes
+
+Revision ID: 6d9a2f7c3e18
+Revises: 5b2e8c41d0f7
+Create Date: 2026-10-18 14:55:03.117000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d9a2f7c3e18'
+down_revision = '5b2e8c41d0f7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# fact table -> (index name suffix, columns), for the table and each of its partitions
+fact_indexes = {'call_stacks': [('name_datetime', ['call_stack_name_id', 'datetime']),
+                                ('datetime', ['datetime'])],
+                'sql_statements': [('string_datetime', ['sql_string_id', 'datetime']),
+                                   ('datetime', ['datetime'])],
+                'file_accesses': [('name_datetime', ['file_name_id', 'datetime']),
+                                  ('datetime', ['datetime'])]}
+
+indexes = [('ix_call_stack_metadata_association_metadata', 'call_stack_metadata_association', ['metadata_id', 'call_stack_id']),
+           ('ix_sql_statement_metadata_association_metadata', 'sql_statement_metadata_association', ['metadata_id', 'sql_statement_id']),
+           ('ix_file_access_metadata_association_metadata', 'file_access_metadata_association', ['metadata_id', 'file_access_id']),
+           ('ix_sql_stack_association_stack_item', 'sql_stack_association', ['sql_stack_item_id']),
+           ('ix_sql_arguments_association_argument', 'sql_arguments_association', ['sql_argument_id'])]
+
+
+def partitions(table):
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT child.relname FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE parent.relname = :parent'), parent=table)]
+
+
+def all_indexes():
+    for name, table, columns in indexes:
+        yield name, table, columns
+    for table, table_indexes in fact_indexes.items():
+        for suffix, columns in table_indexes:
+            # indexes on the parent are copied to partitions created from now on
+            yield 'ix_{0}_{1}'.format(table, suffix), table, columns
+            for partition in partitions(table):
+                yield '{0}_{1}_idx'.format(partition, suffix), partition, columns
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, end the one
+    # alembic started so ingest carries on while the indexes are built
+    op.execute('COMMIT')
+    for name, table, columns in list(all_indexes()):
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} ({2})'.format(name, table, ', '.join(columns)))
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, table, columns in list(all_indexes()):
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
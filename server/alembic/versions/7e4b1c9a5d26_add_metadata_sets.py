@@ -0,0 +1,107 @@
+"""add metadata sets
+
+Revision ID: 7e4b1c9a5d26
+Revises: 6d9a2f7c3e18
+Create Date: 2026-10-18 16:20:41.503000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e4b1c9a5d26'
+down_revision = '6d9a2f7c3e18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# fact table -> (metadata association table, its fact column)
+fact_tables = {'call_stacks': ('call_stack_metadata_association', 'call_stack_id'),
+               'sql_statements': ('sql_statement_metadata_association', 'sql_statement_id'),
+               'file_accesses': ('file_access_metadata_association', 'file_access_id')}
+
+
+def partitions(table):
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT child.relname FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE parent.relname = :parent'), parent=table)]
+
+
+def column_indexes(table, columns):
+    '''The indexes of a table on the given columns, whatever they were named'''
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexdef LIKE :definition'),
+                table=table, definition='% ({0})'.format(', '.join(columns)))]
+
+
+def upgrade():
+    op.create_table('metadata_sets',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+    )
+    op.create_table('metadata_set_items',
+        sa.Column('metadata_set_id', sa.Integer(), nullable=False),
+        sa.Column('metadata_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['metadata_set_id'], ['metadata_sets.id']),
+        sa.ForeignKeyConstraint(['metadata_id'], ['metadata_items.id']),
+        sa.PrimaryKeyConstraint('metadata_set_id', 'metadata_id')
+    )
+    op.create_index('ix_metadata_set_items_metadata', 'metadata_set_items', ['metadata_id', 'metadata_set_id'])
+
+    for table, (association_table, fact_column) in fact_tables.items():
+        # added to the parent, the partitions inherit the column
+        op.add_column(table, sa.Column('metadata_set_id', sa.Integer(), sa.ForeignKey('metadata_sets.id'), nullable=True))
+
+        # the key is the md5 of the sorted metadata ids, as dimensions.metadata_set_key makes it
+        op.execute('CREATE TEMPORARY TABLE fact_metadata_sets AS '
+                   'SELECT {0} AS fact_id, '
+                   '       md5(string_agg(metadata_id::text, \',\' ORDER BY metadata_id)) AS key, '
+                   '       array_agg(metadata_id ORDER BY metadata_id) AS metadata_ids '
+                   'FROM {1} GROUP BY {0}'.format(fact_column, association_table))
+        op.execute('INSERT INTO metadata_sets (key) '
+                   'SELECT DISTINCT key FROM fact_metadata_sets '
+                   'WHERE NOT EXISTS (SELECT 1 FROM metadata_sets WHERE metadata_sets.key = fact_metadata_sets.key)')
+        op.execute('INSERT INTO metadata_set_items (metadata_set_id, metadata_id) '
+                   'SELECT DISTINCT metadata_sets.id, unnest(sets.metadata_ids) '
+                   'FROM (SELECT DISTINCT key, metadata_ids FROM fact_metadata_sets) sets '
+                   'JOIN metadata_sets ON metadata_sets.key = sets.key '
+                   'ON CONFLICT DO NOTHING')
+        op.execute('UPDATE {0} SET metadata_set_id = metadata_sets.id '
+                   'FROM fact_metadata_sets JOIN metadata_sets ON metadata_sets.key = fact_metadata_sets.key '
+                   'WHERE {0}.id = fact_metadata_sets.fact_id'.format(table))
+        op.execute('DROP TABLE fact_metadata_sets')
+
+        # indexes on the parent are copied to partitions created from now on
+        op.create_index('ix_{0}_metadata_set_datetime'.format(table), table, ['metadata_set_id', 'datetime'])
+        for partition in partitions(table):
+            op.create_index('{0}_metadata_set_datetime_idx'.format(partition), partition, ['metadata_set_id', 'datetime'])
+
+        op.drop_table(association_table)
+
+
+def downgrade():
+    for table, (association_table, fact_column) in fact_tables.items():
+        op.create_table(association_table,
+            sa.Column(fact_column, sa.Integer(), nullable=False),
+            sa.Column('metadata_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['metadata_id'], ['metadata_items.id']),
+            sa.PrimaryKeyConstraint(fact_column, 'metadata_id')
+        )
+        op.create_index('ix_{0}_metadata'.format(association_table), association_table, ['metadata_id', fact_column])
+        op.execute('INSERT INTO {0} ({1}, metadata_id) '
+                   'SELECT {2}.id, metadata_set_items.metadata_id FROM {2} '
+                   'JOIN metadata_set_items ON metadata_set_items.metadata_set_id = {2}.metadata_set_id'
+                   .format(association_table, fact_column, table))
+        # partitions created since got indexes named by postgres
+        for partition in partitions(table):
+            for name in column_indexes(partition, ['metadata_set_id', 'datetime']):
+                op.execute('DROP INDEX IF EXISTS {0}'.format(name))
+        op.drop_index('ix_{0}_metadata_set_datetime'.format(table))
+        op.drop_column(table, 'metadata_set_id')
+
+    op.drop_index('ix_metadata_set_items_metadata', 'metadata_set_items')
+    op.drop_table('metadata_set_items')
+    op.drop_table('metadata_sets')
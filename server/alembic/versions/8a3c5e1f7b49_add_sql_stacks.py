@@ -0,0 +1,85 @@
+"""add sql stacks
+
+Revision ID: 8a3c5e1f7b49
+Revises: 7e4b1c9a5d26
+Create Date: 2026-10-18 17:48:12.264000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a3c5e1f7b49'
+down_revision = '7e4b1c9a5d26'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def partitions(table):
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT child.relname FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE parent.relname = :parent'), parent=table)]
+
+
+def column_indexes(table, columns):
+    '''The indexes of a table on the given columns, whatever they were named'''
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexdef LIKE :definition'),
+                table=table, definition='% ({0})'.format(', '.join(columns)))]
+
+
+def upgrade():
+    op.create_table('sql_stacks',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(), nullable=True),
+        sa.Column('frames', postgresql.ARRAY(sa.Integer()), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+    )
+    # added to the parent, the partitions inherit the column
+    op.add_column('sql_statements', sa.Column('sql_stack_id', sa.Integer(), sa.ForeignKey('sql_stacks.id'), nullable=True))
+
+    # the key is the md5 of the ordered stack item ids, as dimensions.sql_stack_key makes it
+    op.execute('CREATE TEMPORARY TABLE statement_stacks AS '
+               'SELECT sql_statement_id, '
+               '       md5(string_agg(sql_stack_item_id::text, \',\' ORDER BY index)) AS key, '
+               '       array_agg(sql_stack_item_id ORDER BY index) AS frames '
+               'FROM sql_stack_association GROUP BY sql_statement_id')
+    op.execute('INSERT INTO sql_stacks (key, frames) '
+               'SELECT DISTINCT ON (key) key, frames FROM statement_stacks')
+    op.execute('UPDATE sql_statements SET sql_stack_id = sql_stacks.id '
+               'FROM statement_stacks JOIN sql_stacks ON sql_stacks.key = statement_stacks.key '
+               'WHERE sql_statements.id = statement_stacks.sql_statement_id')
+    op.execute('DROP TABLE statement_stacks')
+
+    # indexes on the parent are copied to partitions created from now on
+    op.create_index('ix_sql_statements_stack_datetime', 'sql_statements', ['sql_stack_id', 'datetime'])
+    for partition in partitions('sql_statements'):
+        op.create_index('{0}_stack_datetime_idx'.format(partition), partition, ['sql_stack_id', 'datetime'])
+
+    op.drop_table('sql_stack_association')
+
+
+def downgrade():
+    op.create_table('sql_stack_association',
+        sa.Column('sql_statement_id', sa.Integer(), nullable=False),
+        sa.Column('sql_stack_item_id', sa.Integer(), nullable=False),
+        sa.Column('index', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['sql_stack_item_id'], ['sql_stack_items.id']),
+        sa.PrimaryKeyConstraint('sql_statement_id', 'sql_stack_item_id', 'index')
+    )
+    op.create_index('ix_sql_stack_association_stack_item', 'sql_stack_association', ['sql_stack_item_id'])
+    op.execute('INSERT INTO sql_stack_association (sql_statement_id, sql_stack_item_id, index) '
+               'SELECT sql_statements.id, frame.sql_stack_item_id, frame.position - 1 '
+               'FROM sql_statements JOIN sql_stacks ON sql_stacks.id = sql_statements.sql_stack_id, '
+               'unnest(sql_stacks.frames) WITH ORDINALITY AS frame(sql_stack_item_id, position)')
+
+    # partitions created since got indexes named by postgres
+    for partition in partitions('sql_statements'):
+        for name in column_indexes(partition, ['sql_stack_id', 'datetime']):
+            op.execute('DROP INDEX IF EXISTS {0}'.format(name))
+    op.drop_index('ix_sql_statements_stack_datetime')
+    op.drop_column('sql_statements', 'sql_stack_id')
+    op.drop_table('sql_stacks')
@@ -0,0 +1,61 @@
+"""store sql args inline
+
+Revision ID: 9b6d2a4e8c13
+Revises: 8a3c5e1f7b49
+Create Date: 2026-10-18 18:36:57.820000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b6d2a4e8c13'
+down_revision = '8a3c5e1f7b49'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    # added to the parent, the partitions inherit the column
+    op.add_column('sql_statements', sa.Column('args', postgresql.ARRAY(sa.String()), nullable=True))
+    # keys and values alternating, in the order of the args
+    op.execute('UPDATE sql_statements SET args = statement_args.args '
+               'FROM (SELECT sql_statement_id, array_agg(pair.item ORDER BY association.index, pair.position) AS args '
+               '      FROM sql_arguments_association association '
+               '      JOIN sql_arguments ON sql_arguments.id = association.sql_argument_id, '
+               '      unnest(ARRAY[sql_arguments.key, sql_arguments.value]) WITH ORDINALITY AS pair(item, position) '
+               '      GROUP BY sql_statement_id) statement_args '
+               'WHERE sql_statements.id = statement_args.sql_statement_id')
+    op.drop_table('sql_arguments_association')
+    op.drop_table('sql_arguments')
+
+
+def downgrade():
+    op.create_table('sql_arguments',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(), nullable=True),
+        sa.Column('value', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('sql_arguments_association',
+        sa.Column('sql_statement_id', sa.Integer(), nullable=False),
+        sa.Column('sql_argument_id', sa.Integer(), nullable=False),
+        sa.Column('index', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['sql_argument_id'], ['sql_arguments.id']),
+        sa.PrimaryKeyConstraint('sql_statement_id', 'sql_argument_id', 'index')
+    )
+    op.create_index('ix_sql_arguments_association_argument', 'sql_arguments_association', ['sql_argument_id'])
+
+    op.execute('CREATE TEMPORARY TABLE statement_args AS '
+               'SELECT id AS sql_statement_id, (i - 1) / 2 AS index, args[i] AS key, args[i + 1] AS value '
+               'FROM sql_statements, generate_subscripts(args, 1) AS i '
+               'WHERE i % 2 = 1')
+    op.execute('INSERT INTO sql_arguments (key, value) '
+               'SELECT DISTINCT key, value FROM statement_args')
+    op.execute('INSERT INTO sql_arguments_association (sql_statement_id, sql_argument_id, index) '
+               'SELECT statement_args.sql_statement_id, sql_arguments.id, statement_args.index '
+               'FROM statement_args JOIN sql_arguments '
+               'ON sql_arguments.key IS NOT DISTINCT FROM statement_args.key '
+               'AND sql_arguments.value IS NOT DISTINCT FROM statement_args.value')
+    op.execute('DROP TABLE statement_args')
+    op.drop_column('sql_statements', 'args')
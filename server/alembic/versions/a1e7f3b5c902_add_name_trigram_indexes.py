@@ -0,0 +1,36 @@
+"""add name trigram indexes
+
+Revision ID: a1e7f3b5c902
+Revises: 9b6d2a4e8c13
+Create Date: 2026-10-18 19:52:26.431000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1e7f3b5c902'
+down_revision = '9b6d2a4e8c13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+indexes = [('ix_call_stack_names_module_name_trgm', 'call_stack_names', 'module_name'),
+           ('ix_call_stack_names_class_name_trgm', 'call_stack_names', 'class_name'),
+           ('ix_call_stack_names_fn_name_trgm', 'call_stack_names', 'fn_name'),
+           ('ix_sql_strings_sql_trgm', 'sql_strings', 'sql'),
+           ('ix_file_names_filename_trgm', 'file_names', 'filename')]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, end the one
+    # alembic started so ingest carries on while the indexes are built
+    op.execute('COMMIT')
+    for name, table, column in indexes:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} USING gin ({2} gin_trgm_ops)'.format(name, table, column))
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, table, column in indexes:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
@@ -0,0 +1,32 @@
+"""add merged profiles
+
+Revision ID: b3f8d1c6e247
+Revises: a1e7f3b5c902
+Create Date: 2026-10-18 21:14:08.517000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3f8d1c6e247'
+down_revision = 'a1e7f3b5c902'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('merged_profiles',
+        sa.Column('call_stack_name_id', sa.Integer(), nullable=False),
+        sa.Column('resolution', sa.Integer(), nullable=False),
+        sa.Column('bucket', sa.Integer(), nullable=False),
+        sa.Column('profile_count', sa.Integer(), nullable=True),
+        sa.Column('pstat_key', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['call_stack_name_id'], ['call_stack_names.id']),
+        sa.PrimaryKeyConstraint('call_stack_name_id', 'resolution', 'bucket')
+    )
+    op.create_index('ix_merged_profiles_pstat_key', 'merged_profiles', ['pstat_key'])
+
+
+def downgrade():
+    op.drop_index('ix_merged_profiles_pstat_key', 'merged_profiles')
+    op.drop_table('merged_profiles')
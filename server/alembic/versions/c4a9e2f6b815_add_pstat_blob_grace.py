@@ -0,0 +1,59 @@
+"""add pstat blob grace
+
+Revision ID: c4a9e2f6b815
+Revises: b3f8d1c6e247
+Create Date: 2026-10-19 09:41:52.306000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e2f6b815'
+down_revision = 'b3f8d1c6e247'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def partitions(table):
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT child.relname FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE parent.relname = :parent'), parent=table)]
+
+
+def column_indexes(table, columns):
+    '''The indexes of a table on the given columns, whatever they were named'''
+    return [name for (name,) in op.get_bind().execute(sa.text(
+                'SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexdef LIKE :definition'),
+                table=table, definition='% ({0})'.format(', '.join(columns)))]
+
+
+def upgrade():
+    op.add_column('pstat_blobs', sa.Column('created_at', sa.Float(), nullable=True))
+    op.add_column('pstat_blobs', sa.Column('graph_key', sa.String(), nullable=True))
+    # what is stored already gets a full grace period from now
+    op.execute('UPDATE pstat_blobs SET created_at = extract(epoch FROM now())')
+    op.execute("UPDATE pstat_blobs SET graph_key = pstat_blobs.key || '.graph' "
+               "WHERE EXISTS (SELECT 1 FROM pstat_blobs graphs WHERE graphs.key = pstat_blobs.key || '.graph')")
+    op.create_index('ix_pstat_blobs_graph_key', 'pstat_blobs', ['graph_key'])
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, end the one
+    # alembic started so ingest carries on while the indexes are built.
+    # Indexes on the parent are copied to partitions created from now on
+    op.execute('COMMIT')
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_call_stacks_pstat_uuid ON call_stacks (pstat_uuid)')
+    for partition in partitions('call_stacks'):
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_pstat_uuid_idx ON {0} (pstat_uuid)'.format(partition))
+
+
+def downgrade():
+    op.drop_index('ix_pstat_blobs_graph_key', 'pstat_blobs')
+    op.drop_column('pstat_blobs', 'graph_key')
+    op.drop_column('pstat_blobs', 'created_at')
+
+    op.execute('COMMIT')
+    for partition in partitions('call_stacks'):
+        for name in column_indexes(partition, ['pstat_uuid']):
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_call_stacks_pstat_uuid')
@@ -0,0 +1,117 @@
+"""store null natural keys as empty
+
+Revision ID: d5b7f3a8c926
+Revises: c4a9e2f6b815
+Create Date: 2026-10-19 11:07:33.815000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd5b7f3a8c926'
+down_revision = 'c4a9e2f6b815'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# dimension table -> its natural key columns, which may have been NULL
+dimensions = {'call_stack_names': ('module_name', 'class_name', 'fn_name'),
+              'sql_stack_items': ('module', 'function'),
+              'metadata_items': ('key', 'value')}
+
+# the duplicate rows the unique constraints let in, as NULLs never match, and
+# the oldest row with the same key which takes their place
+find_duplicates = """
+CREATE TEMPORARY TABLE duplicates AS
+SELECT id, keep_id FROM (SELECT id, min(id) OVER (PARTITION BY {keys}) AS keep_id FROM {table}) ids
+WHERE id != keep_id
+"""
+
+# must match the buckets of histogram.py, the histograms of the rollups of
+# a name and its duplicates are added up bucket by bucket
+merge_rollups = """
+CREATE TEMPORARY TABLE merged_rollups AS
+SELECT totals.resolution, totals.bucket, totals.name_id, totals.count, totals.total, totals.min, totals.max,
+       histograms.histogram
+FROM (SELECT resolution, bucket, coalesce(duplicates.keep_id, name_id) AS name_id,
+             sum(count) AS count, sum(total) AS total, min(min) AS min, max(max) AS max
+      FROM rollups LEFT JOIN duplicates ON duplicates.id = rollups.name_id
+      WHERE fact_type = 'call_stack' AND name_id IN (SELECT id FROM duplicates UNION SELECT keep_id FROM duplicates)
+      GROUP BY 1, 2, 3) totals
+LEFT JOIN (SELECT resolution, bucket, name_id, '{' || string_agg('"' || index || '":' || n, ',') || '}' AS histogram
+           FROM (SELECT resolution, bucket, coalesce(duplicates.keep_id, name_id) AS name_id,
+                        histogram_buckets.key AS index, sum(histogram_buckets.value::bigint) AS n
+                 FROM rollups LEFT JOIN duplicates ON duplicates.id = rollups.name_id,
+                      json_each_text(coalesce(nullif(rollups.histogram, ''), '{}')::json) AS histogram_buckets
+                 WHERE fact_type = 'call_stack'
+                 AND name_id IN (SELECT id FROM duplicates UNION SELECT keep_id FROM duplicates)
+                 GROUP BY 1, 2, 3, 4) histogram_counts
+           GROUP BY 1, 2, 3) histograms
+ON histograms.resolution = totals.resolution AND histograms.bucket = totals.bucket
+AND histograms.name_id = totals.name_id
+"""
+
+
+def repoint_call_stack_names():
+    op.execute('UPDATE call_stacks SET call_stack_name_id = duplicates.keep_id FROM duplicates '
+               'WHERE call_stacks.call_stack_name_id = duplicates.id')
+    op.execute(merge_rollups)
+    op.execute("DELETE FROM rollups WHERE fact_type = 'call_stack' "
+               "AND name_id IN (SELECT id FROM duplicates UNION SELECT keep_id FROM duplicates)")
+    op.execute("INSERT INTO rollups (fact_type, resolution, bucket, name_id, count, total, min, max, histogram) "
+               "SELECT 'call_stack', resolution, bucket, name_id, count, total, min, max, histogram FROM merged_rollups")
+    op.execute('DROP TABLE merged_rollups')
+    # merged profiles can't be added up here, a duplicate's are only kept
+    # for the buckets the name it is merged into has none for
+    op.execute('DELETE FROM merged_profiles USING duplicates '
+               'WHERE merged_profiles.call_stack_name_id = duplicates.id '
+               'AND EXISTS (SELECT 1 FROM merged_profiles kept '
+               '            WHERE kept.call_stack_name_id = duplicates.keep_id '
+               '            AND kept.resolution = merged_profiles.resolution AND kept.bucket = merged_profiles.bucket)')
+    op.execute('UPDATE merged_profiles SET call_stack_name_id = duplicates.keep_id FROM duplicates '
+               'WHERE merged_profiles.call_stack_name_id = duplicates.id')
+
+
+def repoint_sql_stack_items():
+    # the keys of the stacks are left as they are, a stack ingested again
+    # gets a new row with the same frames, which does no harm
+    op.execute('UPDATE sql_stacks SET frames = ARRAY('
+               '    SELECT coalesce(duplicates.keep_id, frame.id) '
+               '    FROM unnest(sql_stacks.frames) WITH ORDINALITY AS frame(id, position) '
+               '    LEFT JOIN duplicates ON duplicates.id = frame.id ORDER BY frame.position) '
+               'WHERE sql_stacks.frames && ARRAY(SELECT id FROM duplicates)')
+
+
+def repoint_metadata_items():
+    # likewise the keys of the metadata sets
+    op.execute('DELETE FROM metadata_set_items USING duplicates '
+               'WHERE metadata_set_items.metadata_id = duplicates.id '
+               'AND EXISTS (SELECT 1 FROM metadata_set_items kept '
+               '            WHERE kept.metadata_set_id = metadata_set_items.metadata_set_id '
+               '            AND kept.metadata_id = duplicates.keep_id)')
+    op.execute('UPDATE metadata_set_items SET metadata_id = duplicates.keep_id FROM duplicates '
+               'WHERE metadata_set_items.metadata_id = duplicates.id')
+
+
+repoint = {'call_stack_names': repoint_call_stack_names,
+           'sql_stack_items': repoint_sql_stack_items,
+           'metadata_items': repoint_metadata_items}
+
+
+def upgrade():
+    for table, columns in dimensions.items():
+        op.execute(find_duplicates.format(table=table,
+                                          keys=', '.join("coalesce({0}, '')".format(column) for column in columns)))
+        repoint[table]()
+        op.execute('DELETE FROM {0} WHERE id IN (SELECT id FROM duplicates)'.format(table))
+        op.execute('DROP TABLE duplicates')
+        for column in columns:
+            op.execute("UPDATE {0} SET {1} = '' WHERE {1} IS NULL".format(table, column))
+            op.alter_column(table, column, nullable=False)
+
+
+def downgrade():
+    # the duplicates merged are not split again
+    for table, columns in dimensions.items():
+        for column in columns:
+            op.alter_column(table, column, nullable=True)
@@ -0,0 +1,24 @@
+"""add sql stack used at
+
+Revision ID: e6c8a4b2d137
+Revises: d5b7f3a8c926
+Create Date: 2026-10-19 14:22:08.471000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6c8a4b2d137'
+down_revision = 'd5b7f3a8c926'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('sql_stacks', sa.Column('used_at', sa.Float(), nullable=True))
+    # the stacks there already get a full grace period from now
+    op.execute('UPDATE sql_stacks SET used_at = extract(epoch FROM now())')
+
+
+def downgrade():
+    op.drop_column('sql_stacks', 'used_at')
@@ -1,45 +1,44 @@
-import pstats
-import os
-import json
+import pstats_store
 
 
 def load(uuid):
-    stats = pstats.Stats(os.path.join('pstats',uuid))
+    '''The sorted pstats.Stats of a stored profile, None if it isn't stored'''
+    stats = pstats_store.load_stats(uuid)
+    if stats is None:
+        return None
     stats.calc_callees()
     stats.sort_stats('cumulative')
     return stats
 
-def keys_to_str(dictionary):
-    for key in dictionary.keys():
-        str_key = to_str(key)
-        dictionary[str_key] = dictionary.pop(key)
-        if type(dictionary[str_key]) == dict:
-            keys_to_str(dictionary[str_key])
-        elif len(dictionary[str_key])>4:
-            keys_to_str(dictionary[str_key][4])
-    return dictionary
-
-def to_str(tup):
-    if tup[0]=='~' and tup[1]==0:
-        return tup[2]
-    else:
-        return '{0}::{1}::{2}'.format(tup[0],tup[1],tup[2])
-
-
-def write_json(dictionary, uuid):
-    with open(os.path.join('pstats',uuid+'.json'),'w') as f:
-        f.write(json.dumps(dictionary))
-
-
-
-if __name__ == '__main__':
-
-    for f in os.listdir('pstats'):
-        if '.' in f:
-            continue
-        stats = load(f)
-        callees = keys_to_str(stats.all_callees)
-        total_tt = stats.total_tt
-        stats = keys_to_str(stats.stats)
-        write_json({'stats':stats,'callees':callees,'total_tt':total_tt}, f)
-        exit(0)
+def call_graph(stats):
+    '''
+    The call graph of a sorted pstats.Stats object in compact form. Each
+    function is listed once in functions as [file, line, name], most
+    cumulative time first, and everything else refers to it by its index:
+    stats[i] is [cc, nc, tt, ct, [caller indexes]] of function i,
+    callees[i] is [[callee index, cc, nc, tt, ct]] of the calls it makes and
+    roots are the functions nothing else calls.
+    '''
+    functions = list(stats.fcn_list or stats.stats.keys())
+    index = dict((function, i) for i, function in enumerate(functions))
+    graph_stats = []
+    callees = []
+    roots = []
+    for i, function in enumerate(functions):
+        cc, nc, tt, ct, callers = stats.stats[function]
+        graph_stats.append([cc, nc, tt, ct, sorted(index[caller] for caller in callers)])
+        callees.append([[index[callee]] + call_stats(value)
+                        for callee, value in stats.all_callees.get(function, {}).iteritems()])
+        if not callers or function in callers:
+            roots.append(i)
+    return {'functions': [[function[0], function[1], function[2]] for function in functions],
+            'stats': graph_stats,
+            'callees': callees,
+            'roots': roots,
+            'total_tt': stats.total_tt}
+
+def call_stats(value):
+    # profiles from older pythons only count the calls
+    if isinstance(value, tuple):
+        return list(value)
+    return [value, value, 0.0, 0.0]
@@ -0,0 +1,69 @@
+'''
+Collects the fact rows of one or more packets so that each table is
+written with a single executemany, rather than one INSERT per ORM object,
+along with the profiles the fact rows refer to.
+'''
+from collections import OrderedDict
+from sqlalchemy import text
+import partitions
+import pstats_store
+
+
+class FactBatch(object):
+
+    def __init__(self):
+        self.facts = OrderedDict()
+        # profile key -> data, stored in the transaction writing the facts
+        self.blobs = {}
+        self.packets = 1
+        # packet log positions of the packets in the batch
+        self.positions = []
+
+    def add_fact(self, table, row):
+        '''Queue a fact row, its id is filled in when the batch is written'''
+        self.facts.setdefault(table, []).append(row)
+        return row
+
+    def add_blob(self, data):
+        '''Queue profile data to be stored, returning the key it is stored under'''
+        key = pstats_store.blob_key(data)
+        self.blobs[key] = data
+        return key
+
+    def extend(self, other):
+        for table, rows in other.facts.iteritems():
+            self.facts.setdefault(table, []).extend(rows)
+        self.blobs.update(other.blobs)
+        self.packets += other.packets
+        self.positions.extend(other.positions)
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.facts.values())
+
+    def write(self, connection):
+        for table, rows in self.facts.iteritems():
+            ids = allocate_ids(connection, table, len(rows))
+            if ids is None:
+                # no sequence to draw from, let the database number them
+                for row in rows:
+                    row.pop('id', None)
+                    row['id'] = connection.execute(table.insert(), row).inserted_primary_key[0]
+            else:
+                for row, _id in zip(rows, ids):
+                    row['id'] = _id
+                for partition, partition_rows in partitions.route(table, rows):
+                    connection.execute(partition.insert(), partition_rows)
+
+
+def allocate_ids(connection, table, count):
+    '''
+    Reserve count ids from the table's serial sequence so fact rows can be
+    inserted in bulk, straight into their partitions, with their ids known.
+    Returns None if the database has no sequences.
+    '''
+    if connection.dialect.name != 'postgresql':
+        return None
+    result = connection.execute(text('SELECT nextval(:sequence) FROM generate_series(1, :count)'),
+                                sequence='{0}_id_seq'.format(table.name),
+                                count=count)
+    return [row[0] for row in result]
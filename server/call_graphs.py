@@ -0,0 +1,99 @@
+'''
+Call graphs of stored profiles, as the call stack page draws them. A
+background stage builds the graph of each profile once its call stack is
+committed and stores it, gzipped, beside the profile, so opening a call
+stack serves the stored bytes instead of analysing the profile. Profiles
+are keyed by their content, so a graph never changes once built and its
+key makes a strong ETag.
+'''
+import gzip
+import json
+import cherrypy
+from cStringIO import StringIO
+from threading import Thread
+from Queue import Queue, Full
+import database as db
+import pstats_store
+import analyse_stats
+
+# profile keys waiting for their graph to be built
+build_queue = Queue(10000)
+
+worker_threads = []
+
+
+def setup(worker_count, queue_size):
+    '''Start the threads building the graphs of newly ingested profiles'''
+    global build_queue
+    build_queue = Queue(queue_size)
+    for i in xrange(worker_count):
+        worker_thread = Thread(target=worker, name='call-graph-worker-{0}'.format(i))
+        worker_thread.daemon = True
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+
+
+def graph_key(key):
+    return key + '.graph'
+
+
+def etag(key, gzipped=True):
+    '''The ETag of the graph of a profile, each encoding being its own entity'''
+    return '"{0}{1}"'.format(graph_key(key), '' if gzipped else '.identity')
+
+
+def enqueue(keys):
+    '''Queue the graphs of committed profiles to be built'''
+    if not worker_threads:
+        return
+    for key in keys:
+        try:
+            build_queue.put_nowait(key)
+        except Full:
+            # built when somebody first looks at it instead
+            return
+
+
+def worker():
+    while True:
+        key = build_queue.get()
+        try:
+            build(key)
+        except Exception:
+            cherrypy.log('Unable to build the call graph of profile {0}'.format(key), traceback=True)
+        finally:
+            db.session.remove()
+            build_queue.task_done()
+
+
+def available(key):
+    '''Whether the graph of a profile is stored or can be built'''
+    return pstats_store.store.exists(graph_key(key)) or pstats_store.store.exists(key)
+
+
+def build(key):
+    '''
+    Build and store the gzipped graph of a profile, returning it. None if
+    the profile isn't stored, it may have been purged.
+    '''
+    data = pstats_store.store.get(graph_key(key))
+    if data is not None:
+        return data
+    stats = analyse_stats.load(key)
+    if stats is None:
+        return None
+    data = compress(json.dumps(analyse_stats.call_graph(stats), separators=(',', ':')))
+    pstats_store.store.put(data, graph_key(key), graph_of=key)
+    return data
+
+
+def compress(data):
+    buf = StringIO()
+    # no timestamp, the same graph always compresses to the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
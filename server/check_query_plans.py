@@ -0,0 +1,213 @@
+'''
+Checks that the aggregate and filter queries only read the partitions of
+the fact tables inside the period they ask for, and use the indexes meant
+for them rather than sequential scans of large fact and association tables,
+and that name searches use the trigram indexes. A partition lying wholly
+inside the period is read in full anyway, so it may be scanned, as may any
+table of fewer than --min-rows rows. Run against a database of realistic
+size, --seed fills the configured database with that much synthetic data
+first.
+
+    python check_query_plans.py [--seed PACKETS] [--min-rows ROWS]
+
+Exits with status 1 if any query reads a partition or scans a table it
+shouldn't, or if a fact table is empty and its plans would prove nothing.
+'''
+import sys
+import json
+import time
+import random
+import cPickle
+from optparse import OptionParser
+import stats_server
+import database as db
+import dimensions
+import partitions
+import pstats_store
+import stat_handlers
+import aggregate_json_ui as aggregate
+import rollups
+from sqlalchemy import or_, select, text
+
+
+# tables which must never be read with a sequential scan
+indexed_tables = ('call_stacks', 'sql_statements', 'file_accesses', 'metadata_set_items', 'rollups')
+
+# name tables, which mustn't be scanned to search them
+search_tables = ('call_stack_names', 'sql_strings', 'file_names')
+
+# tables with fewer rows than this may be scanned, the planner rightly prefers it
+min_rows = 100000
+
+
+def synthetic_profile(duration):
+    '''A pickled profile of a single function taking duration seconds'''
+    return cPickle.dumps({('module.py', 1, 'function'): (1, 1, duration, duration, {})})
+
+
+def seed(packets):
+    '''Ingest synthetic function, sql and file packets spread over the last week'''
+    now = time.time()
+    for i in xrange(packets):
+        metadata = {'hostname': 'host{0}'.format(i % 50), 'product': 'product{0}'.format(i % 5)}
+        fn_stats = [{'profile': synthetic_profile(round(random.expovariate(10), 3)),
+                     'module': 'module{0}'.format(random.randint(0, 99)), 'class': 'Class',
+                     'function': 'function{0}'.format(random.randint(0, 9)),
+                     'datetime': now - random.random() * 7 * 24 * 60 * 60}
+                    for j in xrange(20)]
+        sql_stats = [{'sql_string': 'SELECT * FROM table{0} WHERE id = %(id)s'.format(random.randint(0, 999)),
+                      'args': {'id': str(j)}, 'duration': random.expovariate(10),
+                      'datetime': now - random.random() * 7 * 24 * 60 * 60,
+                      'stack': [{'module': 'module{0}'.format(j), 'function': 'function'}]}
+                     for j in xrange(20)]
+        file_stats = [{'filename': '/data/file{0}'.format(random.randint(0, 999)), 'time_to_open': 0.001,
+                       'duration': random.expovariate(10), 'data_written': 100, 'mode': 'w',
+                       'datetime': now - random.random() * 7 * 24 * 60 * 60}
+                      for j in xrange(20)]
+        stat_handlers.ingest([[stat_handlers.parse_fn_packet, {'metadata': metadata, 'stats': fn_stats}, None, 0],
+                              [stat_handlers.parse_sql_packet, {'metadata': metadata, 'stats': sql_stats}, None, 0],
+                              [stat_handlers.parse_file_packet, {'metadata': metadata, 'stats': file_stats}, None, 0]])
+        db.session.remove()
+
+
+def queries():
+    '''
+    (description, query, tables it mustn't scan, (start, end) of the period
+    it asks for or None) of the queries the aggregate pages run
+    '''
+    now = int(time.time())
+    day_ago = now - 24 * 60 * 60
+    for table_class in (db.CallStack, db.SQLStatement, db.FileAccess):
+        name = table_class.__tablename__
+        metadata_table = aggregate.metadata_table_dict[table_class][0]
+        name_id = db.session.query(metadata_table.id).first()
+        name_id = name_id[0] if name_id else 0
+
+        yield ('{0} aggregate, metadata filter'.format(name),
+               aggregate.aggregate_query(table_class, {'key_1': 'hostname', 'value_1': 'host1',
+                                                       'start_date': day_ago, 'end_date': now}),
+               indexed_tables, (day_ago, now))
+        yield ('{0} aggregate, from rollups'.format(name),
+               aggregate.aggregate_query(table_class, {'start_date': day_ago, 'end_date': now}),
+               indexed_tables, (day_ago, now))
+        # the queries of the time series of an item, over the rollups and,
+        # with a metadata filter, over the facts
+        width = aggregate.series_width(day_ago, now)
+        for description, filter_kwargs in (('', {}), (', metadata filter', {'key_1': 'hostname', 'value_1': 'host1'})):
+            filter_kwargs.update(start_date=day_ago, end_date=now)
+            query, from_rollups = aggregate.series_query(table_class, filter_kwargs, name_id, day_ago, now, width)
+            yield ('{0} item time series{1}'.format(name, description), query, indexed_tables, (day_ago, now))
+            # as if the item had plenty of calls in each of its buckets
+            counts = dict((bucket, 100) for bucket in xrange(day_ago // width * width, now, width))
+            yield ('{0} item sample{1}'.format(name, description),
+                   aggregate.sample_query(table_class, filter_kwargs, name_id, counts, width),
+                   indexed_tables, (day_ago, now))
+        yield ('{0} name search'.format(name),
+               db.session.query(metadata_table.id)
+                         .filter(or_(*[column.ilike(aggregate.contains_pattern('able12'), escape='\\')
+                                       for column in aggregate.searchable_columns_dict[table_class]])),
+               search_tables, None)
+
+
+def empty_fact_tables():
+    '''The fact tables without a row, whose plans say nothing about a real database'''
+    return [table.name for table in rollups.fact_tables
+            if db.session.execute(select([table.c.id]).limit(1)).first() is None]
+
+
+def relation_scans(plan):
+    '''(relation, node type) of each table a plan reads'''
+    scans = []
+    if 'Relation Name' in plan:
+        scans.append((plan['Relation Name'], plan['Node Type']))
+    for child in plan.get('Plans', []):
+        scans.extend(relation_scans(child))
+    return scans
+
+
+def partition_range(relation):
+    '''The (start, end) datetimes of a fact table partition, None for other tables'''
+    if not partitions.enabled:
+        return None
+    for table in partitions.tables:
+        for start, child in partitions.partitions[table].items():
+            if child.name == relation:
+                return start, child.end
+    return None
+
+
+def row_counts(connection, relations):
+    '''The planner's estimate of the rows of each table'''
+    if not relations:
+        return {}
+    return dict(connection.execute(text('SELECT relname, reltuples FROM pg_class WHERE relname IN :relations'),
+                                   relations=tuple(relations)).fetchall())
+
+
+def check():
+    connection = db.session.connection()
+    failures = 0
+    # the parents of partitioned tables are empty, scanning them costs nothing
+    parents = [table.name for table in partitions.tables] if partitions.enabled else []
+    for description, query, tables, period in queries():
+        statement = getattr(query, 'statement', query).compile(dialect=connection.dialect)
+        plan = connection.execute('EXPLAIN (FORMAT JSON) ' + unicode(statement), statement.params).scalar()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        scans = relation_scans(plan[0]['Plan'])
+        rows = row_counts(connection, set(relation for relation, node_type in scans))
+
+        problems = []
+        if period is not None:
+            outside = sorted(set(relation for relation, node_type in scans
+                                 if partition_range(relation) is not None
+                                 and not (partition_range(relation)[0] < period[1]
+                                          and partition_range(relation)[1] > period[0])))
+            if outside:
+                problems.append('partitions outside the period read: {0}'.format(', '.join(outside)))
+
+        sequential = set()
+        for relation, node_type in scans:
+            if node_type != 'Seq Scan' or not relation.startswith(tables) or relation in parents:
+                continue
+            partition = partition_range(relation)
+            if period is not None and partition is not None and period[0] <= partition[0] and partition[1] <= period[1]:
+                continue
+            if rows.get(relation, 0) < min_rows:
+                continue
+            sequential.add(relation)
+        if sequential:
+            problems.append('sequential scan of {0}'.format(', '.join(sorted(sequential))))
+
+        if problems:
+            failures += 1
+            print 'FAIL {0}: {1}'.format(description, '; '.join(problems))
+        else:
+            print 'ok   {0}'.format(description)
+    return failures
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--seed', type='int', default=0, help='Packets of synthetic data to ingest first')
+    parser.add_option('--min-rows', type='int', default=min_rows,
+                      help='Rows a table must have for a sequential scan of it to fail')
+    options, args = parser.parse_args()
+    min_rows = options.min_rows
+
+    cfg = stats_server.load_config()
+    db.setup(cfg['database_username'], cfg['database_password'])
+    dimensions.setup(int(cfg.get('dimension_cache_size', 100000)), int(cfg.get('dimension_grace_period', 3600)))
+    pstats_store.setup(cfg.get('pstats_dir', 'pstats'), int(cfg.get('pstats_segment_size', 268435456)),
+                       int(cfg.get('pstats_grace_period', 3600)))
+    partitions.setup(int(cfg.get('partition_days', 1)), int(cfg.get('partitions_ahead', 7)))
+    if options.seed:
+        seed(options.seed)
+    # ingest only logs what it fails to write, so make sure something was
+    empty = empty_fact_tables()
+    if empty:
+        print 'FAIL no rows in {0}, seed the database first'.format(', '.join(empty))
+        sys.exit(1)
+    # make sure the planner knows how big the tables are
+    db.session.connection().execute('ANALYZE')
+    sys.exit(1 if check() else 0)
@@ -1,18 +1,20 @@
 import sqlalchemy
-from sqlalchemy import Table, Column, Integer, String, Float, ForeignKey, UniqueConstraint
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, composite
+from sqlalchemy import Table, Column, Integer, BigInteger, String, Float, ForeignKey, UniqueConstraint, Index, DDL, event
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, composite, object_session
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 from threading import Thread
 from sqlparse import tokens as sql_tokens, parse as parse_sql
 import os
+import json
 from collections import defaultdict
-from operator import attrgetter
-import pstats
 from alembic.config import Config
 from alembic import command as al_command
 
 
 session = None
+engine = None
 
 def setup(user, password, host='localhost', reset_db=False):
     postgres_string = u'postgresql://{0}:{1}@{2}'.format(user, password, host)
@@ -46,7 +48,8 @@ def setup(user, password, host='localhost', reset_db=False):
         # Stamp table with current version for Alembic upgrades
         al_command.stamp(alembic_cfg, "head")
 
-    global session
+    global session, engine
+    engine = db
     session = scoped_session(sessionmaker(bind=db))
 
 
@@ -55,11 +58,55 @@ def setup(user, password, host='localhost', reset_db=False):
 
 Base = declarative_base()
 
+# the trigram operator classes the search indexes use
+event.listen(Base.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+def trigram_index(name, column):
+    '''A Postgres trigram index on a column, for substring searches with ilike'''
+    return Index(name, column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
+
+class Array(TypeDecorator):
+    '''
+    An array of item_type, a Postgres array or a JSON list in databases
+    without arrays.
+    '''
+    impl = String
+
+    def __init__(self, item_type):
+        TypeDecorator.__init__(self)
+        self.item_type = item_type
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(self.item_type))
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return json.dumps(value, separators=(',', ':'))
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return json.loads(value)
+
+
+def metadata_dict(pairs):
+    '''The metadata of a fact as a dict from its (key, value) pairs'''
+    list_dict = defaultdict(list)
+    for key, value in pairs:
+        list_dict[key].append(value)
+    # if list only one item, set to that one item
+    list_dict = dict(list_dict)
+    for k,v in list_dict.items():
+        if len(v)==1:
+            list_dict[k] = v[0]
+    return list_dict
 
-call_stack_metadata_association_table = Table('call_stack_metadata_association', Base.metadata,
-    Column('call_stack_id', Integer, ForeignKey('call_stacks.id'), primary_key=True),
-    Column('metadata_id', Integer, ForeignKey('metadata_items.id'), primary_key=True)
-)
 
 class CallStack(Base):
     __tablename__ = 'call_stacks'
@@ -68,9 +115,15 @@ class CallStack(Base):
     datetime = Column(Float)
     duration = Column(Float)
     pstat_uuid = Column(String)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'))
+
+    __table_args__ = (Index('ix_call_stacks_name_datetime', 'call_stack_name_id', 'datetime'),
+                      Index('ix_call_stacks_datetime', 'datetime'),
+                      Index('ix_call_stacks_metadata_set_datetime', 'metadata_set_id', 'datetime'),
+                      Index('ix_call_stacks_pstat_uuid', 'pstat_uuid'))
 
     name = relationship('CallStackName', cascade='all', backref='call_stacks')
-    metadata_items = relationship('MetaData', secondary=call_stack_metadata_association_table, cascade='all', backref='call_stacks')
+    metadata_set = relationship('MetaDataSet')
 
     def __init__(self, profile):
         self.datetime = profile['datetime']
@@ -88,18 +141,13 @@ class CallStack(Base):
         return dict(response.items() + self._metadata().items())
 
     def _stats(self):
-        return pstats.Stats(os.path.join(os.getcwd(),'pstats',self.pstat_uuid))
+        # imported here, the profile store imports this module
+        import pstats_store
+        return pstats_store.load_stats(self.pstat_uuid)
 
     def _metadata(self):
-        list_dict = defaultdict(list)
-        for key, value in [meta._to_tuple() for meta in self.metadata_items]:
-            list_dict[key].append(value)
-        # if list only one item, set to that one item
-        list_dict = dict(list_dict)
-        for k,v in list_dict.items():
-            if len(v)==1:
-                list_dict[k] = v[0]
-        return list_dict
+        metadata_items = self.metadata_set.metadata_items if self.metadata_set else []
+        return metadata_dict([meta._to_tuple() for meta in metadata_items])
 
     def __repr__(self):
         return 'Callstack({0}, {1!s})'.format(self.name.full_name,int(self.datetime))
@@ -122,13 +170,16 @@ class CallStackFullName(object):
 class CallStackName(Base):
     __tablename__ = 'call_stack_names'
     id = Column(Integer, primary_key=True)
-    module_name = Column(String)
-    class_name = Column(String)
-    fn_name = Column(String)
+    module_name = Column(String, nullable=False)
+    class_name = Column(String, nullable=False)
+    fn_name = Column(String, nullable=False)
 
     full_name = composite(CallStackFullName, module_name, class_name, fn_name)
 
-    __table_args__ = (UniqueConstraint('module_name', 'class_name', 'fn_name', name='_call_stack_name_uc'),)
+    __table_args__ = (UniqueConstraint('module_name', 'class_name', 'fn_name', name='_call_stack_name_uc'),
+                      trigram_index('ix_call_stack_names_module_name_trgm', 'module_name'),
+                      trigram_index('ix_call_stack_names_class_name_trgm', 'class_name'),
+                      trigram_index('ix_call_stack_names_fn_name_trgm', 'fn_name'))
 
     def __init__(self, module_name, class_name, fn_name):
         self.module_name = module_name
@@ -137,22 +188,25 @@ class CallStackName(Base):
 
 #========================================#
 
-sql_statement_metadata_association_table = Table('sql_statement_metadata_association', Base.metadata,
-    Column('sql_statement_id', Integer, ForeignKey('sql_statements.id'), primary_key=True),
-    Column('metadata_id', Integer, ForeignKey('metadata_items.id'), primary_key=True)
-)
-
 class SQLStatement(Base):
     __tablename__ = 'sql_statements'
     id = Column(Integer, primary_key=True)
     sql_string_id = Column(Integer, ForeignKey('sql_strings.id'))
     datetime = Column(Float)
     duration = Column(Float)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'))
+    sql_stack_id = Column(Integer, ForeignKey('sql_stacks.id'))
+    # the bind arguments captured, keys and values alternating
+    args = Column(Array(String))
+
+    __table_args__ = (Index('ix_sql_statements_string_datetime', 'sql_string_id', 'datetime'),
+                      Index('ix_sql_statements_datetime', 'datetime'),
+                      Index('ix_sql_statements_metadata_set_datetime', 'metadata_set_id', 'datetime'),
+                      Index('ix_sql_statements_stack_datetime', 'sql_stack_id', 'datetime'))
 
     sql_string = relationship('SQLString', cascade='all', backref='sql_statements')
-    sql_stack_items = relationship('SQLStackAssociation', cascade='all', backref='sql_statements')
-    arguments = relationship('SQLArgAssociation', cascade='all', backref='sql_statements')
-    metadata_items = relationship('MetaData', secondary=sql_statement_metadata_association_table, cascade='all', backref='sql_statements')
+    sql_stack = relationship('SQLStack')
+    metadata_set = relationship('MetaDataSet')
 
     def __init__(self, profile):
         self.datetime = profile['datetime']
@@ -168,23 +222,17 @@ class SQLStatement(Base):
         return dict(response.items() + self._metadata().items())
 
     def _metadata(self):
-        list_dict = defaultdict(list)
-        for key, value in [meta._to_tuple() for meta in self.metadata_items]:
-            list_dict[key].append(value)
-        # if list only one item, set to that one item
-        list_dict = dict(list_dict)
-        for k,v in list_dict.items():
-            if len(v)==1:
-                list_dict[k] = v[0]
-        return list_dict
+        metadata_items = self.metadata_set.metadata_items if self.metadata_set else []
+        return metadata_dict([meta._to_tuple() for meta in metadata_items])
 
     def _stack(self):
-        self.sql_stack_items.sort(key=attrgetter('index'))
-        return [stack_item.stack_item.to_dict() for stack_item in self.sql_stack_items]
+        if self.sql_stack is None:
+            return []
+        return self.sql_stack.to_list()
 
     def _args(self):
-        self.arguments.sort(key=attrgetter('index'))
-        return [(arg.arg.key, arg.arg.value) for arg in self.arguments]
+        args = self.args or []
+        return zip(args[::2], args[1::2])
 
     def __repr__(self):
         sql = self._metadata()['sql_string']
@@ -198,6 +246,8 @@ class SQLString(Base):
     id = Column(Integer, primary_key=True)
     sql = Column(String, unique=True)
 
+    __table_args__ = (trigram_index('ix_sql_strings_sql_trgm', 'sql'),)
+
     def __init__(self, sql):
         if type(sql)==dict:
             self.sql = sql['sql']
@@ -209,20 +259,33 @@ class SQLString(Base):
         return 'SQLString({0})'.format(truncated_sql)
 
 
-class SQLStackAssociation(Base):
-    __tablename__ = 'sql_stack_association'
-    sql_statement_id = Column(Integer, ForeignKey('sql_statements.id'), primary_key=True)
-    sql_stack_item_id = Column(Integer, ForeignKey('sql_stack_items.id'), primary_key=True)
-    index = Column(Integer, primary_key=True)
+class SQLStack(Base):
+    '''
+    A distinct stack SQL statements were executed from, the ids of its
+    SQLStackItems in the order they were sent. The key is the md5 of
+    the list of ids. used_at is when an ingest worker last handed the
+    stack out, unreferenced stacks are only purged once it is long past.
+    '''
+    __tablename__ = 'sql_stacks'
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+    frames = Column(Array(Integer))
+    used_at = Column(Float)
+
+    def to_list(self):
+        items = object_session(self).query(SQLStackItem).filter(SQLStackItem.id.in_(self.frames))
+        items = dict((item.id, item) for item in items)
+        return [items[_id].to_dict() for _id in self.frames]
 
-    stack_item = relationship("SQLStackItem", cascade='all', backref="sql_association")
+    def __repr__(self):
+        return 'SQLStack({0})'.format(self.id)
 
 
 class SQLStackItem(Base):
     __tablename__ = 'sql_stack_items'
     id = Column(Integer, primary_key=True)
-    module = Column(String)
-    function = Column(String)
+    module = Column(String, nullable=False)
+    function = Column(String, nullable=False)
 
     __table_args__ = (UniqueConstraint('module', 'function', name='_sql_stack_item_uc'),)
 
@@ -231,42 +294,16 @@ class SQLStackItem(Base):
         self.module = module
 
     def to_dict(self):
-        return {'module':self.module,
+        return {'id':self.id,
+                'module':self.module,
                 'function':self.function}
 
     def __repr__(self):
         return 'SQLStackItem({0})'.format(self.id)
 
 
-class SQLArgAssociation(Base):
-    __tablename__ = 'sql_arguments_association'
-    sql_statement_id = Column(Integer, ForeignKey('sql_statements.id'), primary_key=True)
-    sql_argument_id = Column(Integer, ForeignKey('sql_arguments.id'), primary_key=True)
-    index = Column(Integer, primary_key=True)
-
-    arg = relationship("SQLArg", cascade='all', backref="sql_association")
-
-
-class SQLArg(Base):
-    __tablename__ = 'sql_arguments'
-    id = Column(Integer, primary_key=True)
-    key = Column(String)
-    value = Column(String)
-
-    def __init__(self, key, value):
-        self.key = key
-        self.value = value
-
-    def __repr__(self):
-        return 'SQLArg({0})'.format(self.id)
-
 #========================================#
 
-file_access_metadata_association_table = Table('file_access_metadata_association', Base.metadata,
-    Column('file_access_id', Integer, ForeignKey('file_accesses.id'), primary_key=True),
-    Column('metadata_id', Integer, ForeignKey('metadata_items.id'), primary_key=True)
-)
-
 class FileAccess(Base):
     __tablename__ = 'file_accesses'
     id = Column(Integer, primary_key=True)
@@ -276,9 +313,14 @@ class FileAccess(Base):
     duration = Column(Float)
     data_written = Column(Integer)
     mode = Column(String)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'))
+
+    __table_args__ = (Index('ix_file_accesses_name_datetime', 'file_name_id', 'datetime'),
+                      Index('ix_file_accesses_datetime', 'datetime'),
+                      Index('ix_file_accesses_metadata_set_datetime', 'metadata_set_id', 'datetime'))
 
     filename = relationship('FileName', cascade='all', backref='file_accesses')
-    metadata_items = relationship('MetaData', secondary=file_access_metadata_association_table, cascade='all', backref='file_accesses')
+    metadata_set = relationship('MetaDataSet')
 
     def __init__(self, profile):
         self.datetime = profile['datetime']
@@ -298,15 +340,8 @@ class FileAccess(Base):
         return dict(response.items() + self._metadata().items())
 
     def _metadata(self):
-        list_dict = defaultdict(list)
-        for key, value in [meta._to_tuple() for meta in self.metadata_items]:
-            list_dict[key].append(value)
-        # if list only one item, set to that one item
-        list_dict = dict(list_dict)
-        for k,v in list_dict.items():
-            if len(v)==1:
-                list_dict[k] = v[0]
-        return list_dict
+        metadata_items = self.metadata_set.metadata_items if self.metadata_set else []
+        return metadata_dict([meta._to_tuple() for meta in metadata_items])
 
     def __repr__(self):
         return 'FileAccess({0}, {1!s})'.format(self._metadata()['filename'],int(self.datetime))
@@ -317,6 +352,8 @@ class FileName(Base):
     id = Column(Integer, primary_key=True)
     filename = Column(String, unique=True)
 
+    __table_args__ = (trigram_index('ix_file_names_filename_trgm', 'filename'),)
+
     def __init__(self, filename):
         if type(filename)==dict:
             self.filename = filename['filename']
@@ -328,8 +365,8 @@ class FileName(Base):
 class MetaData(Base):
     __tablename__ = 'metadata_items'
     id = Column(Integer, primary_key=True)
-    key = Column(String)
-    value = Column(String)
+    key = Column(String, nullable=False)
+    value = Column(String, nullable=False)
 
     __table_args__ = (UniqueConstraint('key', 'value', name='_metadata_item_uc'),)
 
@@ -343,3 +380,87 @@ class MetaData(Base):
     def __repr__(self):
         return 'MetaData({0}={1})'.format(self.key,self.value)
 
+
+metadata_set_items = Table('metadata_set_items', Base.metadata,
+    Column('metadata_set_id', Integer, ForeignKey('metadata_sets.id'), primary_key=True),
+    Column('metadata_id', Integer, ForeignKey('metadata_items.id'), primary_key=True),
+    Index('ix_metadata_set_items_metadata', 'metadata_id', 'metadata_set_id')
+)
+
+class MetaDataSet(Base):
+    '''
+    A distinct combination of metadata items. Facts point at the set of
+    all their metadata rather than having a row per item. The key is the
+    md5 of the set's sorted metadata ids.
+    '''
+    __tablename__ = 'metadata_sets'
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+
+    metadata_items = relationship('MetaData', secondary=metadata_set_items)
+
+    def __repr__(self):
+        return 'MetaDataSet({0})'.format(self.id)
+
+
+#========================================#
+
+class PStatBlob(Base):
+    '''
+    Where a stored profile (or the call graph of one) is in the segment
+    files. A profile's graph_key is the key of its call graph, if built.
+    '''
+    __tablename__ = 'pstat_blobs'
+    key = Column(String, primary_key=True)
+    segment = Column(Integer)
+    start = Column(BigInteger)
+    length = Column(Integer)
+    created_at = Column(Float)
+    graph_key = Column(String)
+
+    __table_args__ = (Index('ix_pstat_blobs_graph_key', 'graph_key'),)
+
+    def __repr__(self):
+        return 'PStatBlob({0})'.format(self.key)
+
+#========================================#
+
+class Rollup(Base):
+    '''
+    Count, total, min, max and latency histogram of the facts of one name
+    (call stack name, sql string or file name) within one time bucket.
+    '''
+    __tablename__ = 'rollups'
+    fact_type = Column(String, primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    name_id = Column(Integer, primary_key=True)
+    count = Column(Integer)
+    total = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    histogram = Column(String)
+
+    __table_args__ = (Index('ix_rollups_name', 'fact_type', 'name_id', 'resolution', 'bucket'),)
+
+    def __repr__(self):
+        return 'Rollup({0}, {1}, {2}, {3})'.format(self.fact_type, self.name_id, self.resolution, self.bucket)
+
+#========================================#
+
+class MergedProfile(Base):
+    '''
+    The profiles of the call stacks of one name within one hour or day bucket
+    added together, stored in the profile store under pstat_key.
+    '''
+    __tablename__ = 'merged_profiles'
+    call_stack_name_id = Column(Integer, ForeignKey('call_stack_names.id'), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    profile_count = Column(Integer)
+    pstat_key = Column(String)
+
+    __table_args__ = (Index('ix_merged_profiles_pstat_key', 'pstat_key'),)
+
+    def __repr__(self):
+        return 'MergedProfile({0}, {1}, {2})'.format(self.call_stack_name_id, self.resolution, self.bucket)
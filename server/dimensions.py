@@ -0,0 +1,292 @@
+'''
+Process wide caches mapping the natural key of each dimension row (metadata
+items, stack items, sql strings, call stack names, file names, metadata sets
+and sql stacks) to its id, so incoming packets can be ingested without a
+query per row.
+'''
+import time
+import hashlib
+import database as db
+from lru_cache import LRUCache
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+
+natural_keys = {db.MetaData:      ('key', 'value'),
+                db.SQLStackItem:  ('module', 'function'),
+                db.SQLString:     ('sql',),
+                db.CallStackName: ('module_name', 'class_name', 'fn_name'),
+                db.FileName:      ('filename',),
+                db.MetaDataSet:   ('key',),
+                db.SQLStack:      ('key',)}
+
+# Maximum number of keys sent in a single IN (...) lookup or multi-row insert
+chunk_size = 500
+
+# Number of times to retry creating rows which lost a race with another worker
+insert_attempts = 3
+
+caches = dict((model, LRUCache(100000)) for model in natural_keys)
+
+# Seconds a sql stack handed out to an ingest worker is safe from the
+# retention thread purging it, longer than any ingest transaction
+grace = 60 * 60
+# sql stack id -> when its used_at was last set
+stacks_used = LRUCache(100000)
+
+
+def setup(cache_size, grace_period=60 * 60):
+    '''
+    Size the caches and warm them with the most recently created rows
+    of each dimension table.
+    '''
+    global grace, stacks_used
+    grace = grace_period
+    stacks_used = LRUCache(cache_size)
+    for model, columns in natural_keys.items():
+        cache = caches[model] = LRUCache(cache_size)
+        key_columns = [getattr(model, column) for column in columns]
+        rows = db.session.query(model.id, *key_columns)\
+                         .order_by(model.id.desc())\
+                         .limit(cache_size).all()
+        # oldest first so the newest rows end up most recently used
+        for row in reversed(rows):
+            cache.put(tuple(row[1:]), row[0])
+    db.session.remove()
+
+
+def normalise(value):
+    '''
+    Coerce a value to the unicode form the database hands back. None is
+    stored as '', unique constraints never match NULLs so racing workers
+    could otherwise both create the same row.
+    '''
+    if value is None:
+        return u''
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def resolve(model, keys):
+    '''
+    Return the ids of the given natural keys (tuples in the order of
+    natural_keys[model]), creating any rows which do not exist yet.
+    '''
+    cache = caches[model]
+    keys = [tuple(normalise(value) for value in key) for key in keys]
+    ids = {}
+    misses = set()
+    for key in keys:
+        _id = cache.get(key)
+        if _id is None:
+            misses.add(key)
+        else:
+            ids[key] = _id
+
+    if misses:
+        found = fetch_or_create(model, misses)
+        for key, _id in found.iteritems():
+            cache.put(key, _id)
+        ids.update(found)
+
+    return [ids[key] for key in keys]
+
+
+def resolve_one(model, *key):
+    return resolve(model, [key])[0]
+
+
+def fetch_or_create(model, keys, values=None):
+    '''
+    Fetch the ids of the given keys, inserting the rows which are missing.
+    Another worker may insert the same keys concurrently, in which case the
+    unique constraint fails our insert and we go round again, picking up
+    the rows the other worker committed. values optionally maps each key
+    to the other columns of its row.
+    '''
+    for attempt in xrange(insert_attempts):
+        try:
+            # Use a connection of our own so created rows are committed
+            # straight away, the cache must never point at rolled back rows.
+            with db.engine.begin() as connection:
+                found = fetch(connection, model, keys)
+                missing = keys.difference(found)
+                if missing:
+                    insert(connection, model, missing, values)
+                    found.update(fetch(connection, model, missing))
+            return found
+        except IntegrityError:
+            if attempt == insert_attempts - 1:
+                raise
+
+
+def metadata_set_key(metadata_ids):
+    '''The key of the set of the given metadata ids, the md5 of their sorted list'''
+    return hashlib.md5(','.join(str(_id) for _id in sorted(set(metadata_ids)))).hexdigest()
+
+
+def resolve_metadata_sets(metadata_id_sets):
+    '''
+    Return the ids of the metadata sets holding each of the given
+    collections of metadata ids, creating any sets which do not exist yet.
+    An empty collection has no set, its id is None.
+    '''
+    cache = caches[db.MetaDataSet]
+    keys = [(metadata_set_key(metadata_ids),) if metadata_ids else None for metadata_ids in metadata_id_sets]
+    ids = {None: None}
+    misses = {}
+    for key, metadata_ids in zip(keys, metadata_id_sets):
+        if key in ids or key in misses:
+            continue
+        _id = cache.get(key)
+        if _id is None:
+            misses[key] = set(metadata_ids)
+        else:
+            ids[key] = _id
+
+    if misses:
+        found = fetch_or_create_metadata_sets(misses)
+        for key, _id in found.iteritems():
+            cache.put(key, _id)
+        ids.update(found)
+
+    return [ids[key] for key in keys]
+
+
+def fetch_or_create_metadata_sets(members):
+    '''
+    fetch_or_create for metadata sets, members maps the key of each set to
+    its metadata ids. The items of a set are inserted in the same
+    transaction as the set, so a set is never seen without them.
+    '''
+    keys = set(members)
+    for attempt in xrange(insert_attempts):
+        try:
+            with db.engine.begin() as connection:
+                found = fetch(connection, db.MetaDataSet, keys)
+                missing = keys.difference(found)
+                if missing:
+                    insert(connection, db.MetaDataSet, missing)
+                    created = fetch(connection, db.MetaDataSet, missing)
+                    items = [{'metadata_set_id': _id, 'metadata_id': metadata_id}
+                             for key, _id in created.iteritems() for metadata_id in members[key]]
+                    for chunk in chunks(items, chunk_size):
+                        connection.execute(db.metadata_set_items.insert().values(chunk))
+                    found.update(created)
+            return found
+        except IntegrityError:
+            if attempt == insert_attempts - 1:
+                raise
+
+
+def sql_stack_key(frame_ids):
+    '''The key of a sql stack, the md5 of its list of stack item ids'''
+    return hashlib.md5(','.join(str(_id) for _id in frame_ids)).hexdigest()
+
+
+def resolve_sql_stacks(frame_id_lists):
+    '''
+    Return the ids of the sql stacks made of each of the given lists of
+    stack item ids, creating any stacks which do not exist yet. An empty
+    stack has no row, its id is None. Sql stacks no statement refers to
+    are purged, so the stacks handed out are marked used; any purged
+    before they could be are created again.
+    '''
+    cache = caches[db.SQLStack]
+    now = time.time()
+    keys = [(sql_stack_key(frame_ids),) if frame_ids else None for frame_ids in frame_id_lists]
+    ids = {None: None}
+    pending = dict((key, list(frame_ids)) for key, frame_ids in zip(keys, frame_id_lists) if key is not None)
+
+    for attempt in xrange(insert_attempts):
+        found = {}
+        misses = {}
+        for key, frames in pending.iteritems():
+            _id = cache.get(key)
+            if _id is None:
+                misses[key] = {'frames': frames, 'used_at': now}
+            else:
+                found[key] = _id
+
+        if misses:
+            created = fetch_or_create(db.SQLStack, set(misses), misses)
+            for key, _id in created.iteritems():
+                cache.put(key, _id)
+            found.update(created)
+
+        kept = mark_stacks_used(found.values(), now)
+        for key, _id in found.iteritems():
+            if _id in kept:
+                ids[key] = _id
+                del pending[key]
+            else:
+                cache.discard(key)
+        if not pending:
+            break
+    else:
+        raise RuntimeError('{0} sql stacks were purged as fast as they were created'.format(len(pending)))
+
+    return [ids[key] for key in keys]
+
+
+def mark_stacks_used(stack_ids, now):
+    '''
+    Set the used_at of the given sql stacks to now, unless it was set in
+    the first half of their grace period already, and return the ids of
+    those which still exist. Committed straight away, the purge leaves a
+    stack alone once it sees the new used_at, and if the purge commits
+    first the stack is gone and is left out.
+    '''
+    table = db.SQLStack.__table__
+    kept = set()
+    stale = []
+    for _id in set(stack_ids):
+        used_at = stacks_used.get(_id)
+        if used_at is not None and used_at >= now - grace / 2:
+            kept.add(_id)
+        else:
+            stale.append(_id)
+    if stale:
+        with db.engine.begin() as connection:
+            for chunk in chunks(sorted(stale), chunk_size):
+                connection.execute(table.update().where(table.c.id.in_(chunk)).values(used_at=now))
+                kept.update(row[0] for row in connection.execute(select([table.c.id]).where(table.c.id.in_(chunk))))
+    for _id in stale:
+        if _id in kept:
+            stacks_used.put(_id, now)
+    return kept
+
+
+def fetch(connection, model, keys):
+    '''Look up the ids of existing rows with a batched IN (...) query'''
+    table = model.__table__
+    columns = [table.c[column] for column in natural_keys[model]]
+    found = {}
+    for chunk in chunks(sorted(keys), chunk_size):
+        if len(columns) == 1:
+            clause = columns[0].in_([key[0] for key in chunk])
+        else:
+            clause = tuple_(*columns).in_(chunk)
+        query = select([table.c.id] + columns).where(clause)
+        for row in connection.execute(query):
+            found[tuple(row[1:])] = row[0]
+    return found
+
+
+def insert(connection, model, keys, values=None):
+    '''Create the rows for the given keys with multi-row inserts'''
+    columns = natural_keys[model]
+    for chunk in chunks(sorted(keys), chunk_size):
+        rows = [dict(zip(columns, key)) for key in chunk]
+        if values:
+            for row, key in zip(rows, chunk):
+                row.update(values[key])
+        connection.execute(model.__table__.insert().values(rows))
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
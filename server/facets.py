@@ -0,0 +1,239 @@
+'''
+In memory counts of the facts carrying each metadata key and value, per
+fact table and day, for the filter side bar. Call stacks also count their
+module, class and method as keys. A fact may carry several values of a
+key, so the facts carrying each key are counted too, under (key, None).
+The counts of the last few days are loaded at start up and the ingest
+workers add the facts they write, so the side bar never has to scan the
+metadata or name tables for them.
+Periods reaching back past the last few days are counted in the database
+for the older days, which no longer change, and cached until the next day.
+'''
+import time
+import sqlalchemy
+import database as db
+from threading import Lock
+from lru_cache import LRUCache
+from dimensions import chunk_size, chunks
+from sqlalchemy import select, func
+
+
+day = 24 * 60 * 60
+# days of counts kept
+days = 7
+
+fact_tables = dict((table.name, table) for table in (db.CallStack.__table__, db.SQLStatement.__table__,
+                                                      db.FileAccess.__table__))
+
+# fact table name -> {day: {(key, value): count}}
+counts = dict((table_name, {}) for table_name in fact_tables)
+_lock = Lock()
+
+# metadata set id -> its (key, value) pairs, call stack name id -> its pairs
+set_pairs = LRUCache(100000)
+name_pairs = LRUCache(100000)
+
+# (table names, start, end, key) -> counts of the facts before the in memory days
+stored_counts = LRUCache(1000)
+
+# the keys call stack names are counted under
+name_columns = (('module', db.CallStackName.module_name),
+                ('class', db.CallStackName.class_name),
+                ('method', db.CallStackName.fn_name))
+
+
+def setup(facet_days, cache_size):
+    '''Load the counts of the last facet_days days. Must run before the ingest workers start'''
+    global days, set_pairs, name_pairs
+    days = facet_days
+    set_pairs = LRUCache(cache_size)
+    name_pairs = LRUCache(cache_size)
+    for day_counts in counts.values():
+        day_counts.clear()
+
+    horizon = oldest_day()
+    for table in (db.CallStack.__table__, db.SQLStatement.__table__, db.FileAccess.__table__):
+        bucket = sqlalchemy.cast(func.floor(table.c.datetime / day), sqlalchemy.Integer) * day
+        columns = [bucket, table.c.metadata_set_id]
+        if table is db.CallStack.__table__:
+            columns.append(table.c.call_stack_name_id)
+        query = select(columns + [func.count()]).where(table.c.datetime >= horizon).group_by(*columns)
+        rows = [tuple(row) for row in db.session.execute(query)]
+        apply(prepare_rows(table.name, [(row[0], row[1], row[2] if len(row) > 3 else None, row[-1])
+                                        for row in rows]))
+    db.session.remove()
+
+
+def oldest_day():
+    return (int(time.time()) // day - days + 1) * day
+
+
+def prepare(batch):
+    '''
+    The counts to add for the facts of a batch. Done before the batch is
+    committed, as it may need to look up metadata sets and names.
+    '''
+    facts = []
+    for table, rows in batch.facts.iteritems():
+        if table.name in counts:
+            facts.append((table.name, [(int(row['datetime']) // day * day, row.get('metadata_set_id'),
+                                        row.get('call_stack_name_id'), 1) for row in rows]))
+    return [increment for name, rows in facts for increment in prepare_rows(name, rows)]
+
+
+def prepare_rows(table_name, rows):
+    '''(table name, day, (key, value), count) increments of rows of (day, set id, name id, count)'''
+    horizon = oldest_day()
+    rows = [row for row in rows if row[0] >= horizon]
+    load(set_pairs, set([row[1] for row in rows if row[1] is not None]), load_set_pairs)
+    load(name_pairs, set([row[2] for row in rows if row[2] is not None]), load_name_pairs)
+    increments = []
+    for bucket, set_id, name_id, count in rows:
+        pairs = set_pairs.get(set_id, []) if set_id is not None else []
+        if name_id is not None:
+            pairs = pairs + name_pairs.get(name_id, [])
+        for pair in pairs + [(key, None) for key in set(pair[0] for pair in pairs)]:
+            increments.append((table_name, bucket, pair, count))
+    return increments
+
+
+def apply(increments):
+    '''Add prepared increments to the counts, once their facts are committed'''
+    horizon = oldest_day()
+    with _lock:
+        for table_name, bucket, pair, count in increments:
+            day_counts = counts[table_name].setdefault(bucket, {})
+            day_counts[pair] = day_counts.get(pair, 0) + count
+        for day_counts in counts.values():
+            for bucket in [bucket for bucket in day_counts if bucket < horizon]:
+                del day_counts[bucket]
+
+
+def load(cache, ids, load_fn):
+    missing = [_id for _id in ids if _id not in cache]
+    for chunk in chunks(sorted(missing), chunk_size):
+        found = dict((_id, []) for _id in chunk)
+        for _id, pair in load_fn(chunk):
+            found[_id].append(pair)
+        for _id, pairs in found.iteritems():
+            cache.put(_id, pairs)
+
+
+def load_set_pairs(ids):
+    items = db.metadata_set_items
+    query = select([items.c.metadata_set_id, db.MetaData.key, db.MetaData.value])\
+                .where(items.c.metadata_id == db.MetaData.id)\
+                .where(items.c.metadata_set_id.in_(ids))
+    return [(row[0], (row[1], row[2])) for row in db.session.execute(query)]
+
+
+def load_name_pairs(ids):
+    query = db.session.query(db.CallStackName).filter(db.CallStackName.id.in_(ids))
+    return [(name.id, pair) for name in query for pair in (('module', name.module_name),
+                                                           ('class', name.class_name),
+                                                           ('method', name.fn_name))]
+
+
+def totals(table_names, start_date=None, end_date=None):
+    '''
+    The counts of each (key, value) pair over the given fact tables, for
+    the days overlapping a period
+    '''
+    result = {}
+    with _lock:
+        for table_name in table_names:
+            for bucket, day_counts in counts[table_name].iteritems():
+                if start_date is not None and bucket + day <= start_date:
+                    continue
+                if end_date is not None and bucket >= end_date:
+                    continue
+                for pair, count in day_counts.iteritems():
+                    result[pair] = result.get(pair, 0) + count
+    return result
+
+
+def period_totals(table_names, start_date=None, end_date=None, key=None):
+    '''
+    totals() over any period, counting the days before the in memory ones in
+    the database. key limits those to the pairs of one key.
+    '''
+    horizon = oldest_day()
+    result = {}
+    if end_date is None or end_date > horizon:
+        result = totals(table_names, horizon if start_date is None else max(start_date, horizon), end_date)
+    if start_date is None or start_date < horizon:
+        stored_end = horizon if end_date is None else min(end_date, horizon)
+        cache_key = (tuple(sorted(table_names)), start_date, stored_end, key)
+        stored = stored_counts.get(cache_key)
+        if stored is None:
+            stored = stored_totals(table_names, start_date, stored_end, key)
+            stored_counts.put(cache_key, stored)
+        for pair, count in stored.iteritems():
+            result[pair] = result.get(pair, 0) + count
+    return result
+
+
+def stored_totals(table_names, start_date, end_date, key=None):
+    '''The counts of each (key, value) pair, and (key, None), of the facts stored in a period'''
+    items = db.metadata_set_items
+    metadata = db.MetaData.__table__
+    names = db.CallStackName.__table__
+    result = {}
+    for table_name in table_names:
+        table = fact_tables[table_name]
+        period = []
+        if start_date is not None:
+            period.append(table.c.datetime >= start_date)
+        period.append(table.c.datetime < end_date)
+
+        query = select([metadata.c.key, metadata.c.value, func.count()])\
+                    .select_from(table.join(items, items.c.metadata_set_id == table.c.metadata_set_id)
+                                      .join(metadata, metadata.c.id == items.c.metadata_id))\
+                    .where(sqlalchemy.and_(*period))\
+                    .group_by(metadata.c.key, metadata.c.value)
+        if key is not None:
+            query = query.where(metadata.c.key == key)
+        rows = [((row[0], row[1]), row[2]) for row in db.session.execute(query)]
+
+        # each fact once per key of its metadata set, however many values it has
+        set_keys = select([items.c.metadata_set_id, metadata.c.key])\
+                       .where(metadata.c.id == items.c.metadata_id).distinct()
+        if key is not None:
+            set_keys = set_keys.where(metadata.c.key == key)
+        set_keys = set_keys.alias('set_keys')
+        query = select([set_keys.c.key, func.count()])\
+                    .select_from(table.join(set_keys, set_keys.c.metadata_set_id == table.c.metadata_set_id))\
+                    .where(sqlalchemy.and_(*period))\
+                    .group_by(set_keys.c.key)
+        rows.extend(((row[0], None), row[1]) for row in db.session.execute(query))
+
+        if table is db.CallStack.__table__:
+            for name_key, column in name_columns:
+                if key is not None and key != name_key:
+                    continue
+                query = select([column, func.count()])\
+                            .select_from(table.join(names, names.c.id == table.c.call_stack_name_id))\
+                            .where(sqlalchemy.and_(*period))\
+                            .group_by(column)
+                name_rows = [((name_key, row[0]), row[1]) for row in db.session.execute(query)]
+                # every call stack has exactly one of each
+                rows.extend(name_rows + [((name_key, None), sum(count for pair, count in name_rows))])
+
+        for pair, count in rows:
+            result[pair] = result.get(pair, 0) + count
+    return result
+
+
+def keys(table_names, start_date=None, end_date=None):
+    '''[(key, facts carrying it)] of the keys facts in the period carry, most common first'''
+    key_counts = [(key, count) for (key, value), count in period_totals(table_names, start_date, end_date).iteritems()
+                  if value is None and count]
+    return sorted(key_counts, key=lambda item: (-item[1], item[0]))
+
+
+def values(table_names, key, start_date=None, end_date=None):
+    '''[(value, count)] of the values of a key in the period, most common first'''
+    value_counts = [(value, count)
+                    for (pair_key, value), count in period_totals(table_names, start_date, end_date, key).iteritems()
+                    if pair_key == key and value not in (None, u'')]
+    return sorted(value_counts, key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,69 @@
+'''
+Latency histograms with logarithmically sized buckets. Bucket i counts the
+durations in (gamma**(i-1), gamma**i], so any value read back from a bucket
+is within a few percent of the real one. Histograms of different time
+buckets and names can be merged by adding their counts.
+
+Histograms are stored as JSON objects mapping bucket index to count.
+'''
+import math
+import json
+import sqlalchemy
+from sqlalchemy import func
+
+
+gamma = 1.05
+log_gamma = math.log(gamma)
+# durations below a microsecond all go in the same bucket
+min_duration = 1e-6
+
+
+def bucket_index(duration):
+    return int(math.ceil(math.log(max(duration, min_duration)) / log_gamma))
+
+
+def bucket_index_clause(duration):
+    '''bucket_index as a SQL expression, for building histograms in the database'''
+    return sqlalchemy.cast(func.ceil(func.ln(func.greatest(duration, min_duration)) / log_gamma),
+                           sqlalchemy.Integer)
+
+
+def bucket_value(index):
+    '''The value reported for the durations in a bucket, within 2.5% of each of them'''
+    return 2 * gamma ** index / (gamma + 1)
+
+
+class Histogram(object):
+
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+
+    def add(self, duration, count=1):
+        index = bucket_index(duration)
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def percentile(self, q):
+        '''Estimate the q quantile (0 <= q <= 1) of the durations, None if there are none'''
+        rank = q * (len(self) - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return bucket_value(index)
+        return None
+
+    def to_json(self):
+        return json.dumps(self.counts, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            return cls()
+        return cls(dict((int(index), count) for index, count in json.loads(data).iteritems()))
+
+    def __len__(self):
+        return sum(self.counts.itervalues())
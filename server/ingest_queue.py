@@ -0,0 +1,121 @@
+'''
+A bounded queue for packets waiting to be ingested. The queue is limited
+both by number of packets and by their estimated size in bytes and keeps
+depth, rate and wait time figures for sizing the ingest worker pool.
+'''
+from Queue import Queue
+from collections import deque
+from threading import Lock
+import time
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RateCounter(object):
+    '''Counts events per second over a sliding window'''
+
+    def __init__(self, window=60):
+        self.window = window
+        self._buckets = deque()
+        self._lock = Lock()
+
+    def add(self, count=1):
+        now = int(time.time())
+        with self._lock:
+            if self._buckets and self._buckets[-1][0] == now:
+                self._buckets[-1][1] += count
+            else:
+                self._buckets.append([now, count])
+            self._expire(now)
+
+    def rate(self):
+        now = int(time.time())
+        with self._lock:
+            self._expire(now)
+            return sum(count for second, count in self._buckets) / float(self.window)
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+
+class IngestQueue(object):
+
+    def __init__(self, max_packets=0, max_bytes=0):
+        '''A limit of 0 means unbounded'''
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self._queue = Queue()
+        self._lock = Lock()
+        self.packets = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.enqueue_rate = RateCounter()
+        self.dequeue_rate = RateCounter()
+        self.wait_times = deque(maxlen=1000)
+
+    def full(self, size=0):
+        return (self.max_packets and self.packets >= self.max_packets) or \
+               (self.max_bytes and self.packets and self.bytes + size > self.max_bytes)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def put(self, item, size=0):
+        '''Queue an item of the given estimated size, raising QueueFull if it won't fit'''
+        with self._lock:
+            if self.full(size):
+                self.rejected += 1
+                raise QueueFull()
+            self.packets += 1
+            self.bytes += size
+        self.enqueue_rate.add()
+        self._queue.put((time.time(), size, item))
+
+    def requeue(self, item, size=0):
+        '''Queue an item again which was taken off the queue, whatever the limits'''
+        with self._lock:
+            self.packets += 1
+            self.bytes += size
+        self._queue.put((time.time(), size, item))
+
+    def get(self, block=True):
+        queued_at, size, item = self._queue.get(block)
+        with self._lock:
+            self.packets -= 1
+            self.bytes -= size
+        self.dequeue_rate.add()
+        self.wait_times.append(time.time() - queued_at)
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+    def retry_after(self):
+        '''Seconds a rejected client should wait, based on how fast the queue is draining'''
+        rate = self.dequeue_rate.rate()
+        if not rate:
+            return 60
+        return max(1, min(60, int(self.packets / rate)))
+
+    def status(self):
+        wait_times = sorted(self.wait_times)
+        return {'packets': self.packets,
+                'bytes': self.bytes,
+                'max_packets': self.max_packets,
+                'max_bytes': self.max_bytes,
+                'rejected': self.rejected,
+                'enqueue_rate': self.enqueue_rate.rate(),
+                'dequeue_rate': self.dequeue_rate.rate(),
+                'avg_wait': sum(wait_times) / len(wait_times) if wait_times else 0,
+                'max_wait': wait_times[-1] if wait_times else 0,
+                'p90_wait': wait_times[int(len(wait_times) * 0.9)] if wait_times else 0}
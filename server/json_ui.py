@@ -6,21 +6,45 @@ from cgi import escape as html_escape
 import re
 import os.path
 import json
-import analyse_stats as a
-
-def retrieve_pstat(uuid):
-    if not os.path.isfile(os.path.join('pstats',uuid+'.json')):
-        stats = a.load(uuid)
-        callees = a.keys_to_str(stats.all_callees)
-        total_tt = stats.total_tt
-        stats = a.keys_to_str(stats.stats)
-        response = {'stats':stats,'callees':callees,'total_tt':total_tt}
-        a.write_json(response, uuid)
-        return response
-    else:
-        with open(os.path.join('pstats',str(uuid)+'.json')) as f:
-            return json.load(f)
+import facets
+import serializers
+import call_graphs
+import merged_profiles
+import analyse_stats
+from cherrypy.lib import cptools
+
+
+# Rows returned by a page of a list endpoint unless a limit is given, and at most
+default_limit = 1000
+max_limit = 10000
+
+# Rows fetched from the server side cursor at a time when exporting
+export_chunk_size = 1000
+
+list_models = {'callstacks': db.CallStack,
+               'sqlstatements': db.SQLStatement,
+               'sqlstackitems': db.SQLStackItem,
+               'fileaccesses': db.FileAccess}
+
+def list_query(model, kwargs):
+    # The rows of a list endpoint in id order, starting after after_id and,
+    # for facts, within start_date and end_date
+    query = db.session.query(model).order_by(model.id)
+    if kwargs.get('after_id'):
+        query = query.filter(model.id > int(kwargs['after_id']))
+    if hasattr(model, 'datetime'):
+        if kwargs.get('start_date'):
+            query = query.filter(model.datetime >= float(kwargs['start_date']))
+        if kwargs.get('end_date'):
+            query = query.filter(model.datetime < float(kwargs['end_date']))
+    return query
 
+def list_page(model, kwargs):
+    # A page of a list endpoint, the next one starts after the last id in it.
+    # stack=1 adds the stacks of sql statements
+    limit = min(int(kwargs.get('limit', default_limit)), max_limit)
+    rows = db.session.execute(list_query(model, kwargs).limit(limit).statement).fetchall()
+    return serializers.serialize(model, rows, stacks=bool(kwargs.get('stack')))
 
 
 class JSONAPI(object):
@@ -40,17 +64,49 @@ class JSONAPI(object):
             else:
                 raise cherrypy.NotFound
         else:
-            results = db.session.query(db.CallStack)
-            return [item.to_dict() for item in results.all()]
+            return list_page(db.CallStack, kwargs)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
     def callstackitems(self, callstack_id):
+        '''
+        The call graph of a call stack, gzipped unless the client can't take
+        it. Conditional GETs of a graph the client already has get a 304.
+        '''
         callstack = db.session.query(db.CallStack).get(callstack_id)
-        if not callstack:
+        if not callstack or not call_graphs.available(callstack.pstat_uuid):
             raise cherrypy.NotFound
         uuid = callstack.pstat_uuid
-        return retrieve_pstat(uuid)
+        gzipped = 'gzip' in cherrypy.request.headers.get('Accept-Encoding', '')
+        response = cherrypy.response
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['ETag'] = call_graphs.etag(uuid, gzipped)
+        response.headers['Vary'] = 'Accept-Encoding'
+        cptools.validate_etags()
+
+        data = call_graphs.build(uuid)
+        if data is None:
+            raise cherrypy.NotFound
+        if not gzipped:
+            return call_graphs.decompress(data)
+        response.headers['Content-Encoding'] = 'gzip'
+        return data
+
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def mergedcallgraph(self, call_stack_name_id, start_date=None, end_date=None):
+        '''
+        The call graph of every profile of a call stack name in a period,
+        widened to whole hours, in the form of callstackitems
+        '''
+        stats, profile_count = merged_profiles.period_stats(int(call_stack_name_id),
+                                                            float(start_date) if start_date else None,
+                                                            float(end_date) if end_date else None)
+        if stats is None:
+            raise cherrypy.NotFound
+        response = analyse_stats.call_graph(stats)
+        response['profile_count'] = profile_count
+        return response
 
 
     @cherrypy.expose
@@ -78,8 +134,7 @@ class JSONAPI(object):
             else:
                 raise cherrypy.NotFound
         else:
-            results = db.session.query(db.SQLStatement)
-            return [item.to_dict() for item in results.all()]
+            return list_page(db.SQLStatement, kwargs)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -87,8 +142,7 @@ class JSONAPI(object):
         if id:
             return db.session.query(db.SQLStackItem).get(id).to_dict()
         else:
-            results = db.session.query(db.SQLStackItem)
-            return [item.to_dict() for item in results.all()]
+            return list_page(db.SQLStackItem, kwargs)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -96,48 +150,57 @@ class JSONAPI(object):
         if id:
             return db.session.query(db.FileAccess).get(id).to_dict()
         else:
-            results = db.session.query(db.FileAccess)
-            return [item.to_dict() for item in results.all()]
+            return list_page(db.FileAccess, kwargs)
+
+    @cherrypy.expose
+    def export(self, url_name, **kwargs):
+        '''
+        Stream the rows of a list endpoint as newline delimited JSON, read
+        through a server side cursor so memory use stays flat however many
+        there are. Takes the same after_id, start_date, end_date and stack
+        arguments, limit is optional.
+        '''
+        if url_name not in list_models:
+            raise cherrypy.NotFound
+        model = list_models[url_name]
+        query = list_query(model, kwargs)
+        if kwargs.get('limit'):
+            query = query.limit(int(kwargs['limit']))
+        connection = db.session.connection().execution_options(stream_results=True)
+        result = connection.execute(query.statement)
+
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+        def lines():
+            try:
+                rows = result.fetchmany(export_chunk_size)
+                while rows:
+                    for response in serializers.serialize(model, rows, stacks=bool(kwargs.get('stack'))):
+                        yield json.dumps(response) + '\n'
+                    rows = result.fetchmany(export_chunk_size)
+            finally:
+                result.close()
+                db.session.remove()
+        return lines()
+    export._cp_config = {'response.stream': True}
         
-    table_metadata_keys_dict = {'callstacks':[['module','class','method'],['statement_identifiers','statement_type']],
-                                'sqlstatements':[[],[]],
-                                'fileaccesses':[[],['statement_identifiers','statement_type']]}
-    
-    call_stack_metadata_dict = {'module': ['module_name', db.CallStackName.module_name],
-                                'class':  ['class_name', db.CallStackName.class_name],
-                                'method': ['fn_name', db.CallStackName.fn_name]}
-    
+    # fact tables of each page, the side bar only offers the metadata of its facts
+    table_names_dict = {'callstacks': ['call_stacks'],
+                        'sqlstatements': ['sql_statements'],
+                        'fileaccesses': ['file_accesses']}
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def metadata(self, id=None, **kwargs):
-        results_list = []
+        start_date = int(float(kwargs['start_date'])) if kwargs.get('start_date') else None
+        end_date = int(float(kwargs['end_date'])) if kwargs.get('end_date') else None
         if 'get_keys' in kwargs:
-            table_name = kwargs['get_keys']
-            table_metadata_keys = self.table_metadata_keys_dict[table_name]
-            extra_keys = table_metadata_keys[0]
-            remove_keys = table_metadata_keys[1]
-            
-            key_list_dicts = db.session.query(db.MetaData.key).distinct().all()
-            results_list = [key_dict[0] for key_dict in key_list_dicts]
-            results_list += extra_keys
-            for key in remove_keys:
-                if key in results_list:
-                    results_list.remove(key)
+            table_names = self.table_names_dict[kwargs['get_keys']]
+            results_list = facets.keys(table_names, start_date, end_date)
         else:
-            results_list = []
-            for key in kwargs:
-                if kwargs[key] in self.call_stack_metadata_dict:
-                    call_stack_attr_name = self.call_stack_metadata_dict[kwargs[key]][0]
-                    call_stack_attr = self.call_stack_metadata_dict[kwargs[key]][1]
-                    call_stack_name_list = db.session.query(db.CallStackName).all()
-                    results_list += list(set([getattr(call_stack_name, call_stack_attr_name) for call_stack_name in call_stack_name_list]))
-            
-            metadata_list = db.session.query(db.MetaData).filter_by(**kwargs).all()
-            results_list += [metadata.__dict__['value'] for metadata in metadata_list]
-        
-        for result in results_list:
-            if result == None:
-                results_list.remove(result)
-        results_list = [str(result) for result in results_list]
-        results_list.sort(key=str.lower)
+            table_names = self.table_names_dict.get(kwargs.get('table'), facets.counts.keys())
+            results_list = facets.values(table_names, kwargs.get('key'), start_date, end_date)
+
+        # [value, number of facts with it] pairs
+        results_list = [[str(result), count] for result, count in results_list]
+        results_list.sort(key=lambda result: result[0].lower())
         return results_list
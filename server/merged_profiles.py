@@ -0,0 +1,168 @@
+'''
+The profiles of each call stack name added together per hour and per day,
+showing where a handler spends its time across all of its calls. The
+ingest workers queue the call stacks they commit and a merger thread adds
+their profiles to the buckets every interval seconds. The adding up is CPU
+bound, so it is done in a pool of processes where it can't hold up the
+ingest workers and web threads. A period is answered by adding up the
+coarsest buckets covering it.
+'''
+import time
+import cPickle
+import pstats
+import cherrypy
+from multiprocessing import Pool
+from threading import Thread
+from Queue import Queue, Full, Empty
+from sqlalchemy import select, and_, or_, tuple_
+import database as db
+import pstats_store
+import rollups
+from dimensions import chunk_size, chunks
+
+
+resolutions = (rollups.hour, rollups.day)
+
+key_columns = ('call_stack_name_id', 'resolution', 'bucket')
+
+# (call stack name id, datetime, profile key) of committed call stacks
+merge_queue = Queue(100000)
+# seconds between merges, profiles arriving in between are merged together
+interval = 60
+pool = None
+dropped = 0
+
+
+def setup(process_count, queue_size, merge_interval):
+    '''
+    Start the merge processes and the thread feeding them. Must run before
+    any other threads are started and before the database engine and the
+    profile store are opened, the processes are forked and would share
+    their connections and files.
+    '''
+    global merge_queue, interval, pool
+    merge_queue = Queue(queue_size)
+    interval = merge_interval
+    pool = Pool(process_count)
+    merger_thread = Thread(target=merger, name='profile-merger')
+    merger_thread.daemon = True
+    merger_thread.start()
+
+
+def enqueue(rows):
+    '''Queue the profiles of committed call stack rows to be merged'''
+    global dropped
+    if pool is None:
+        return
+    for row in rows:
+        try:
+            merge_queue.put_nowait((row['call_stack_name_id'], row['datetime'], row['pstat_uuid']))
+        except Full:
+            dropped += 1
+
+
+def merger():
+    global dropped
+    while True:
+        time.sleep(interval)
+        if dropped:
+            cherrypy.log('Merge queue full, {0} profiles were left out of the merged profiles'.format(dropped))
+            dropped = 0
+        try:
+            merge_queued()
+        except Exception:
+            cherrypy.log('Unable to merge profiles', traceback=True)
+        finally:
+            db.session.remove()
+
+
+def merge(profiles):
+    '''Add up stored profiles into a pickled stats dict. Runs in the pool'''
+    stats = pstats.Stats(*[pstats_store.BogusStats(pstats_store.decode_stats(data)) for data in profiles])
+    return cPickle.dumps(stats.stats, cPickle.HIGHEST_PROTOCOL)
+
+
+def merge_queued():
+    '''Add the queued profiles to the merged profiles of their buckets'''
+    buckets = {}
+    while True:
+        try:
+            name_id, datetime, key = merge_queue.get_nowait()
+        except Empty:
+            break
+        for resolution in resolutions:
+            buckets.setdefault((name_id, resolution, int(datetime) // resolution * resolution), []).append(key)
+    if not buckets:
+        return
+
+    table = db.MergedProfile.__table__
+    columns = [table.c[column] for column in key_columns]
+    existing = {}
+    for chunk in chunks(sorted(buckets), chunk_size):
+        for row in db.session.execute(select([table]).where(tuple_(*columns).in_(chunk))):
+            existing[tuple(row[column] for column in key_columns)] = row
+
+    # each profile is read once, however many buckets it goes in
+    profiles = {}
+    def profile(key):
+        if key not in profiles:
+            profiles[key] = pstats_store.store.get(key)
+        return profiles[key]
+
+    jobs = []
+    for bucket in sorted(buckets):
+        row = existing.get(bucket)
+        # profiles purged since they were queued are left out
+        data = [item for item in (profile(key) for key in buckets[bucket]) if item is not None]
+        if not data:
+            continue
+        count = len(data)
+        if row is not None and profile(row['pstat_key']) is not None:
+            data.insert(0, profile(row['pstat_key']))
+        jobs.append((bucket, count, pool.apply_async(merge, (data,))))
+
+    updates = []
+    inserts = []
+    for bucket, count, job in jobs:
+        pstat_key = pstats_store.store.put(job.get())
+        row = existing.get(bucket)
+        if row is None:
+            inserts.append(dict(zip(key_columns, bucket), profile_count=count, pstat_key=pstat_key))
+        else:
+            updates.append((bucket, row['profile_count'] + count, pstat_key))
+    with db.engine.begin() as connection:
+        if inserts:
+            connection.execute(table.insert(), inserts)
+        for bucket, profile_count, pstat_key in updates:
+            connection.execute(table.update().where(and_(*[column == value for column, value in zip(columns, bucket)]))
+                                             .values(profile_count=profile_count, pstat_key=pstat_key))
+
+
+def period_stats(call_stack_name_id, start=None, end=None):
+    '''
+    The sorted pstats.Stats of the profiles of a call stack name in a
+    period, widened to whole hours, and how many profiles went into it.
+    None if there are none.
+    '''
+    table = db.MergedProfile.__table__
+    available = tuple(resolution for resolution in rollups.available_resolutions(start, end)
+                      if resolution in resolutions)
+    clauses = []
+    for resolution, range_start, range_end in rollups.bucket_ranges(start, end, available):
+        clause = [table.c.resolution == resolution]
+        if range_start is not None:
+            clause.append(table.c.bucket >= range_start)
+        if range_end is not None:
+            clause.append(table.c.bucket < range_end)
+        clauses.append(and_(*clause))
+    rows = db.session.execute(select([table]).where(table.c.call_stack_name_id == call_stack_name_id)
+                                             .where(or_(*clauses))).fetchall()
+    profiles = [data for data in (pstats_store.store.get(row['pstat_key']) for row in rows) if data is not None]
+    if not profiles:
+        return None, 0
+
+    data = pool.apply(merge, (profiles,)) if pool is not None else merge(profiles)
+    stats = pstats.Stats(pstats_store.BogusStats(cPickle.loads(data)))
+    stats.calc_callees()
+    stats.sort_stats('cumulative')
+    return stats, sum(row['profile_count'] for row in rows)
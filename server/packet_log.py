@@ -0,0 +1,189 @@
+'''
+An append-only, segmented log of accepted packets. Packets are written to
+the log before they are acknowledged and are marked as consumed once the
+ingest workers have committed them, so packets still in the ingest queue
+survive a restart of the server.
+
+Each segment file holds a sequence of records, a header of the payload
+length and crc32 followed by the payload. Consumed records are noted by
+their offset in a matching .done file. Appends are fsynced in groups by a
+single syncer thread, so concurrent requests share the cost of one fsync.
+'''
+import os
+import struct
+import zlib
+from threading import Condition, Thread
+
+
+header = struct.Struct('>II')
+done_entry = struct.Struct('>Q')
+
+
+class PacketLog(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._cond = Condition()
+        self._pending = {}      # segment number -> offsets not yet consumed
+        self._sealed = set()    # segments which will not be appended to again
+        self._done_files = {}
+        self._segment = None
+        self._file = None
+        self._offset = 0
+        self._written = 0
+        self._synced = 0
+
+    def open(self):
+        '''
+        Find the records earlier runs did not consume, then start a new
+        segment for appending. Returns the number of records to replay.
+        '''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        segments = self._segments()
+        for segment in segments:
+            done = self._read_done(segment)
+            self._pending[segment] = set(offset for offset, data in self._read_segment(segment)
+                                         if offset not in done)
+            self._sealed.add(segment)
+            if not self._pending[segment]:
+                self._remove(segment)
+        self._start_segment(segments[-1] + 1 if segments else 1)
+
+        syncer = Thread(target=self._sync_loop, name='packet-log-syncer')
+        syncer.daemon = True
+        syncer.start()
+        return sum(len(offsets) for offsets in self._pending.values())
+
+    def replay(self):
+        '''Yield the (position, data) of every record left over from earlier runs'''
+        with self._cond:
+            segments = sorted(self._sealed)
+        for segment in segments:
+            with self._cond:
+                pending = set(self._pending.get(segment, ()))
+            if not pending:
+                continue
+            for offset, data in self._read_segment(segment):
+                if offset in pending:
+                    yield (segment, offset), data
+
+    def append(self, data):
+        '''Write a record and wait until it is on disk, returning its position'''
+        with self._cond:
+            if self._offset >= self.segment_size:
+                self._roll()
+            position = (self._segment, self._offset)
+            self._file.write(header.pack(len(data), zlib.crc32(data) & 0xffffffff))
+            self._file.write(data)
+            self._offset += header.size + len(data)
+            self._pending[self._segment].add(position[1])
+            self._written += 1
+            sequence = self._written
+            self._cond.notify_all()
+            while self._synced < sequence:
+                self._cond.wait()
+        return position
+
+    def consumed(self, position):
+        '''Note that the record at position has been committed to the database'''
+        segment, offset = position
+        with self._cond:
+            pending = self._pending.get(segment)
+            if pending is None or offset not in pending:
+                return
+            pending.remove(offset)
+            if not pending and segment in self._sealed:
+                self._remove(segment)
+            else:
+                done_file = self._done_file(segment)
+                done_file.write(done_entry.pack(offset))
+                done_file.flush()
+
+    def status(self):
+        with self._cond:
+            return {'segments': len(self._pending),
+                    'unconsumed': sum(len(offsets) for offsets in self._pending.values())}
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while self._synced == self._written:
+                    self._cond.wait()
+                target = self._written
+                self._file.flush()
+                fileno = self._file.fileno()
+            try:
+                os.fsync(fileno)
+            except OSError:
+                # the segment was rolled (and synced) while we were waiting
+                pass
+            with self._cond:
+                self._synced = max(self._synced, target)
+                self._cond.notify_all()
+
+    def _roll(self):
+        '''Seal the current segment and start the next, called holding the lock'''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._synced = self._written
+        self._cond.notify_all()
+        segment = self._segment
+        self._sealed.add(segment)
+        if not self._pending[segment]:
+            self._remove(segment)
+        self._start_segment(segment + 1)
+
+    def _start_segment(self, segment):
+        self._segment = segment
+        self._file = open(self._path(segment, 'log'), 'ab')
+        self._offset = self._file.tell()
+        self._pending[segment] = set()
+
+    def _remove(self, segment):
+        del self._pending[segment]
+        self._sealed.discard(segment)
+        done_file = self._done_files.pop(segment, None)
+        if done_file:
+            done_file.close()
+        for extension in ('log', 'done'):
+            if os.path.exists(self._path(segment, extension)):
+                os.remove(self._path(segment, extension))
+
+    def _done_file(self, segment):
+        if segment not in self._done_files:
+            self._done_files[segment] = open(self._path(segment, 'done'), 'ab')
+        return self._done_files[segment]
+
+    def _segments(self):
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self.directory)
+                      if name.endswith('.log'))
+
+    def _path(self, segment, extension):
+        return os.path.join(self.directory, '{0:08d}.{1}'.format(segment, extension))
+
+    def _read_done(self, segment):
+        path = self._path(segment, 'done')
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'rb') as f:
+            data = f.read()
+        count = len(data) // done_entry.size
+        return set(done_entry.unpack_from(data, i * done_entry.size)[0] for i in xrange(count))
+
+    def _read_segment(self, segment):
+        '''Yield each intact record, stopping at a torn write at the end of the file'''
+        with open(self._path(segment, 'log'), 'rb') as f:
+            offset = 0
+            while True:
+                record_header = f.read(header.size)
+                if len(record_header) < header.size:
+                    return
+                length, crc = header.unpack(record_header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    return
+                yield offset, data
+                offset += header.size + length
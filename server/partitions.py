@@ -0,0 +1,161 @@
+'''
+Time partitioning of the fact tables. Each partition is a child table
+inheriting from its fact table and holding the facts of one period, with a
+CHECK constraint on their datetime. Postgres leaves out the partitions a
+date filter excludes (constraint_exclusion = partition, the default), and
+retention drops whole partitions instead of deleting rows.
+
+Partitions are created a few periods ahead by a maintenance thread, and on
+demand for facts falling outside of those. The ingest workers insert
+straight into the partitions, the fact tables themselves stay empty.
+Partitioning needs table inheritance, so it is only used with Postgres.
+'''
+import time
+import calendar
+import cherrypy
+import database as db
+from threading import Thread, Lock
+from sqlalchemy import Table, Column, MetaData, text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+tables = (db.CallStack.__table__, db.SQLStatement.__table__, db.FileAccess.__table__)
+
+day = 24 * 60 * 60
+period = day
+ahead = 7
+enabled = False
+# milliseconds a partition drop waits for the queries reading it, queries on
+# the fact table queue up behind a waiting drop
+drop_lock_timeout = 5000
+
+# fact table -> {period start: partition table}
+partitions = dict((table, {}) for table in tables)
+_lock = Lock()
+_metadata = MetaData()
+
+
+def setup(partition_days, partitions_ahead):
+    '''
+    Create the partitions for the coming periods and start the thread
+    keeping them coming. partition_days must not change once partitions
+    exist, the periods of different lengths would overlap.
+    '''
+    global period, ahead, enabled
+    period = partition_days * day
+    ahead = partitions_ahead
+    enabled = db.engine.dialect.name == 'postgresql'
+    if not enabled:
+        return
+    refresh()
+    maintain()
+    maintenance_thread = Thread(target=maintenance_loop, name='partition-maintenance')
+    maintenance_thread.daemon = True
+    maintenance_thread.start()
+
+
+def maintenance_loop():
+    while True:
+        time.sleep(60 * 60)
+        try:
+            maintain()
+        except SQLAlchemyError:
+            cherrypy.log('Unable to create partitions', traceback=True)
+
+
+def maintain():
+    '''Make sure the partitions from the last period to ahead periods from now exist'''
+    now = partition_start(time.time())
+    for table in tables:
+        for i in xrange(-1, ahead + 1):
+            ensure(table, now + i * period)
+
+
+def refresh():
+    '''Load the partitions which already exist'''
+    with db.engine.begin() as connection:
+        for table in tables:
+            names = connection.execute(text('SELECT child.relname FROM pg_inherits '
+                                            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                                            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                                            'WHERE parent.relname = :parent'), parent=table.name)
+            for (name,) in names:
+                start, end = partition_range(table, name)
+                partitions[table][start] = partition_table(table, name, end)
+
+
+def partition_start(datetime):
+    return int(datetime) // period * period
+
+
+def partition_name(table, start):
+    return '{0}_{1}_{2}d'.format(table.name, time.strftime('%Y%m%d', time.gmtime(start)), period // day)
+
+
+def partition_range(table, name):
+    '''The (start, end) datetimes of a partition, from its name'''
+    date, days = name[len(table.name) + 1:].split('_')
+    start = calendar.timegm(time.strptime(date, '%Y%m%d'))
+    return start, start + int(days.rstrip('d')) * day
+
+
+def partition_table(table, name, end):
+    child = Table(name, _metadata, *[Column(column.name, column.type, primary_key=column.primary_key)
+                                     for column in table.columns])
+    child.end = end
+    return child
+
+
+def ensure(table, start):
+    '''Create the partition of table starting at start if there isn't one'''
+    if start in partitions[table]:
+        return partitions[table][start]
+    with _lock:
+        if start not in partitions[table]:
+            name = partition_name(table, start)
+            end = start + period
+            with db.engine.begin() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS {0} ('
+                                   '    LIKE {1} INCLUDING DEFAULTS INCLUDING INDEXES,'
+                                   '    CHECK (datetime >= {2} AND datetime < {3})'
+                                   ') INHERITS ({1})'.format(name, table.name, start, end))
+            partitions[table][start] = partition_table(table, name, end)
+    return partitions[table][start]
+
+
+def prepare(batch):
+    '''Create the partitions the facts of a batch go in, before the batch is written'''
+    if not enabled:
+        return
+    for table, rows in batch.facts.iteritems():
+        if table in partitions:
+            for start in set(partition_start(row['datetime']) for row in rows):
+                ensure(table, start)
+
+
+def route(table, rows):
+    '''Split rows between the tables they are inserted into'''
+    if not enabled or table not in partitions:
+        return [(table, rows)]
+    routed = {}
+    for row in rows:
+        child = partitions[table][partition_start(row['datetime'])]
+        routed.setdefault(child, []).append(row)
+    return routed.items()
+
+
+def expired(table, cutoff):
+    '''The partitions of table holding nothing but facts from before cutoff'''
+    return [child for start, child in sorted(partitions[table].items()) if child.end <= cutoff]
+
+
+def drop(table, child):
+    '''Drop a partition, giving up if it stays in use for drop_lock_timeout'''
+    with _lock:
+        with db.engine.begin() as connection:
+            connection.execute('SET LOCAL lock_timeout = {0}'.format(int(drop_lock_timeout)))
+            connection.execute('DROP TABLE IF EXISTS {0}'.format(child.name))
+        for start, partition in partitions[table].items():
+            if partition is child:
+                del partitions[table][start]
+        _metadata.remove(child)
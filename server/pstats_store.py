@@ -0,0 +1,287 @@
+'''
+Storage for profile stats. Rather than a file per profile, compressed
+profiles are appended to large segment files, with an index table in the
+database mapping each key to its segment, offset and length. Profiles are
+keyed by the hash of their content, so identical profiles are stored once.
+Segments are read through memory maps, and compaction rewrites segments
+whose profiles are mostly no longer referenced by any call stack.
+Blobs and segments written in the last grace seconds are never reclaimed,
+the rows referring to them may not have committed yet.
+
+Profiles stored before this (one file per profile in the pstats directory)
+are still read from their own files.
+'''
+import os
+import time
+import mmap
+import zlib
+import marshal
+import cPickle
+import hashlib
+import pstats
+from threading import Lock
+from sqlalchemy import func, exists, or_, select, text
+from sqlalchemy.orm import aliased
+import database as db
+from lru_cache import LRUCache
+from dimensions import chunk_size, chunks
+
+
+class BogusStats(object):
+    '''
+    A bogus class to put the stats into, this object can be used
+    to initilise a pstats object
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+       '''A phantom method to trick pstats into accepting its stats'''
+       pass
+
+
+def blob_key(data):
+    '''The key data is stored under when none is given, the hash of its content'''
+    return hashlib.sha1(data).hexdigest()
+
+
+class PStatsStore(object):
+
+    def __init__(self, directory='pstats', segment_size=256 * 1024 * 1024, grace=60 * 60):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.grace = grace
+        self._lock = Lock()
+        self._maps = {}
+        # key -> when its blob was last known to be stored and safe from compaction
+        self._known_keys = LRUCache(100000)
+        self._segment = None
+        self._file = None
+        self._dirty = False
+
+    def open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        segments = self._segments()
+        # always start a fresh segment, an earlier run may have left a torn tail
+        self._start_segment(segments[-1] + 1 if segments else 1)
+
+    def put(self, data, key=None, graph_of=None):
+        '''
+        Store data under the given key, or the hash of the data if no key
+        is given, and return the key. Data already stored is not written
+        again. graph_of is the key of the profile data is the call graph of.
+        '''
+        if key is None:
+            key = blob_key(data)
+        with db.engine.begin() as connection:
+            stored = self.write(connection, {key: data})
+            # on disk before the index entry pointing at it commits
+            self.sync()
+            if graph_of is not None:
+                table = db.PStatBlob.__table__
+                connection.execute(table.update().where(table.c.key == graph_of).values(graph_key=key))
+        self.stored(stored)
+        return key
+
+    def write(self, connection, blobs):
+        '''
+        Store blobs (key -> data) in the transaction of connection, which
+        should be the one committing the rows that refer to them. Blobs
+        already stored are not written again, but are given a new grace
+        period if theirs is half over, so compaction leaves them alone until
+        the transaction commits. Returns what to pass to stored() once it has.
+        '''
+        now = time.time()
+        table = db.PStatBlob.__table__
+        keys = sorted(key for key in blobs if not self._known(key, now))
+        existing = {}
+        for chunk in chunks(keys, chunk_size):
+            existing.update(tuple(row) for row in connection.execute(
+                select([table.c.key, table.c.created_at]).where(table.c.key.in_(chunk))))
+
+        stale = sorted(key for key, created_at in existing.iteritems()
+                       if created_at is None or created_at < now - self.grace / 2)
+        for chunk in chunks(stale, chunk_size):
+            connection.execute(table.update().where(table.c.key.in_(chunk)).values(created_at=now))
+            # compaction may have reclaimed some before they were updated
+            kept = set(row[0] for row in connection.execute(select([table.c.key]).where(table.c.key.in_(chunk))))
+            for key in chunk:
+                if key in kept:
+                    existing[key] = now
+                else:
+                    del existing[key]
+
+        rows = []
+        for key in keys:
+            if key not in existing:
+                compressed = zlib.compress(blobs[key])
+                segment, start = self._append(compressed)
+                rows.append({'key': key, 'segment': segment, 'start': start,
+                             'length': len(compressed), 'created_at': now})
+                existing[key] = now
+        if rows:
+            if connection.dialect.name == 'postgresql':
+                # another worker may be storing the same data, ours is left for compaction
+                statement = text('INSERT INTO pstat_blobs (key, segment, start, length, created_at) '
+                                 'VALUES (:key, :segment, :start, :length, :created_at) '
+                                 'ON CONFLICT (key) DO NOTHING')
+            else:
+                statement = table.insert().prefix_with('OR IGNORE')
+            connection.execute(statement, rows)
+        return existing
+
+    def stored(self, stored):
+        '''Remember the blobs a write() stored, once its transaction has committed'''
+        for key, created_at in stored.iteritems():
+            self._known_keys.put(key, created_at)
+
+    def _known(self, key, now):
+        created_at = self._known_keys.get(key)
+        return created_at is not None and created_at >= now - self.grace / 2
+
+    def get(self, key):
+        '''Return the data stored under key, or None if there is none'''
+        blob = db.session.query(db.PStatBlob).get(key)
+        if blob is None:
+            return self._get_legacy(key)
+        return zlib.decompress(self._read(blob.segment, blob.start, blob.length))
+
+    def exists(self, key):
+        '''Whether there is data stored under key, without reading it'''
+        if db.session.query(db.PStatBlob.key).filter_by(key=key).first() is not None:
+            return True
+        return os.path.isfile(os.path.join(self.directory, key))
+
+    def sync(self):
+        '''Make everything appended so far durable, before it is referenced'''
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def compact(self, min_garbage=0.5, batch_size=1000, pause=0.1):
+        '''
+        Drop index entries nothing refers to, and rewrite every sealed
+        segment in which at least min_garbage of the bytes are unreferenced.
+        Blobs stored and segments written in the last grace seconds are
+        left alone.
+        '''
+        cutoff = time.time() - self.grace
+        self._purge_unreferenced(cutoff, batch_size, pause)
+
+        live_bytes = dict(db.session.query(db.PStatBlob.segment, func.sum(db.PStatBlob.length))
+                                    .group_by(db.PStatBlob.segment).all())
+        for segment in self._segments():
+            if segment == self._segment or os.path.getmtime(self._path(segment)) > cutoff:
+                continue
+            size = os.path.getsize(self._path(segment))
+            if size and 1 - float(live_bytes.get(segment, 0)) / size < min_garbage:
+                continue
+            for blob in db.session.query(db.PStatBlob).filter_by(segment=segment).all():
+                blob.segment, blob.start = self._append(self._read(segment, blob.start, blob.length))
+            self.sync()
+            db.session.commit()
+            with self._lock:
+                segment_map = self._maps.pop(segment, None)
+                if segment_map:
+                    segment_map.close()
+            os.remove(self._path(segment))
+        db.session.remove()
+
+    def _purge_unreferenced(self, cutoff, batch_size, pause):
+        '''
+        Delete the index entries stored before cutoff which no call stack,
+        merged profile or profile (for call graphs) refers to, walking the
+        index in key order a batch at a time
+        '''
+        table = db.PStatBlob.__table__
+        profiles = aliased(db.PStatBlob)
+        referenced = or_(exists().where(db.CallStack.pstat_uuid == table.c.key),
+                         exists().where(db.MergedProfile.pstat_key == table.c.key),
+                         exists().where(profiles.graph_key == table.c.key))
+        last_key = ''
+        while True:
+            with db.engine.begin() as connection:
+                keys = [row[0] for row in connection.execute(
+                            select([table.c.key]).where(table.c.key > last_key)
+                                                 .order_by(table.c.key)
+                                                 .limit(batch_size))]
+                if not keys:
+                    return
+                last_key = keys[-1]
+                connection.execute(table.delete().where(table.c.key.in_(keys))
+                                                 .where(table.c.created_at < cutoff)
+                                                 .where(~referenced))
+            time.sleep(pause)
+
+    def _append(self, data):
+        with self._lock:
+            if self._file.tell() >= self.segment_size:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._start_segment(self._segment + 1)
+            start = self._file.tell()
+            self._file.write(data)
+            self._dirty = True
+            return self._segment, start
+
+    def _read(self, segment, start, length):
+        with self._lock:
+            if segment == self._segment and self._dirty:
+                self._file.flush()
+            segment_map = self._maps.get(segment)
+            if segment_map is None or len(segment_map) < start + length:
+                # (re)map, the current segment grows as it is appended to
+                if segment_map is not None:
+                    segment_map.close()
+                with open(self._path(segment), 'rb') as f:
+                    segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = segment_map
+            return segment_map[start:start + length]
+
+    def _get_legacy(self, key):
+        path = os.path.join(self.directory, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _start_segment(self, segment):
+        self._segment = segment
+        self._file = open(self._path(segment), 'ab')
+
+    def _segments(self):
+        return sorted(int(name[len('segment-'):]) for name in os.listdir(self.directory)
+                      if name.startswith('segment-'))
+
+    def _path(self, segment):
+        return os.path.join(self.directory, 'segment-{0:08d}'.format(segment))
+
+
+store = PStatsStore()
+
+
+def setup(directory, segment_size, grace=60 * 60):
+    global store
+    store = PStatsStore(directory, segment_size, grace)
+    store.open()
+
+
+def load_stats(key):
+    '''Build a pstats.Stats object from the stored profile'''
+    data = store.get(key)
+    if data is None:
+        return None
+    return pstats.Stats(BogusStats(decode_stats(data)))
+
+
+def decode_stats(data):
+    '''The stats dict of a stored profile'''
+    if data.startswith('{'):
+        # marshalled by pstats.dump_stats, as older profiles were stored
+        return marshal.loads(data)
+    # pickled stats dict, as sent by the client
+    return cPickle.loads(data)
@@ -0,0 +1,96 @@
+'''
+Caches the results of the aggregate queries the pages poll, so the same
+page open in several browsers, or redrawn by datatables, costs one query.
+Each fact table has a generation the ingest workers bump after writing to
+it. Results remember the generation they were computed at and are thrown
+away once it moves on, or once they are older than the TTL. Concurrent
+requests for a result which isn't cached wait for the first one to
+compute it rather than all running the same query.
+'''
+import time
+from threading import Lock, Event
+from lru_cache import LRUCache
+
+
+ttl = 30
+results = LRUCache(1000)
+
+# fact table name -> generation
+generations = {}
+_lock = Lock()
+
+# key -> Flight of the result being computed
+_in_flight = {}
+
+
+class Flight(object):
+    '''A result being computed, which other requests for it wait on'''
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def setup(cache_size, cache_ttl):
+    global ttl, results
+    ttl = cache_ttl
+    results = LRUCache(cache_size)
+
+
+def bump(table_names):
+    '''Invalidate the results computed from the given fact tables'''
+    with _lock:
+        for name in table_names:
+            generations[name] = generations.get(name, 0) + 1
+
+
+def normalise(value):
+    '''A hashable form of the arguments of a query, the same however dicts are ordered'''
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalise(item)) for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalise(item) for item in value)
+    return value
+
+
+def get(table_name, key, compute):
+    '''The cached result for key, computing it with compute() if there is none'''
+    generation = generations.get(table_name, 0)
+    entry = results.get(key)
+    if entry is not None and entry[0] == generation and entry[1] > time.time():
+        return entry[2]
+
+    with _lock:
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = Flight()
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        # stamped with the generation from before the query, so facts written
+        # while it runs make the result stale straight away
+        flight.result = compute()
+        results.put(key, (generation, time.time() + ttl, flight.result))
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        flight.done.set()
+
+
+def cached(query_func):
+    '''Cache the results of a query function taking the table class first'''
+    def cached_query(table_class, *args, **kwargs):
+        key = (query_func.__name__, table_class.__tablename__, normalise(args), normalise(kwargs))
+        return get(table_class.__tablename__, key, lambda: query_func(table_class, *args, **kwargs))
+    cached_query.__name__ = query_func.__name__
+    return cached_query
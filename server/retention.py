@@ -0,0 +1,160 @@
+'''
+Background purging of old data. Facts are kept for a configurable number
+of days per fact type and the rollups, per resolution, usually for longer.
+Merged profiles are kept as long as the rollups of their resolution.
+Partitions of facts which have all expired are dropped, anything else is
+deleted in small batches, each in a transaction of its own with a pause
+in between, so the ingest workers are never held up for long.
+Afterwards the profiles and dimension rows nothing refers to any more are
+reclaimed.
+'''
+import time
+import cherrypy
+import database as db
+import dimensions
+import pstats_store
+import rollups
+import partitions
+import merged_profiles
+from threading import Thread
+from sqlalchemy import select, exists, or_, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+
+fact_tables = (db.CallStack.__table__, db.SQLStatement.__table__, db.FileAccess.__table__)
+
+# dimension only referenced by facts -> (table referencing it, column referencing it)
+orphan_dimensions = {db.SQLStack: (db.SQLStatement.__table__, 'sql_stack_id')}
+
+# days to keep each fact table and each rollup resolution for, 0 to keep forever
+fact_days = {}
+rollup_days = {}
+
+interval = 60 * 60
+batch_size = 1000
+# seconds to wait between batches, giving the ingest workers a look in
+pause = 0.1
+
+
+def setup(run_interval, delete_batch_size, table_days, resolution_days):
+    '''
+    Start the retention thread. table_days maps fact table names and
+    resolution_days rollup resolutions (in seconds) to the days to keep.
+    '''
+    global interval, batch_size
+    interval = run_interval
+    batch_size = delete_batch_size
+    for table in fact_tables:
+        fact_days[table] = table_days.get(table.name, 0)
+    rollup_days.update(resolution_days)
+    # the aggregate queries stay clear of rollups which have been purged
+    rollups.kept_days.update(resolution_days)
+
+    retention_thread = Thread(target=retention_loop, name='retention')
+    retention_thread.daemon = True
+    retention_thread.start()
+
+
+def retention_loop():
+    while True:
+        time.sleep(interval)
+        try:
+            run()
+        except Exception:
+            cherrypy.log('Retention run failed', traceback=True)
+        finally:
+            db.session.remove()
+
+
+def run():
+    now = time.time()
+    for table, days in fact_days.items():
+        if days:
+            deleted = purge_facts(table, now - days * rollups.day)
+            cherrypy.log('Purged {0} rows from {1}'.format(deleted, table.name))
+    for resolution, days in rollup_days.items():
+        if days:
+            deleted = purge_buckets(db.Rollup.__table__, rollups.key_columns, resolution, now - days * rollups.day)
+            cherrypy.log('Purged {0} rollups of {1} seconds'.format(deleted, resolution))
+            if resolution in merged_profiles.resolutions:
+                deleted = purge_buckets(db.MergedProfile.__table__, merged_profiles.key_columns,
+                                        resolution, now - days * rollups.day)
+                cherrypy.log('Purged {0} merged profiles of {1} seconds'.format(deleted, resolution))
+    for model in orphan_dimensions:
+        deleted = purge_orphans(model)
+        cherrypy.log('Purged {0} unused rows from {1}'.format(deleted, model.__tablename__))
+    pstats_store.store.compact(batch_size=batch_size, pause=pause)
+
+
+def purge_facts(table, cutoff):
+    '''Delete the facts older than cutoff'''
+    if partitions.enabled:
+        for partition in partitions.expired(table, cutoff):
+            try:
+                partitions.drop(table, partition)
+            except SQLAlchemyError:
+                # still in use, its rows are deleted below and it is dropped next run
+                cherrypy.log('Unable to drop partition {0}'.format(partition.name), traceback=True)
+                continue
+            cherrypy.log('Dropped partition {0}'.format(partition.name))
+    # and the rest, in the partition the cutoff falls in
+    deleted = 0
+    while True:
+        with db.engine.begin() as connection:
+            ids = [row[0] for row in connection.execute(
+                        select([table.c.id]).where(table.c.datetime < cutoff).limit(batch_size))]
+            if not ids:
+                return deleted
+            # the datetime lets constraint exclusion skip the partitions the ids can't be in
+            deleted += connection.execute(table.delete().where(table.c.datetime < cutoff)
+                                                        .where(table.c.id.in_(ids))).rowcount
+        time.sleep(pause)
+
+
+def purge_buckets(table, key_columns, resolution, cutoff):
+    '''Delete the rows of a resolution for buckets before cutoff, from the rollups or merged profiles'''
+    columns = [table.c[column] for column in key_columns]
+    deleted = 0
+    while True:
+        with db.engine.begin() as connection:
+            keys = [tuple(row) for row in connection.execute(
+                        select(columns).where(table.c.resolution == resolution)
+                                       .where(table.c.bucket < cutoff)
+                                       .limit(batch_size))]
+            if not keys:
+                return deleted
+            deleted += connection.execute(table.delete().where(tuple_(*columns).in_(keys))).rowcount
+        time.sleep(pause)
+
+
+def purge_orphans(model):
+    '''
+    Delete dimension rows no fact refers to. Rows an ingest worker marked
+    used in the last grace period are left alone, the facts using them may
+    not have committed yet.
+    '''
+    table = model.__table__
+    referencing_table, column = orphan_dimensions[model]
+    key_columns = [table.c[name] for name in dimensions.natural_keys[model]]
+    referenced = exists().where(referencing_table.c[column] == table.c.id)
+    unused = or_(table.c.used_at == None, table.c.used_at < time.time() - dimensions.grace)
+    deleted = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(select([table.c.id] + key_columns)
+                                      .where(table.c.id > last_id)
+                                      .where(unused)
+                                      .where(~referenced)
+                                      .order_by(table.c.id)
+                                      .limit(batch_size)).fetchall()
+            if not rows:
+                return deleted
+            last_id = rows[-1][0]
+            # check again in the delete, a worker may have marked the row used since
+            deleted += connection.execute(table.delete().where(table.c.id.in_([row[0] for row in rows]))
+                                                        .where(unused)
+                                                        .where(~referenced)).rowcount
+        for row in rows:
+            dimensions.caches[model].discard(tuple(row[1:]))
+        time.sleep(pause)
@@ -0,0 +1,206 @@
+'''
+Per name, per minute/hour/day rollups of the fact tables, kept up to date
+by the ingest workers in the same transaction as the facts themselves.
+The aggregate pages are answered from the coarsest rollups covering the
+requested period, so their cost depends on the length of the period
+rather than on the number of facts stored.
+'''
+import time
+import database as db
+from histogram import Histogram
+from dimensions import chunk_size, chunks
+from sqlalchemy import select, and_, or_, tuple_, bindparam
+from sqlalchemy.exc import IntegrityError
+
+
+# fact table -> (fact type stored in the rollups, column of the name the facts are grouped by)
+fact_tables = {db.CallStack.__table__:    ('call_stack', 'call_stack_name_id'),
+               db.SQLStatement.__table__: ('sql_statement', 'sql_string_id'),
+               db.FileAccess.__table__:   ('file_access', 'file_name_id')}
+
+fact_types = {db.CallStack:    'call_stack',
+              db.SQLStatement: 'sql_statement',
+              db.FileAccess:   'file_access'}
+
+minute, hour, day = 60, 60 * 60, 24 * 60 * 60
+resolutions = (minute, hour, day)
+
+key_columns = ('fact_type', 'resolution', 'bucket', 'name_id')
+
+# days the rollups of each resolution are kept for, set up by the retention job
+kept_days = {}
+
+
+class Summary(object):
+    '''The count, total, min, max and histogram of a set of durations'''
+
+    def __init__(self, count=0, total=0.0, min=None, max=None, histogram=None):
+        self.count = count
+        self.total = total
+        self.min = min
+        self.max = max
+        self.histogram = histogram or Histogram()
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        self.histogram.add(duration)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.histogram.merge(other.histogram)
+
+
+def summarise(batch):
+    '''Summarise the facts of a batch by rollup key'''
+    summaries = {}
+    for table, rows in batch.facts.iteritems():
+        if table not in fact_tables:
+            continue
+        fact_type, name_column = fact_tables[table]
+        for row in rows:
+            for resolution in resolutions:
+                key = (fact_type, resolution, int(row['datetime']) // resolution * resolution, row[name_column])
+                summary = summaries.get(key)
+                if summary is None:
+                    summary = summaries[key] = Summary()
+                summary.add(row['duration'])
+    return summaries
+
+
+def prepare(batch):
+    '''
+    Summarise the facts of a batch, creating the rollup rows they will be
+    added to. Done before the batch's own transaction starts writing.
+    '''
+    summaries = summarise(batch)
+    if summaries:
+        create(sorted(summaries))
+    return summaries
+
+
+def update(connection, summaries):
+    '''
+    Add prepared summaries to the rollups. Rows are locked in key order
+    so concurrent workers updating the same buckets can't deadlock.
+    '''
+    if not summaries:
+        return
+    keys = sorted(summaries)
+    table = db.Rollup.__table__
+    rows = []
+    for chunk in chunks(keys, chunk_size):
+        query = select([table]).where(tuple_(*[table.c[column] for column in key_columns]).in_(chunk))\
+                               .order_by(*[table.c[column] for column in key_columns])\
+                               .with_for_update()
+        for row in connection.execute(query):
+            key = tuple(row[column] for column in key_columns)
+            summary = Summary(row['count'], row['total'], row['min'], row['max'],
+                              Histogram.from_json(row['histogram']))
+            summary.merge(summaries[key])
+            row = dict(('b_' + column, value) for column, value in zip(key_columns, key))
+            row.update(count=summary.count, total=summary.total, min=summary.min, max=summary.max,
+                       histogram=summary.histogram.to_json())
+            rows.append(row)
+
+    statement = table.update().where(and_(*[table.c[column] == bindparam('b_' + column) for column in key_columns]))
+    connection.execute(statement.values(count=bindparam('count'), total=bindparam('total'),
+                                        min=bindparam('min'), max=bindparam('max'),
+                                        histogram=bindparam('histogram')),
+                       rows)
+
+
+def create(keys):
+    '''
+    Create empty rollup rows for the keys which have none. Like dimension
+    rows they are committed straight away on a connection of their own,
+    racing workers just find the row already there.
+    '''
+    table = db.Rollup.__table__
+    columns = [table.c[column] for column in key_columns]
+    with db.engine.begin() as connection:
+        existing = set()
+        for chunk in chunks(keys, chunk_size):
+            query = select(columns).where(tuple_(*columns).in_(chunk))
+            existing.update(tuple(row) for row in connection.execute(query))
+    missing = [key for key in keys if key not in existing]
+    for chunk in chunks(missing, chunk_size):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values([dict(zip(key_columns, key), count=0, total=0.0)
+                                                          for key in chunk]))
+        except IntegrityError:
+            # another worker created some of them first, do the rest one by one
+            for key in chunk:
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(table.insert(), dict(zip(key_columns, key), count=0, total=0.0))
+                except IntegrityError:
+                    pass
+
+
+def bucket_ranges(start=None, end=None, resolutions=resolutions):
+    '''
+    Split a period into (resolution, start, end) ranges of whole buckets,
+    using the coarsest buckets possible. None is an open end. The period
+    is widened to whole buckets of the finest resolution given.
+    '''
+    finest = resolutions[0]
+    if start is not None:
+        start = int(start) // finest * finest
+    if end is not None:
+        end = -(-int(end) // finest) * finest
+    return cover(start, end, resolutions)
+
+
+def cover(start, end, resolutions):
+    resolution = resolutions[-1]
+    if len(resolutions) == 1:
+        return [(resolution, start, end)]
+    inner_start = None if start is None else -(-start // resolution) * resolution
+    inner_end = None if end is None else end // resolution * resolution
+    if inner_start is not None and inner_end is not None and inner_start >= inner_end:
+        return cover(start, end, resolutions[:-1])
+    ranges = [(resolution, inner_start, inner_end)]
+    if start is not None and start < inner_start:
+        ranges.extend(cover(start, inner_start, resolutions[:-1]))
+    if end is not None and inner_end < end:
+        ranges.extend(cover(inner_end, end, resolutions[:-1]))
+    return ranges
+
+
+def available_resolutions(start=None, end=None):
+    '''The resolutions whose rollups have not been purged for the edges of a period'''
+    earliest = start if start is not None else end
+    if earliest is None:
+        return resolutions
+    now = time.time()
+    # the coarsest resolution is always used, there is nothing to fall back on
+    return tuple(resolution for resolution in resolutions
+                 if resolution == resolutions[-1] or not kept_days.get(resolution)
+                 or int(earliest) >= now - kept_days[resolution] * day)
+
+
+def period_clause(start=None, end=None):
+    '''A clause selecting the rollup rows which cover a period exactly once'''
+    clauses = []
+    for resolution, range_start, range_end in bucket_ranges(start, end, available_resolutions(start, end)):
+        clause = [db.Rollup.resolution == resolution]
+        if range_start is not None:
+            clause.append(db.Rollup.bucket >= range_start)
+        if range_end is not None:
+            clause.append(db.Rollup.bucket < range_end)
+        clauses.append(and_(*clause))
+    return or_(*clauses)
+
+
+def join_clause(table_class, name_column):
+    '''Join the rollups of a fact type to its name table'''
+    return and_(db.Rollup.fact_type == fact_types[table_class], db.Rollup.name_id == name_column)
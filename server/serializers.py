@@ -0,0 +1,110 @@
+'''
+Bulk serialisation of the rows the JSON API lists into the dicts their
+models' to_dict methods make. A page of rows is read together with its
+names, metadata and stacks in a fixed number of set based queries, instead
+of lazy loading them row by row through the ORM.
+'''
+import database as db
+from dimensions import chunk_size, chunks
+from sqlalchemy import select
+
+
+def serialize(model, rows, stacks=False):
+    '''
+    Serialise rows of model's table (result rows, keyed by column name).
+    stacks adds the stack of each sql statement.
+    '''
+    if model is db.SQLStatement:
+        return sql_statements(rows, stacks)
+    return serializers[model](rows)
+
+
+def by_id(table, ids):
+    '''The rows of table with the given ids, by id'''
+    found = {}
+    for chunk in chunks(sorted(set(ids)), chunk_size):
+        for row in db.session.execute(select([table]).where(table.c.id.in_(chunk))):
+            found[row['id']] = row
+    return found
+
+
+def metadata(set_ids):
+    '''The metadata dict of each of the given metadata sets, by set id'''
+    items = db.metadata_set_items
+    pairs = dict((set_id, []) for set_id in set_ids if set_id is not None)
+    for chunk in chunks(sorted(pairs), chunk_size):
+        query = select([items.c.metadata_set_id, db.MetaData.key, db.MetaData.value])\
+                    .where(items.c.metadata_id == db.MetaData.id)\
+                    .where(items.c.metadata_set_id.in_(chunk))
+        for set_id, key, value in db.session.execute(query):
+            pairs[set_id].append((key, value))
+    return dict((set_id, db.metadata_dict(set_pairs)) for set_id, set_pairs in pairs.iteritems())
+
+
+def with_metadata(rows, responses):
+    '''Add the metadata of each row to its response, as to_dict does'''
+    row_metadata = metadata([row['metadata_set_id'] for row in rows])
+    for row, response in zip(rows, responses):
+        response.update(row_metadata.get(row['metadata_set_id'], {}))
+    return responses
+
+
+def call_stacks(rows):
+    names = by_id(db.CallStackName.__table__, [row['call_stack_name_id'] for row in rows])
+    responses = []
+    for row in rows:
+        name = names[row['call_stack_name_id']]
+        responses.append({'id': row['id'],
+                          'name': str(db.CallStackFullName(name['module_name'], name['class_name'], name['fn_name'])),
+                          'datetime': row['datetime'],
+                          'duration': row['duration'],
+                          'pstat_uuid': row['pstat_uuid']})
+    return with_metadata(rows, responses)
+
+
+def sql_statements(rows, stacks=False):
+    sql_strings = by_id(db.SQLString.__table__, [row['sql_string_id'] for row in rows])
+    responses = []
+    for row in rows:
+        args = row['args'] or []
+        responses.append({'id': row['id'],
+                          'sql': sql_strings[row['sql_string_id']]['sql'],
+                          'datetime': row['datetime'],
+                          'duration': row['duration'],
+                          'args': zip(args[::2], args[1::2])})
+    if stacks:
+        sql_stacks = by_id(db.SQLStack.__table__, [row['sql_stack_id'] for row in rows
+                                                   if row['sql_stack_id'] is not None])
+        stack_items = by_id(db.SQLStackItem.__table__, [frame for stack in sql_stacks.itervalues()
+                                                        for frame in stack['frames']])
+        for row, response in zip(rows, responses):
+            # a stack purged from under its statement is shown empty
+            stack = sql_stacks.get(row['sql_stack_id'])
+            frames = stack['frames'] if stack is not None else []
+            response['stack'] = sql_stack_items([stack_items[frame] for frame in frames if frame in stack_items])
+    return with_metadata(rows, responses)
+
+
+def sql_stack_items(rows):
+    return [{'id': row['id'],
+             'module': row['module'],
+             'function': row['function']} for row in rows]
+
+
+def file_accesses(rows):
+    filenames = by_id(db.FileName.__table__, [row['file_name_id'] for row in rows])
+    responses = []
+    for row in rows:
+        responses.append({'id': row['id'],
+                          'filename': filenames[row['file_name_id']]['filename'],
+                          'mode': row['mode'],
+                          'datetime': row['datetime'],
+                          'duration': row['duration'],
+                          'data_written': row['data_written']})
+    return with_metadata(rows, responses)
+
+
+serializers = {db.CallStack:    call_stacks,
+               db.SQLStatement: sql_statements,
+               db.SQLStackItem: sql_stack_items,
+               db.FileAccess:   file_accesses}
@@ -0,0 +1,93 @@
+'''
+Extraction of the statement type and identifiers (tables, columns,
+functions, ...) of SQL strings, which sql statements are tagged with as
+metadata. The same few hundred SQL strings are seen over and over, so
+results are cached per SQL string, and the common statement shapes are
+handled by a small tokenizer instead of a full sqlparse parse.
+'''
+import re
+from sqlparse import tokens as sql_tokens, parse as parse_sql
+from sqlparse.keywords import KEYWORDS, KEYWORDS_COMMON
+from lru_cache import LRUCache
+
+
+cache = LRUCache(10000)
+
+# Statements the tokenizer handles, anything else goes to sqlparse
+simple_statements = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+# The subset of the sqlparse lexer rules needed for plain DML, in the same
+# order. Comments, quoted names, dollar quoting etc. are left to sqlparse.
+simple_token = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<placeholder>\?|%\(\w+\)s|[:?%]\w+)
+  | (?P<call>[^\W\d_]\w*(?=[.(]))
+  | (?P<number>[-]?0x[0-9a-fA-F]+|[-]?[0-9]*(\.[0-9]+)?[eE][-]?[0-9]+|[-]?[0-9]*\.[0-9]+|[-]?[0-9]+)
+  | (?P<string>''|'.*?[^\\]'|""|".*?[^\\]")
+  | (?P<word>[^\W\d_]\w*)
+  | (?P<punctuation>[*;(),.]|[<>=~!]+|[+/#%^&|?^-]+)
+''', re.IGNORECASE | re.UNICODE | re.VERBOSE)
+
+
+def extract(sql_string_id, sql):
+    '''Return the (statement type, identifiers) of a SQL string'''
+    result = cache.get(sql_string_id)
+    if result is None:
+        identifiers = tokenize(sql)
+        if identifiers is None:
+            identifiers = sqlparse_identifiers(sql)
+        result = (sql.split()[0], identifiers)
+        cache.put(sql_string_id, result)
+    return result
+
+
+def tokenize(sql):
+    '''
+    Pull the Name tokens out of simple SELECT/INSERT/UPDATE/DELETE
+    statements, returning None for anything it doesn't understand.
+    '''
+    if sql.lstrip()[:6].upper() not in simple_statements:
+        return None
+    if ';' in sql.rstrip().rstrip(';') or '--' in sql or '/*' in sql:
+        # multiple statements or comments
+        return None
+
+    identifiers = []
+    position = 0
+    after_dot = False
+    while position < len(sql):
+        match = simple_token.match(sql, position)
+        if not match:
+            return None
+        kind = match.lastgroup
+        value = match.group()
+        if kind in ('call', 'word'):
+            word = value.upper()
+            if ((kind == 'call' or after_dot) and word in special_words) or word == 'STRAIGHT' \
+                    or (word.startswith('VALUES') and word != 'VALUES'):
+                # sqlparse has rules of its own which lex these as keywords
+                return None
+            if kind == 'call' or after_dot or is_name(word):
+                identifiers.append(value)
+        after_dot = value == '.'
+        position = match.end()
+    return identifiers
+
+
+# Keywords sqlparse matches ahead of its rules for calls and dotted names
+special_words = ('CASE', 'VALUES', 'END', 'CREATE', 'NOT', 'JOIN', 'LEFT', 'RIGHT',
+                 'FULL', 'INNER', 'OUTER', 'CROSS', 'NATURAL')
+
+
+def is_name(word):
+    return word not in KEYWORDS_COMMON and word not in KEYWORDS
+
+
+def sqlparse_identifiers(sql):
+    parsed_sql = parse_sql(sql)[0]
+    sql_identifiers = []
+    for token in parsed_sql.tokens:
+        for item in token.flatten():
+            if item.ttype == sql_tokens.Name:
+                sql_identifiers.append(item.value)
+    return sql_identifiers
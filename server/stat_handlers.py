@@ -2,27 +2,56 @@ import cherrypy
 from cherrypy._cpcompat import ntou, json_decode
 import zlib
 import database as db
+import dimensions
 import os
 import cPickle
-import pstats
-import uuid
+import time
+import random
 from threading import Thread
-from Queue import Queue
-from sqlparse import tokens as sql_tokens, parse as parse_sql
-from sqlalchemy import and_
-from operator import attrgetter
+from Queue import Empty
+from ingest_queue import IngestQueue, QueueFull
+from bulk_writer import FactBatch
+from packet_log import PacketLog
+from sqlalchemy.exc import OperationalError, DisconnectionError
+import sql_identifiers
+import pstats_store
+import rollups
+import partitions
+import result_cache
+import facets
+import call_graphs
+import merged_profiles
 
 
 allowed_content_types = [ntou('application/json'),
                          ntou('text/javascript'),
                          ntou('application/gzip')]
 
+class QueueFullError(cherrypy.HTTPError):
+    '''
+    Rejects a packet while the ingest queue is full, telling the client
+    when to try again.
+    '''
+    def __init__(self):
+        cherrypy.HTTPError.__init__(self, 503, 'Ingest queue is full')
+        self.retry_after = stat_handler_queue.retry_after()
+
+    def set_response(self):
+        cherrypy.HTTPError.set_response(self)
+        cherrypy.serving.response.headers['Retry-After'] = str(self.retry_after)
+
+
 def decompress_json(entity):
     """Try decompressing json before parsing, incase compressed
     content was sent to the server"""
 
     if not entity.headers.get(ntou("Content-Length"), ntou("")):
         raise cherrypy.HTTPError(411)
+
+    # Don't bother reading the body if it can't be queued anyway
+    if stat_handler_queue.full():
+        stat_handler_queue.reject()
+        raise QueueFullError()
     
     body = entity.fp.read()
     # decompress if gzip content type
@@ -36,19 +65,210 @@ def decompress_json(entity):
         cherrypy.serving.request.json = json_decode(body.decode('utf-8'))
     except ValueError:
         raise cherrypy.HTTPError(400, 'Invalid JSON document')
+    # Rough estimate of the memory the packet will hold while queued
+    cherrypy.serving.request.json_size = len(body)
+    cherrypy.serving.request.json_body = body
+
+stat_handler_queue = IngestQueue()
+
+# Maximum number of queued packets written together in one transaction
+ingest_batch_size = 50
+
+worker_threads = []
+
+# Write-ahead log of accepted packets, None if disabled
+packet_log = None
+
+# Which sql statements have their args stored: every one, those taking at
+# least args_min_duration seconds, one in args_sample_rate at random, or none
+args_capture_policies = ('all', 'slow', 'sample', 'none')
+args_capture = 'all'
+args_min_duration = 0.0
+args_sample_rate = 1
+
+# Seconds a worker waits before requeueing the packets it couldn't write
+# for the database being unavailable, doubling while it stays unavailable.
+# Requeued packets count against the queue limits, so clients are turned
+# away rather than told their packets were accepted
+retry_delay = 1
+retry_max_delay = 60
+
+def setup(worker_count=1, batch_size=50, max_packets=0, max_bytes=0,
+          log_directory=None, log_segment_size=64 * 1024 * 1024,
+          sql_args_capture='all', sql_args_min_duration=0.0, sql_args_sample_rate=1):
+    '''
+    Limit the stat handler queue and start the pool of ingest workers
+    draining it. Each worker thread gets its own database session from
+    the scoped session. If a log directory is given, accepted packets are
+    logged there and any left unconsumed by the last run are replayed.
+    sql_args_capture is the policy for storing the args of sql statements,
+    one of args_capture_policies.
+    '''
+    global ingest_batch_size, packet_log, args_capture, args_min_duration, args_sample_rate
+    if sql_args_capture not in args_capture_policies:
+        raise ValueError('Unknown sql args capture policy {0}'.format(sql_args_capture))
+    args_capture = sql_args_capture
+    args_min_duration = sql_args_min_duration
+    args_sample_rate = sql_args_sample_rate
+    ingest_batch_size = batch_size
+    stat_handler_queue.max_packets = max_packets
+    stat_handler_queue.max_bytes = max_bytes
+    if log_directory:
+        packet_log = PacketLog(log_directory, log_segment_size)
+        if packet_log.open():
+            replay_thread = Thread(target=replay, name='packet-log-replay')
+            replay_thread.daemon = True
+            replay_thread.start()
+    for i in xrange(worker_count):
+        worker_thread = Thread(target=worker, name='ingest-worker-{0}'.format(i))
+        worker_thread.daemon = True
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+
+
+def log_record(parse_fn, ip_address, body):
+    return '{0}\n{1}\n{2}'.format(parse_fn.__name__, ip_address, body)
+
+
+def replay():
+    '''Queue the packets the last run accepted but never committed'''
+    replayed = 0
+    for position, record in packet_log.replay():
+        parse_fn_name, ip_address, body = record.split('\n', 2)
+        try:
+            packet = json_decode(body.decode('utf-8'))
+            packet['metadata']['ip_address'] = ip_address
+        except Exception:
+            cherrypy.log('Unable to replay logged packet', traceback=True)
+            packet_log.consumed(position)
+            continue
+        while True:
+            try:
+                stat_handler_queue.put([parsers[parse_fn_name], packet, position, len(body)], len(body))
+                break
+            except QueueFull:
+                time.sleep(1)
+        replayed += 1
+    cherrypy.log('Replayed {0} logged packets'.format(replayed))
+
+
+def mark_consumed(positions):
+    if packet_log:
+        for position in positions:
+            if position is not None:
+                packet_log.consumed(position)
 
-stat_handler_queue = Queue()
         
 def worker():
+    failures = 0
     while True:
-        item = stat_handler_queue.get()
-        fn = item[0]
-        fn(item[1])
-        stat_handler_queue.task_done()
-        
-worker_thread = Thread(target=worker)
-worker_thread.daemon = True
-worker_thread.start()
+        items = [stat_handler_queue.get()]
+        # group commit whatever else is already waiting
+        while len(items) < ingest_batch_size:
+            try:
+                items.append(stat_handler_queue.get_nowait())
+            except Empty:
+                break
+        retry = []
+        try:
+            retry = ingest(items)
+        finally:
+            # start each batch with an empty session so the identity map can't grow
+            db.session.remove()
+            for item in items:
+                stat_handler_queue.task_done()
+        if retry:
+            time.sleep(min(retry_delay * 2 ** failures, retry_max_delay))
+            failures += 1
+            for item in retry:
+                stat_handler_queue.requeue(item, item[3])
+        else:
+            failures = 0
+
+
+def unavailable(error):
+    '''Whether an error is the database being unavailable, rather than something wrong with a packet'''
+    return isinstance(error, (OperationalError, DisconnectionError)) or getattr(error, 'connection_invalidated', False)
+
+
+def ingest(items):
+    '''
+    Parse queued packets and write them together, returning those which
+    failed because the database was unavailable, to be tried again.
+    Packets which can never be written are logged and left out.
+    '''
+    retry = []
+    parsed = []
+    for item in items:
+        parse_fn, packet, position, size = item
+        batch = FactBatch()
+        batch.positions.append(position)
+        try:
+            parse_fn(packet, batch)
+        except Exception as error:
+            cherrypy.log('Unable to parse packet with {0}'.format(parse_fn.__name__), traceback=True)
+            if unavailable(error):
+                retry.append(item)
+            else:
+                # a bad packet, never going to succeed so don't replay it
+                mark_consumed(batch.positions)
+            continue
+        parsed.append((item, batch))
+    if not parsed:
+        return retry
+
+    group = FactBatch()
+    group.packets = 0
+    for item, batch in parsed:
+        group.extend(batch)
+    error = write_batch(group)
+    if error is None:
+        return retry
+    if unavailable(error):
+        return retry + [item for item, batch in parsed]
+
+    # write packets one at a time so one bad packet doesn't lose the rest
+    for item, batch in parsed:
+        if len(parsed) > 1:
+            error = write_batch(batch)
+        if error is None:
+            continue
+        if unavailable(error):
+            retry.append(item)
+        else:
+            cherrypy.log('Dropping packet which {0} can never write'.format(item[0].__name__))
+            mark_consumed(batch.positions)
+    return retry
+
+
+def write_batch(batch):
+    '''Write a batch in one transaction, returning the error it failed with or None'''
+    db_session = db.session
+    try:
+        partitions.prepare(batch)
+        summaries = rollups.prepare(batch)
+        facet_increments = facets.prepare(batch)
+        connection = db_session.connection()
+        # indexed in the same transaction as the call stacks pointing at
+        # them, a rolled back batch leaves no index entries behind
+        stored = pstats_store.store.write(connection, batch.blobs)
+        batch.write(connection)
+        rollups.update(connection, summaries)
+        # the profiles must be on disk before the call stacks pointing at them
+        pstats_store.store.sync()
+        db_session.commit()
+        pstats_store.store.stored(stored)
+        result_cache.bump(table.name for table in batch.facts)
+        facets.apply(facet_increments)
+        call_graphs.enqueue(row['pstat_uuid'] for row in batch.facts.get(db.CallStack.__table__, []))
+        merged_profiles.enqueue(batch.facts.get(db.CallStack.__table__, []))
+        mark_consumed(batch.positions)
+        return None
+    except Exception as error:
+        db_session.rollback()
+        cherrypy.log('Unable to write {0} packets'.format(batch.packets), traceback=True)
+        return error
+
 
 class StatHandler(object):
     '''
@@ -65,193 +285,184 @@ class StatHandler(object):
         # Add sender's details to the metadata
         cherrypy.serving.request.json['metadata']['ip_address'] = cherrypy.request.remote.ip
 
-        stat_handler_queue.put([self.parse_fn, cherrypy.serving.request.json])
+        # Make the packet durable before acknowledging it
+        position = None
+        if packet_log:
+            position = packet_log.append(log_record(self.parse_fn,
+                                                    cherrypy.request.remote.ip,
+                                                    cherrypy.serving.request.json_body))
+
+        try:
+            stat_handler_queue.put([self.parse_fn, cherrypy.serving.request.json, position,
+                                    cherrypy.serving.request.json_size],
+                                   cherrypy.serving.request.json_size)
+        except QueueFull:
+            mark_consumed([position])
+            raise QueueFullError()
 
         cherrypy.response.status = 202 # Send back Accepted so they know it's successfully into the processing queue.
         return 'Hello, World.'
 
 
-class BogusStats(object):
+class IngestStatus(object):
     '''
-    A bogus class to put the stats into, this object can be used
-    to initilise a pstats object
+    Queue depth, enqueue/dequeue rates and packet wait times, for sizing
+    the ingest worker pool.
     '''
-    def __init__(self, stats):
-        self.stats = stats
-
-    def create_stats(self):
-       '''A phantom method to trick pstats into accepting its stats''' 
-       pass
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def index(self):
+        status = stat_handler_queue.status()
+        status['workers'] = len(worker_threads)
+        if packet_log:
+            status['packet_log'] = packet_log.status()
+        return status
 
 
-def parse_fn_packet(packet):
-    db_session = db.session
-    
+def parse_fn_packet(packet, batch):
     # Get global metadata
-    metadata_list = get_metadata_list(packet['metadata'], db_session)
+    metadata_set_id = get_metadata_set_id(packet['metadata'])
+
+    # callstack names
+    call_stack_name_ids = dimensions.resolve(db.CallStackName,
+                                             [(profile['module'], profile['class'], profile['function'])
+                                              for profile in packet['stats']])
     
-    for profile in packet['stats']:
-        # pull and unpickle pstats
-        stats = cPickle.loads(str(profile['profile']))
-        # need to make it a bogus stats object for it to initialise
-        # (needs a create_stats method and stats attr)
-        stats = BogusStats(stats)
-        stats = pstats.Stats(stats)
-        profile['duration'] = stats.total_tt
-        _id = str(uuid.uuid4())
-        while os.path.isfile(os.path.join(os.getcwd(),'pstats',_id)):
-            _id = str(uuid.uuid4())
-        profile['pstat_uuid'] = _id
-        stats.dump_stats('pstats\\'+_id)
-
-        # callstack names
-        call_stack_name = get_or_create(db_session,
-                                       db.CallStackName,
-                                       module_name = profile['module'],
-                                       class_name = profile['class'],
-                                       fn_name = profile['function'])
-        
-        # Add call stack
-        call_stack = db.CallStack(profile)
-        call_stack.name = call_stack_name
-        call_stack.metadata_items = metadata_list
-        # add to session
-        db_session.add(call_stack)
+    for profile, call_stack_name_id in zip(packet['stats'], call_stack_name_ids):
+        # store the pickled stats as received, they are only turned into a
+        # pstats.Stats object when somebody looks at the call stack
+        pickled_stats = str(profile['profile'])
+        _id = batch.add_blob(pickled_stats)
 
-    db_session.commit()
+        # Add call stack
+        batch.add_fact(db.CallStack.__table__,
+                       {'call_stack_name_id': call_stack_name_id,
+                        'datetime': profile['datetime'],
+                        'duration': profile_duration(pickled_stats),
+                        'pstat_uuid': _id,
+                        'metadata_set_id': metadata_set_id})
  
 
-def parse_sql_packet(packet):
-    db_session = db.session
-                    
+def profile_duration(pickled_stats):
+    '''The total time of a pickled profile, as pstats.Stats would report it'''
+    stats = cPickle.loads(pickled_stats)
+    return sum(stat[2] for stat in stats.itervalues())
+
+
+def parse_sql_packet(packet, batch):
     # Get flush metadata
-    global_metadata_list = get_metadata_list(packet['metadata'], db_session)
+    global_metadata_ids = get_metadata_ids(packet['metadata'])
+
+    # get-or-set all the dimension rows for the whole packet in one go
+    sql_string_ids = dimensions.resolve(db.SQLString,
+                                        [(profile['sql_string'],) for profile in packet['stats']])
+
+    # Parse SQL strings
+    statement_metadata = []
+    for profile, sql_string_id in zip(packet['stats'], sql_string_ids):
+        statement_type, identifiers = sql_identifiers.extract(sql_string_id, profile['sql_string'])
+        statement_metadata.append(metadata_keys({'statement_identifiers':identifiers,
+                                                 'statement_type':statement_type}))
+
+    metadata_ids = dict(zip(*lookup(db.MetaData, statement_metadata)))
+    # each statement's metadata is the flush metadata plus its own
+    metadata_set_ids = dimensions.resolve_metadata_sets([set(global_metadata_ids + [metadata_ids[key] for key in sql_metadata])
+                                                         for sql_metadata in statement_metadata])
+    stack_item_ids = dict(zip(*lookup(db.SQLStackItem, [[(stack_item['module'], stack_item['function'])
+                                                         for stack_item in profile['stack']]
+                                                        for profile in packet['stats']])))
+    sql_stack_ids = dimensions.resolve_sql_stacks([[stack_item_ids[(stack_item['module'], stack_item['function'])]
+                                                    for stack_item in profile['stack']]
+                                                   for profile in packet['stats']])
+
+    for profile, metadata_set_id, sql_stack_id, sql_string_id in zip(packet['stats'], metadata_set_ids,
+                                                                      sql_stack_ids, sql_string_ids):
+        # create the statement row
+        batch.add_fact(db.SQLStatement.__table__,
+                       {'sql_string_id': sql_string_id,
+                        'datetime': profile['datetime'],
+                        'duration': profile['duration'],
+                        'metadata_set_id': metadata_set_id,
+                        'sql_stack_id': sql_stack_id,
+                        'args': captured_args(profile)})
+
+
+def parse_file_packet(packet, batch):
+    # Get flush metadata
+    metadata_set_id = get_metadata_set_id(packet['metadata'])
+
+    # Add filenames
+    file_name_ids = dimensions.resolve(db.FileName,
+                                       [(profile['filename'],) for profile in packet['stats']])
+    
+    for profile, file_name_id in zip(packet['stats'], file_name_ids):
+        # Add file access row
+        batch.add_fact(db.FileAccess.__table__,
+                       {'file_name_id': file_name_id,
+                        'datetime': profile['datetime'],
+                        'time_to_open': profile['time_to_open'],
+                        'duration': profile['duration'],
+                        'data_written': profile['data_written'],
+                        'mode': profile['mode'],
+                        'metadata_set_id': metadata_set_id})
     
-    for profile in packet['stats']:
-        # get-or-set all arguments (do not map relationship yet)
-        sql_arg_list = get_arg_list(db_session, profile['args'])
-
-        # get-or-set all stack items (do not map relationship yet)
-        sql_stack_item_list = get_stack_list(db_session, profile['stack'])
-
-        # Parse SQL string
-        parsed_sql = parse_sql(profile['sql_string'])[0]
-        sql_identifiers = []
-        for token in parsed_sql.tokens:
-            for item in token.flatten():
-                if item.ttype == sql_tokens.Name:
-                    sql_identifiers.append(item.value)
-        statement_type = profile['sql_string'].split()[0]
-
-        # get-or-set the metadata
-        sql_identifiers = get_metadata_list({'statement_identifiers':sql_identifiers,
-                                             'statement_type':statement_type},
-                                            db_session)
-        metadata_list = global_metadata_list + sql_identifiers
-
-        # get-or-set the sql string
-        sql_string = get_or_create(db_session,
-                                   db.SQLString,
-                                   sql=profile['sql_string'])
-        
-        # create the statement object
-        sql_statement = db.SQLStatement(profile)
 
-        # add the arg asssociatons
-        for i, arg in enumerate(sql_arg_list):
-            sql_arg_assoc = db.SQLArgAssociation(index=i)
-            sql_arg_assoc.arg = arg
-            sql_statement.arguments.append(sql_arg_assoc)
+def metadata_keys(metadata_dictionary):
+    '''Flatten a metadata dictionary into a list of unique (key, value) pairs'''
+    keys = []
+    for metadata_key, dict_values in metadata_dictionary.items():
+        # make each value in the dictionary a list, even if only one value
+        if not isinstance(dict_values, list):
+            dict_values = [dict_values]
+        for dict_value in dict_values:
+            if (metadata_key, dict_value) not in keys:
+                keys.append((metadata_key, dict_value))
+    return keys
 
-        # add the stack asssociatons
-        for i, stack_item in enumerate(sql_stack_item_list):
-            sql_stack_item_assoc = db.SQLStackAssociation(index=i)
-            sql_stack_item_assoc.stack_item = stack_item
-            sql_statement.sql_stack_items.append(sql_stack_item_assoc)
 
-        # add the metadata
-        sql_statement.metadata_items = metadata_list
+def get_metadata_ids(metadata_dictionary):
+    return list(set(dimensions.resolve(db.MetaData, metadata_keys(metadata_dictionary))))
 
-        # add the sql string
-        sql_statement.sql_string = sql_string
 
-        # Add sql statement to session
-        db_session.add(sql_statement)
-    
-    db_session.commit()
+def get_metadata_set_id(metadata_dictionary):
+    return dimensions.resolve_metadata_sets([get_metadata_ids(metadata_dictionary)])[0]
 
 
-def parse_file_packet(packet):
-    db_session = db.session
-                    
-    # Get flush metadata
-    metadata_list = get_metadata_list(packet['metadata'], db_session)
-    
-    for profile in packet['stats']:
-        # Add filename
-        filename = get_or_create(db_session,
-                                 db.FileName,
-                                 filename=profile['filename'])
-        # Add file access row
-        file_access = db.FileAccess(profile)
-        file_access.filename = filename
-        file_access.metadata_items = metadata_list
-        # add to session
-        db_session.add(file_access)
+def captured_args(profile):
+    '''The args of a statement to store according to the capture policy, keys and values alternating'''
+    if args_capture == 'none':
+        return None
+    if args_capture == 'slow' and profile['duration'] < args_min_duration:
+        return None
+    if args_capture == 'sample' and random.random() * args_sample_rate >= 1:
+        return None
+    args = []
+    for key, value in arg_keys(profile['args']):
+        args.extend((dimensions.normalise(key), dimensions.normalise(value)))
+    return args
 
-    db_session.commit()
-    
 
-def get_metadata_list(metadata_dictionary, db_session):
-    metadata_list = []
-    for metadata_key in metadata_dictionary.keys():
-        # make each value in the dictionary a list, even if only one value
-        if not isinstance(metadata_dictionary[metadata_key], list):
-            metadata_dictionary[metadata_key] = [metadata_dictionary[metadata_key]]
-        for dict_value in metadata_dictionary[metadata_key]:
-            metadata_list.append(get_or_create(db_session,
-                                               db.MetaData,
-                                               key=metadata_key,
-                                               value=dict_value))
-    return list(set(metadata_list))
-
-
-def get_arg_list(db_session, args):
-    arg_list = []
+def arg_keys(args):
     if isinstance(args, list): # sqlite
-        for val in args:
-            sql_arg = get_or_create(db_session,
-                                    db.SQLArg,
-                                    key='?',
-                                    value=val)
-            arg_list.append(sql_arg)
+        return [('?', val) for val in args]
     elif isinstance(args, dict): # postgres
-        for key,val in args.iteritems():
-            sql_arg = get_or_create(db_session,
-                                    db.SQLArg,
-                                    key=key,
-                                    value=val)
-            arg_list.append(sql_arg)
-    return arg_list
-
-def get_stack_list(db_session, stack):
-    sql_stack_item_list = []
-    for stack_item in stack:
-        sql_stack_item = get_or_create(db_session,
-                                       db.SQLStackItem,
-                                       function=stack_item['function'],
-                                       module=stack_item['module'])
-        sql_stack_item_list.append(sql_stack_item)
-    return sql_stack_item_list
-
-def get_or_create(session, model, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).first()
-    if not instance:
-        instance = model(**kwargs)
-        session.add(instance)
-    return instance
+        return args.items()
+    return []
+
+
+def lookup(model, key_lists):
+    '''
+    Resolve the ids of every key in a list of key lists with a single
+    dimension lookup, returning the distinct keys and their ids
+    '''
+    keys = list(set(key for key_list in key_lists for key in key_list))
+    return keys, dimensions.resolve(model, keys)
+
 
+parsers = dict((parse_fn.__name__, parse_fn)
+               for parse_fn in (parse_fn_packet, parse_sql_packet, parse_file_packet))
 
+ingest_status = IngestStatus()
 function_stat_handler = StatHandler(parse_fn_packet)
 handler_stat_handler = StatHandler(parse_fn_packet)
 sql_stat_handler = StatHandler(parse_sql_packet)
@@ -79,6 +79,10 @@ $(document).ready(function() {
 				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] }
 			],
 
@@ -1,7 +1,11 @@
-function draw(data){
+function draw(series){
+	// series.sample holds [duration, datetime, id] of some of the calls,
+	// series.buckets [start, count, avg, max, p99] of each time bucket
 	var height = 400,
 		width = $('.item_container').width(),
-		margins = {'x': 50, 'y': 80};
+		margins = {'x': 50, 'y': 80},
+		data = series.sample,
+		buckets = series.buckets;
 
 	$('#function_graph svg').remove();
 
@@ -13,10 +17,14 @@ function draw(data){
 		.enter()
 		.append('circle')
 
-	var x_extent = d3.extent(data, function(d){ return d[1] * 1000; });
+	var times = data.map(function(d){ return d[1] * 1000; })
+		.concat(buckets.map(function(d){ return (d[0] + series.width / 2) * 1000; }));
+	var x_extent = d3.extent(times);
 	var x_scale = d3.time.scale().range([margins['y'], width - 10]).domain(x_extent);
 
-	var y_extent = d3.extent(data, function(d){ return d[0]; });
+	var durations = data.map(function(d){ return d[0]; })
+		.concat(buckets.map(function(d){ return d[3]; }));
+	var y_extent = d3.extent(durations);
 	var y_scale = d3.scale.linear().range([height - margins['x'], margins['x']]).domain(y_extent);
 
 	d3.selectAll('circle')
@@ -26,11 +34,15 @@ function draw(data){
 		.attr('class', 'datum')
 		.attr('data-id', function(d){ return d[2]; });
 
-	var line = d3.svg.line()
-		 .x(function(d){ return x_scale(d[1] * 1000); })
-		 .y(function(d){ return y_scale(d[0]); });
+	// average and 99th percentile of each bucket, plotted at its middle
+	function bucket_line(column){
+		return d3.svg.line()
+			.x(function(d){ return x_scale((d[0] + series.width / 2) * 1000); })
+			.y(function(d){ return y_scale(d[column]); });
+	}
 
-	d3.select('svg').append('path').attr('d', line(data));
+	d3.select('svg').append('path').attr('class', 'avg').attr('d', bucket_line(2)(buckets));
+	d3.select('svg').append('path').attr('class', 'p99').attr('d', bucket_line(4)(buckets));
 
 	var x_axis = d3.svg.axis().scale(x_scale);
 	d3.select('svg')
@@ -76,8 +88,12 @@ function load_stats(data) {
 		$('.stat_avg').text(item[4]);
 		$('.stat_min').text(item[5]);
 		$('.stat_max').text(item[6]);
+		$('.stat_p50').text(item[7]);
+		$('.stat_p90').text(item[8]);
+		$('.stat_p95').text(item[9]);
+		$('.stat_p99').text(item[10]);
 
-		draw(item[7]);
+		draw(item[11]);
 	}
 }
 
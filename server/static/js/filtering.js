@@ -1,5 +1,32 @@
+function date_window() {
+	// The period the page shows, if it has date inputs, so the side bar offers its metadata
+	var period = {},
+		start_date = new Date($('#filter_from').val()) / 1000,
+		end_date = new Date($('#filter_to').val()) / 1000;
+
+	if (start_date)
+		period.start_date = start_date;
+	if (end_date)
+		period.end_date = end_date;
+	return period;
+}
+
+function load_keys() {
+	$.getJSON('/tables/api/metadata', $.extend({get_keys: url_name}, date_window()), function(data){
+		key_select = $('#filter_key');
+		var selected = key_select.val();
+		// Remove the keys of the last period, all but the "Select metadata key" option
+		key_select.find('option:gt(0)').remove();
+		// Insert the new ones from the array above
+		$.each(data, function(value) {
+			key_select.append($("<option />").val(data[value][0]).text(data[value][0] + ' (' + data[value][1] + ')'));
+		});
+		key_select.val(selected);
+	});
+}
+
 function filter_key() {
-	var filter_key = $(this).val();
+	var filter_key = $('#filter_key').val();
 
 	// Remove all options (except the "No Value Selected" one) from the select list first
 	val_select = $('#filter_value');
@@ -9,10 +36,10 @@ function filter_key() {
 		var loader = $('.loader');
 		loader.show();
 
-		$.getJSON('/tables/api/metadata', {key: filter_key}, function(data) {
-			// Insert the new options from the array
+		$.getJSON('/tables/api/metadata', $.extend({key: filter_key, table: url_name}, date_window()), function(data) {
+			// Insert the new options from the array of [value, count] pairs
 			$.each(data, function(value) { // Use $.each over the built in forEach so we don't have to deal with problems with null values, it'll just gloss over that for us :)
-				val_select.append($("<option />").val(data[value]).text(data[value]));
+				val_select.append($("<option />").val(data[value][0]).text(data[value][0] + ' (' + data[value][1] + ')'));
 			});
 
 			loader.hide();
@@ -115,16 +142,16 @@ $(document).ready(function() {
 
 	$('#filters').trigger('load', [kwargs]);
 
-	$.getJSON('/tables/api/metadata', {get_keys: url_name}, function(data){
-		key_select = $('#filter_key');
-		// Insert the new ones from the array above
-		$.each(data, function(value) {
-			key_select.append($("<option />").val(data[value]).text(data[value]));
-		});
-	});
+	load_keys();
 
 	// Make the filtering work.
 	$('#filter_key').change(filter_key);
+	// and offer the metadata of the period picked
+	$('#filter_from, #filter_to').change(function() {
+		load_keys();
+		if ($('#filter_key')[0].selectedIndex > 0)
+			filter_key();
+	});
 	$('#filter_value').change(add_filter);
 	$('.clear_filters').click(clear_filters);
 });
\ No newline at end of file
@@ -22,6 +22,7 @@ for path in os.listdir(lib_dir):
 import cherrypy
 import sys
 import database as db
+import dimensions
 import os
 import mako.template
 
@@ -30,7 +31,17 @@ from table_ui import Tables
 from aggregate_json_ui import AggregateAPI
 from aggregate_table_ui import AggregatePages
 
-from stat_handlers import function_stat_handler, handler_stat_handler, sql_stat_handler, file_stat_handler
+import stat_handlers
+import pstats_store
+import rollups
+import retention
+import partitions
+import result_cache
+import facets
+import call_graphs
+import merged_profiles
+import aggregate_json_ui
+from stat_handlers import function_stat_handler, handler_stat_handler, sql_stat_handler, file_stat_handler, ingest_status
 
 
 # add gzip to allowed content types for decompressing JSON if compressed.
@@ -42,6 +53,15 @@ def handle_error():
                             ).render(error_str=cherrypy._cperror.format_exc())
 
 
+def remove_session():
+    '''End the request's transaction and hand its connection back to the pool'''
+    db.session.remove()
+
+# Otherwise each web thread's session stays idle in a transaction, holding
+# locks on every partition it read which a retention drop would wait for
+cherrypy.tools.remove_session = cherrypy.Tool('on_end_request', remove_session)
+
+
 def start_cherrypy(host, port):
     cherrypy.server.socket_host = host
     cherrypy.server.socket_port = int(port)
@@ -61,6 +81,7 @@ def start_cherrypy(host, port):
         }
 
     cherrypy.config.update({'request.error_response': handle_error})
+    cherrypy.config.update({'tools.remove_session.on': True})
     cherrypy.config.update({'error_page.404': os.path.join(os.getcwd(),'static','templates','404.html')})
 
 
@@ -69,6 +90,7 @@ def start_cherrypy(host, port):
     cherrypy.tree.mount(handler_stat_handler,  '/handler',    method_dispatch_cfg )
     cherrypy.tree.mount(sql_stat_handler,      '/database',   method_dispatch_cfg )
     cherrypy.tree.mount(file_stat_handler,     '/file',       method_dispatch_cfg )
+    cherrypy.tree.mount(ingest_status,         '/ingest')
 
     cherrypy.tree.mount(Tables(),              '/tables')
     cherrypy.tree.mount(JSONAPI(),             '/tables/api')
@@ -122,12 +144,56 @@ if __name__ == '__main__':
     options, args = _parse_options()
     print 'hi'
     try:
+        # Fork the processes merging the profiles of each call stack name before
+        # anything else starts, so they inherit no threads, database
+        # connections or open segment files
+        merged_profiles.setup(int(cfg.get('profile_merge_processes', 2)),
+                              int(cfg.get('profile_merge_queue_size', 100000)),
+                              int(cfg.get('profile_merge_interval', 60)))
+
         # Set up the initialise database config
         db.setup(cfg['database_username'], cfg['database_password'], reset_db=options.reset_db)
 
-        # Ensure we have a pstats directory to write into.
-        if not os.path.exists('pstats'):
-            os.makedirs('pstats')
+        # Warm the dimension caches used by the ingest workers
+        dimensions.setup(int(cfg.get('dimension_cache_size', 100000)), int(cfg.get('dimension_grace_period', 3600)))
+
+        # Open the segment files profiles are stored in
+        pstats_store.setup(cfg.get('pstats_dir', 'pstats'), int(cfg.get('pstats_segment_size', 268435456)),
+                           int(cfg.get('pstats_grace_period', 3600)))
+
+        # Build the call graphs of profiles as they are ingested
+        call_graphs.setup(int(cfg.get('call_graph_workers', 1)), int(cfg.get('call_graph_queue_size', 10000)))
+
+        # Create the fact table partitions for the days ahead
+        partitions.setup(int(cfg.get('partition_days', 1)), int(cfg.get('partitions_ahead', 7)))
+
+        # Count the metadata of recent facts for the filter side bar
+        facets.setup(int(cfg.get('facet_days', 7)), int(cfg.get('facet_cache_size', 100000)))
+
+        # Cache the results of the aggregate queries between ingests
+        result_cache.setup(int(cfg.get('result_cache_size', 1000)), int(cfg.get('result_cache_ttl', 30)))
+        aggregate_json_ui.setup(int(cfg.get('approximate_count_threshold', 100000)))
+
+        # Start the ingest workers
+        stat_handlers.setup(int(cfg.get('ingest_workers', 4)),
+                            int(cfg.get('ingest_batch_size', 50)),
+                            int(cfg.get('ingest_queue_packets', 10000)),
+                            int(cfg.get('ingest_queue_bytes', 536870912)),
+                            cfg.get('packet_log_dir', 'packet_log'),
+                            int(cfg.get('packet_log_segment_size', 67108864)),
+                            cfg.get('sql_args_capture', 'all'),
+                            float(cfg.get('sql_args_min_duration', 0.0)),
+                            int(cfg.get('sql_args_sample_rate', 1)))
+
+        # Start purging data older than configured
+        retention.setup(int(cfg.get('retention_interval', 3600)),
+                        int(cfg.get('retention_batch_size', 1000)),
+                        dict((table, int(cfg.get('retention_{0}_days'.format(table), 0)))
+                             for table in ('call_stacks', 'sql_statements', 'file_accesses')),
+                        dict((resolution, int(cfg.get('retention_{0}_rollups_days'.format(name), 0)))
+                             for name, resolution in (('minute', rollups.minute),
+                                                      ('hour', rollups.hour),
+                                                      ('day', rollups.day))))
 
         start_cherrypy(cfg['server_host'], cfg['server_port'])
     except Exception, ex: